@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Optional
+
+from aiogram import Bot
+
+from config import JOIN_REQUEST_BATCH_SIZE, JOIN_REQUEST_BATCH_WINDOW
+from db import ConnectionPool, iter_active_subscriptions
+from outbound import OutboundQueue
+
+if TYPE_CHECKING:
+    from subscriptions import SubscriptionCache
+
+logger = logging.getLogger('bot_logger')
+
+
+class ActiveSubscribers:
+    """
+    Действующие подписчики в памяти: user_id -> end_date (None - бессрочно).
+
+    Загружается из subscriptions при запуске, дальше обновляется через
+    SubscriptionCache.update и SubscriptionCache.expire, поэтому проверка
+    доступа не обращается к базе.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self._end_dates = {}
+
+    async def load(self):
+        end_dates = {}
+        async for batch in iter_active_subscriptions(self.pool):
+            end_dates.update(batch)
+        self._end_dates = end_dates
+
+    def update(self, user_id: int, end_date: Optional[int]):
+        """Слушатель pool.add_subscription_listener"""
+        self._end_dates[user_id] = end_date
+
+    def expire(self, user_id: int, end_date: int):
+        # Подписку могли продлить: удаляем только ту, что действительно закончилась
+        if self._end_dates.get(user_id, end_date) == end_date:
+            self._end_dates.pop(user_id, None)
+
+    def is_active(self, user_id: int) -> bool:
+        if user_id not in self._end_dates:
+            return False
+        end_date = self._end_dates[user_id]
+        return end_date is None or end_date >= time.time()
+
+    def __len__(self):
+        return len(self._end_dates)
+
+
+class JoinRequestProcessor:
+    """
+    Одобряет заявки на вступление подписчиков и отклоняет остальные.
+
+    Хендлер только ставит заявку в очередь. Фоновая задача собирает заявки,
+    пришедшие в пределах batch_window, в пачку до batch_size штук и отвечает
+    на них параллельно через полосу 'payment' очереди исходящих запросов.
+    """
+
+    def __init__(self, bot: Bot, chat_id, subscriptions: 'SubscriptionCache',
+                 outbound: OutboundQueue, batch_size: int = JOIN_REQUEST_BATCH_SIZE,
+                 batch_window: float = JOIN_REQUEST_BATCH_WINDOW):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.subscriptions = subscriptions
+        self.outbound = outbound
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        self._task = None
+
+    def submit(self, user_id: int):
+        if user_id not in self._queued:
+            self._queued.add(user_id)
+            self._queue.put_nowait(user_id)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _next_batch(self) -> list:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            self._queued.difference_update(batch)
+            await asyncio.gather(*(self._answer(user_id) for user_id in batch))
+
+    async def _answer(self, user_id: int):
+        approve = self.subscriptions.is_active(user_id)
+        method = self.bot.approve_chat_join_request if approve else self.bot.decline_chat_join_request
+        try:
+            await self.outbound.call('payment', None, method, self.chat_id, user_id)
+        except Exception as e:
+            # Заявку могли отозвать или уже обработать вручную
+            logger.warning(f"Failed to {'approve' if approve else 'decline'} join request of {user_id}: {e}")
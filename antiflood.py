@@ -0,0 +1,126 @@
+import time
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import ADMIN_ID
+
+
+class _FloodState:
+    """Состояние одного пользователя: пара чисел вместо списка отметок времени"""
+
+    __slots__ = ('tat', 'banned_until', 'seen')
+
+    def __init__(self, now: float):
+        self.tat = now  # Теоретическое время прихода следующего сообщения (GCRA)
+        self.banned_until = 0.0
+        self.seen = now
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """
+    Защита от флуда сообщениями и нажатиями кнопок.
+
+    Лимит "не больше limit событий за interval секунд" считается по GCRA:
+    на пользователя хранится одно число, проверка - O(1). Бан хранится как
+    дедлайн и проверяется при следующем событии, без отдельной задачи.
+    Пользователи хранятся в LRU: неактивные дольше idle_ttl и всё, что
+    сверх max_users, вытесняется, поэтому память ограничена.
+
+    Если передан store (общее хранилище из storage.py), состояние хранится
+    в нём, и лимит с баном действуют сразу для всех процессов бота.
+    """
+
+    def __init__(self, limit=3, interval=1, ban_time=300, max_users=100000, idle_ttl=600, store=None):
+        self.limit = limit  # Максимальное количество сообщений
+        self.interval = interval  # Интервал в секундах
+        self.ban_time = ban_time  # Длительность блокировки в секундах
+        self.max_users = max_users
+        self.idle_ttl = max(idle_ttl, ban_time)
+        self.emission = interval / limit
+        self.tolerance = interval - self.emission
+        self._users = OrderedDict()
+        self.store = store
+        super(AntiFloodMiddleware, self).__init__()
+
+    def _evict(self, now: float):
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if len(self._users) <= self.max_users and now - state.seen < self.idle_ttl:
+                break
+            del self._users[user_id]
+
+    def _step(self, state: _FloodState, now: float):
+        if now < state.banned_until:
+            return 'banned'
+
+        tat = max(state.tat, now)
+        if tat - now > self.tolerance:
+            state.banned_until = now + self.ban_time
+            state.tat = now
+            return 'flood'
+        state.tat = tat + self.emission
+        return None
+
+    async def check(self, user_id: int):
+        """Возвращает None, 'flood' (только что забанен) или 'banned'"""
+        if self.store is not None:
+            return await self._check_shared(user_id)
+
+        now = time.monotonic()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _FloodState(now)
+            self._evict(now)
+        else:
+            self._users.move_to_end(user_id)
+        state.seen = now
+        return self._step(state, now)
+
+    async def _check_shared(self, user_id: int):
+        # В общем хранилище время должно быть общим для процессов, поэтому time.time()
+        now = time.time()
+        key = f"flood:{user_id}"
+        state = _FloodState(now)
+        raw = await self.store.get(key)
+        if raw:
+            tat, banned_until = raw.split(':')
+            state.tat, state.banned_until = float(tat), float(banned_until)
+
+        result = self._step(state, now)
+        if result != 'banned':
+            await self.store.set(key, f"{state.tat}:{state.banned_until}", self.idle_ttl)
+        return result
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        # Пропускаем сообщения от админа
+        if str(message.from_user.id) == ADMIN_ID:
+            return
+
+        result = await self.check(message.from_user.id)
+        if result == 'banned':
+            await message.answer("Вы временно заблокированы за спам.")
+            raise CancelHandler()
+        if result == 'flood':
+            await message.answer(
+                "Вы отправляете сообщения слишком часто. "
+                f"Вы заблокированы на {self.ban_time // 60} минут."
+            )
+            raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        if str(callback_query.from_user.id) == ADMIN_ID:
+            return
+
+        result = await self.check(callback_query.from_user.id)
+        if result == 'banned':
+            await callback_query.answer("Вы временно заблокированы за спам.")
+            raise CancelHandler()
+        if result == 'flood':
+            await callback_query.answer(
+                f"Слишком много нажатий. Вы заблокированы на {self.ban_time // 60} минут.",
+                show_alert=True
+            )
+            raise CancelHandler()
@@ -0,0 +1,272 @@
+"""
+Микробенчмарк запросов db.py на больших объёмах.
+
+Заполняет временную базу SQLite (--users пользователей, доля --subscribed
+из них с подпиской и платежом), затем для каждой конфигурации PRAGMA/индексов
+замеряет функции db.py при --concurrency одновременных вызовах.
+
+Примеры:
+    python benchmarks/bench_db.py --users 100000
+    python benchmarks/bench_db.py --users 1000000 --configs default,sync_full,no_end_date_index
+    python benchmarks/bench_db.py --output new.json --compare baseline.json
+
+Результат - JSON (--output или stdout): сравнение с прошлым прогоном через
+--compare печатает отношение задержек и завершается с кодом 1, если p50 или
+p99 какой-то операции выросли больше чем на --threshold.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aiogram import types  # noqa: E402
+import db  # noqa: E402
+
+DAY = db.DAY
+FILL_CHUNK = 100000
+
+# Операции только читают, поэтому перед замером их можно прогреть (кэш страниц, потоки соединений)
+READ_OPERATIONS = {'get_user_subscriptions', 'get_expiring_subscriptions', 'check_expired_subscriptions',
+                   'get_all_users'}
+
+# Конфигурации: изменения PRAGMA относительно db.PRAGMAS, удаляемые индексы, число читателей
+CONFIGS = {
+    'default': {},
+    'sync_full': {'pragmas': {'synchronous': 'FULL'}},
+    'sqlite_defaults': {'pragmas': {'cache_size': '-2000', 'mmap_size': '0', 'temp_store': 'DEFAULT'}},
+    'no_end_date_index': {'drop_indexes': ['idx_subscriptions_end_date']},
+    'readers_4': {'readers': 4},
+}
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def build_pragmas(overrides: dict) -> tuple:
+    pragmas = []
+    for pragma in db.PRAGMAS:
+        name = pragma.split()[1]
+        if name in overrides:
+            pragma = f'PRAGMA {name} = {overrides[name]}'
+        pragmas.append(pragma)
+    return tuple(pragmas)
+
+
+def fill(path: str, users: int, subscribed: float, seed: int) -> dict:
+    """Создаёт схему через init_db и заливает данные напрямую через sqlite3"""
+    async def create_schema():
+        pool = await db.create_pool(path)
+        await db.init_db(pool)
+        await pool.close()
+    asyncio.run(create_schema())
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')
+    subscriptions = 0
+    for start in range(1, users + 1, FILL_CHUNK):
+        ids = range(start, min(start + FILL_CHUNK, users + 1))
+        conn.executemany(
+            'INSERT INTO users (user_id, username, first_name, joined_date) VALUES (?, ?, ?, ?)',
+            ((user_id, f'user{user_id}', f'User{user_id}', now - rng.randrange(365 * DAY)) for user_id in ids)
+        )
+        rows = []
+        for user_id in ids:
+            if rng.random() >= subscribed:
+                continue
+            # Окончания равномерно в пределах года в обе стороны, 5% бессрочных
+            end_date = None if rng.random() < 0.05 else now + rng.randrange(-365 * DAY, 365 * DAY)
+            rows.append((user_id, now - 400 * DAY, end_date))
+        conn.executemany('''
+            INSERT INTO subscriptions (user_id, start_date, end_date, subscription_type, payment_method, amount)
+            VALUES (?, ?, ?, 'month', 'tg_stars', 1000)
+        ''', rows)
+        conn.executemany('''
+            INSERT INTO payments (user_id, amount, status, payment_method, provider, external_id,
+                                  created_at, completed_at)
+            VALUES (?, 1000, 'completed', 'tg_stars', 'tg_stars', ?, ?, ?)
+        ''', ((user_id, f'seed-{user_id}', start_date, start_date) for user_id, start_date, _ in rows))
+        subscriptions += len(rows)
+        conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    return {'users': users, 'subscriptions': subscriptions, 'payments': subscriptions}
+
+
+async def measure(call, calls: int, concurrency: int, finish=None) -> dict:
+    """
+    Выполняет call(i) calls раз не более чем в concurrency потоков.
+    finish - завершающий шаг, который входит в общее время (но не в задержки вызовов).
+    """
+    latencies = []
+    counter = iter(range(calls))
+
+    async def worker():
+        for i in counter:
+            started = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, calls))))
+    if finish is not None:
+        await finish()
+    elapsed = time.perf_counter() - started
+    return {
+        'calls': calls,
+        'elapsed_s': round(elapsed, 4),
+        'ops_per_s': round(calls / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+    }
+
+
+async def run_config(path: str, name: str, config: dict, dataset: dict, args) -> list:
+    if config.get('drop_indexes'):
+        conn = sqlite3.connect(path)
+        for index in config['drop_indexes']:
+            conn.execute(f'DROP INDEX IF EXISTS {index}')
+        conn.close()
+
+    default_pragmas = db.PRAGMAS
+    db.PRAGMAS = build_pragmas(config.get('pragmas', {}))
+    try:
+        pool = db.ConnectionPool(path, readers=config.get('readers', db.DB_READERS))
+        pool.users = db.UserWriteBuffer(pool, mode=args.user_write_mode)
+        await pool.open()
+    finally:
+        db.PRAGMAS = default_pragmas
+
+    rng = random.Random(args.seed)
+    users = dataset['users']
+    ops, scan_ops, concurrency = args.ops, args.scan_ops, args.concurrency
+
+    async def add_user(i):
+        user_id = users + 1 + i
+        await db.add_user(pool, types.User(id=user_id, is_bot=False, first_name=f'User{user_id}'))
+
+    operations = [
+        ('get_user_subscriptions', ops, lambda i: db.get_user_subscriptions(pool, rng.randint(1, users)), None),
+        ('get_expiring_subscriptions', scan_ops, lambda i: db.get_expiring_subscriptions(pool, 7), None),
+        ('check_expired_subscriptions', scan_ops, lambda i: db.check_expired_subscriptions(pool), None),
+        ('get_all_users', scan_ops, lambda i: db.get_all_users(pool), None),
+        # В режиме 'buffered' пользователи попадают в базу при сбросе буфера - он входит в общее время
+        ('add_user', ops, add_user, pool.users.flush),
+        ('add_subscription', ops, lambda i: db.add_subscription(
+            pool, rng.randint(1, users), 'month', 'tg_stars', 1000, external_id=f'{name}-{i}'
+        ), None),
+    ]
+
+    results = []
+    try:
+        for operation, calls, call, finish in operations:
+            if args.operations and operation not in args.operations:
+                continue
+            if operation in READ_OPERATIONS:
+                await measure(call, min(calls, concurrency), concurrency)
+            result = await measure(call, calls, concurrency, finish)
+            results.append(dict({'config': name, 'operation': operation, 'concurrency': concurrency}, **result))
+            print(f"{name:<18} {operation:<28} {result['ops_per_s']:>10} ops/s  "
+                  f"p50 {result['p50_ms']:>9} ms  p99 {result['p99_ms']:>9} ms", file=sys.stderr)
+    finally:
+        await pool.close()
+    return results
+
+
+def compare(results: list, baseline_path: str, threshold: float) -> bool:
+    """Печатает сравнение с прошлым прогоном; False, если есть регрессия"""
+    with open(baseline_path) as f:
+        baseline = {(row['config'], row['operation']): row for row in json.load(f)['results']}
+    ok = True
+    for row in results:
+        old = baseline.get((row['config'], row['operation']))
+        if old is None:
+            continue
+        ratios = {key: row[key] / old[key] if old[key] else 1.0 for key in ('p50_ms', 'p99_ms')}
+        regressed = any(ratio > 1 + threshold for ratio in ratios.values())
+        ok = ok and not regressed
+        print(f"{row['config']:<18} {row['operation']:<28} p50 x{ratios['p50_ms']:.2f}  "
+              f"p99 x{ratios['p99_ms']:.2f}{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    return ok
+
+
+def parse_args(argv: list):
+    parser = argparse.ArgumentParser(description="Бенчмарк запросов db.py")
+    parser.add_argument('--users', type=int, default=100000, help="пользователей в базе (1k - 10M)")
+    parser.add_argument('--subscribed', type=float, default=0.5, help="доля пользователей с подпиской")
+    parser.add_argument('--configs', default='default,sync_full,sqlite_defaults,no_end_date_index',
+                        help=f"конфигурации через запятую: {', '.join(CONFIGS)}")
+    parser.add_argument('--operations', default='', help="замерять только эти функции (через запятую)")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременных вызовов")
+    parser.add_argument('--ops', type=int, default=2000, help="вызовов точечных операций")
+    parser.add_argument('--scan-ops', type=int, default=20, help="вызовов операций, читающих всю таблицу")
+    parser.add_argument('--user-write-mode', default=db.USER_WRITE_MODE, choices=('buffered', 'immediate'))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="файл для результатов (по умолчанию stdout)")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.2, help="допустимый рост задержки (0.2 = +20%%)")
+    args = parser.parse_args(argv)
+    args.configs = [name for name in args.configs.split(',') if name]
+    args.operations = [name for name in args.operations.split(',') if name]
+    unknown = [name for name in args.configs if name not in CONFIGS]
+    if unknown:
+        parser.error(f"unknown configs: {', '.join(unknown)}")
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    with tempfile.TemporaryDirectory() as workdir:
+        template = os.path.join(workdir, 'template.db')
+        started = time.perf_counter()
+        dataset = fill(template, args.users, args.subscribed, args.seed)
+        print(f"Filled {dataset} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        results = []
+        for name in args.configs:
+            # Каждая конфигурация получает свою копию одинаковых данных
+            path = os.path.join(workdir, f'{name}.db')
+            shutil.copyfile(template, path)
+            results.extend(asyncio.run(run_config(path, name, CONFIGS[name], dataset, args)))
+
+    report = {
+        'meta': {
+            'dataset': dataset,
+            'concurrency': args.concurrency,
+            'ops': args.ops,
+            'scan_ops': args.scan_ops,
+            'user_write_mode': args.user_write_mode,
+            'sqlite_version': sqlite3.sqlite_version,
+            'python': platform.python_version(),
+            'timestamp': int(time.time()),
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
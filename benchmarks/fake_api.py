@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Методы, которые в настоящем Bot API упираются в лимиты и могут вернуть 429
+THROTTLED_METHODS = {
+    'sendMessage', 'copyMessage', 'editMessageText', 'sendInvoice', 'answerCallbackQuery',
+    'banChatMember', 'unbanChatMember', 'approveChatJoinRequest', 'declineChatJoinRequest',
+}
+
+# Курсы для заглушки Crypto Pay: сколько рублей стоит единица актива
+CRYPTO_RATES = {'TON': '500', 'USDT': '95', 'BTC': '6000000', 'ETH': '250000'}
+CRYPTO_DECIMALS = {'TON': 9, 'USDT': 6, 'BTC': 8, 'ETH': 18}
+
+
+async def _serve(app: web.Application, host: str = '127.0.0.1') -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    return runner
+
+
+def _bound_url(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f'http://{host}:{port}'
+
+
+class FakeBotAPI:
+    """
+    Локальная заглушка Telegram Bot API.
+
+    Отвечает на методы, которыми пользуется бот, с задержкой latency секунд;
+    доля rate_429 запросов из THROTTLED_METHODS получает "429 Too Many Requests"
+    с retry_after. Обновления для getUpdates добавляются через push_update.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_429: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.throttled = 0
+        self.submitted = {}  # update_id -> время постановки в очередь
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self._runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = await _serve(app)
+        self.url = _bound_url(self._runner)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_update(self, kind: str, payload: dict) -> int:
+        update_id = next(self._update_ids)
+        self._updates.append({'update_id': update_id, kind: payload})
+        self.submitted[update_id] = time.perf_counter()
+        self._new_updates.set()
+        return update_id
+
+    async def _get_updates(self, params) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def _message(self, params) -> dict:
+        chat_id = int(params.get('chat_id') or 0)
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+            'text': params.get('text', ''),
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await request.post()
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in THROTTLED_METHODS and random.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+
+        if method in ('sendMessage', 'sendInvoice', 'editMessageText'):
+            result = self._message(params)
+        elif method == 'copyMessage':
+            result = {'message_id': next(self._message_ids)}
+        elif method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getWebhookInfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+class FakeCryptoPay:
+    """
+    Локальная заглушка Crypto Pay API.
+
+    Инвойс считается оплаченным через pay_after секунд после создания,
+    курсы берутся из CRYPTO_RATES.
+    """
+
+    def __init__(self, latency: float = 0.0, pay_after: float = 0.0):
+        self.latency = latency
+        self.pay_after = pay_after
+        self.calls = Counter()
+        self.invoices = {}
+        self._invoice_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/{method}', self._handle)
+        self._runner = await _serve(app)
+        self.url = _bound_url(self._runner) + '/api'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _invoice(self, invoice: dict) -> dict:
+        status = 'paid' if time.time() >= invoice['paid_at'] else 'active'
+        return dict(invoice, status=status)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = request.query
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'createInvoice':
+            invoice_id = next(self._invoice_ids)
+            self.invoices[invoice_id] = {
+                'invoice_id': invoice_id,
+                'asset': params['asset'],
+                'amount': params['amount'],
+                'bot_invoice_url': f'https://t.me/CryptoBot?start=IV{invoice_id}',
+                'paid_at': time.time() + self.pay_after,
+            }
+            result = self._invoice(self.invoices[invoice_id])
+        elif method == 'getInvoices':
+            ids = [int(invoice_id) for invoice_id in params.get('invoice_ids', '').split(',') if invoice_id]
+            result = {'items': [self._invoice(self.invoices[i]) for i in ids if i in self.invoices]}
+        elif method == 'getExchangeRates':
+            result = [
+                {'source': asset, 'target': 'RUB', 'rate': rate, 'is_valid': True}
+                for asset, rate in CRYPTO_RATES.items()
+            ]
+        elif method == 'getCurrencies':
+            result = [{'code': asset, 'decimals': decimals} for asset, decimals in CRYPTO_DECIMALS.items()]
+        else:
+            return web.json_response({'ok': False, 'error': {'code': 400, 'name': 'METHOD_NOT_FOUND'}})
+        return web.json_response({'ok': True, 'result': result})
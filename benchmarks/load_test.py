@@ -0,0 +1,408 @@
+"""
+Нагрузочный тест бота на локальных заглушках Telegram Bot API и Crypto Pay.
+
+Бот запускается целиком - on_startup, long polling через getUpdates,
+middleware, фоновые задачи - но ходит не в Telegram, а в FakeBotAPI.
+Сценарии:
+    start_flood    - поток /start от разных пользователей
+    payment_burst  - пачка оплат: половина Telegram Payments, половина Crypto Pay
+    broadcast      - рассылка на --broadcast-users пользователей под фоновым потоком /start
+    expiry_run     - обработка --expiring подписок, у которых подошёл этап окончания
+
+Примеры:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py start_flood --users 20000 --api-latency 0.05 --rate-429 0.01
+    python benchmarks/load_test.py --json > results.json
+
+Каждый сценарий идёт в отдельном процессе со своей временной базой, поэтому
+пиковый RSS относится к одному сценарию. Лимит Telegram по умолчанию поднят
+(--global-rate), чтобы измерять накладные расходы бота, а не ожидание лимита.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import config  # noqa: E402 - настройки подменяются до импорта bot
+from aiogram.bot.api import TelegramAPIServer  # noqa: E402
+from aiogram.dispatcher.middlewares import BaseMiddleware  # noqa: E402
+from fake_api import FakeBotAPI, FakeCryptoPay  # noqa: E402
+
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+ADMIN_ID = 1
+CHANNEL_ID = -1001
+FIRST_USER_ID = 1000
+DAY = 24 * 60 * 60
+
+SCENARIOS = {}
+
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb() -> float:
+    # В Linux ru_maxrss - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LatencyRecorder(BaseMiddleware):
+    """
+    Сырые задержки: хендлера (от прохождения фильтров до возврата) и полного
+    пути апдейта (от постановки в getUpdates до конца обработки).
+    """
+
+    def __init__(self, api: FakeBotAPI):
+        super().__init__()
+        self.api = api
+        self.handler = []
+        self.end_to_end = []
+        self.processed = 0
+
+    async def trigger(self, action, args):
+        if action.endswith('_error'):
+            return
+        data = args[-1]
+        if action == 'post_process_update':
+            self.processed += 1
+            submitted = self.api.submitted.pop(args[0].update_id, None)
+            if submitted is not None:
+                self.end_to_end.append(time.perf_counter() - submitted)
+        elif action.startswith('process_') and action != 'process_update':
+            data['_bench_started'] = time.perf_counter()
+        elif action.startswith('post_process_') and '_bench_started' in data:
+            self.handler.append(time.perf_counter() - data['_bench_started'])
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def _message(user_id: int, text: str = None, **extra) -> dict:
+    message = {
+        'message_id': int(time.time() * 1000) % 1000000,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+    }
+    if text is not None:
+        message['text'] = text
+    message.update(extra)
+    return message
+
+
+def _callback(user_id: int, data: str) -> dict:
+    return {
+        'id': str(user_id),
+        'chat_instance': str(user_id),
+        'from': _user(user_id),
+        'data': data,
+        'message': _message(user_id, 'menu'),
+    }
+
+
+class Harness:
+    """Поднимает заглушки, настраивает и запускает бота, собирает результаты"""
+
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotAPI(args.api_latency, args.rate_429)
+        self.crypto = FakeCryptoPay(args.api_latency, args.pay_after)
+        self.recorder = LatencyRecorder(self.api)
+        self.app = None
+        self._polling = None
+
+    async def prepare(self):
+        await self.api.start()
+        await self.crypto.start()
+
+        config.BOT_TOKEN = BENCH_TOKEN
+        config.ADMIN_ID = str(ADMIN_ID)
+        config.CHANNEL_ID = str(CHANNEL_ID)
+        config.CRYPTO_PAY_TOKEN = 'benchmark'
+        config.CRYPTO_PAY_API_URL = self.crypto.url
+        config.USE_WEBHOOK = False
+        config.STORAGE_BACKEND = 'memory'
+        config.METRICS_PORT = 0
+        config.TELEGRAM_GLOBAL_RATE = self.args.global_rate
+
+        import bot as app
+
+        app.bot.server = TelegramAPIServer.from_base(self.api.url)
+        # Замер - первым, чтобы время апдейта включало все middleware; дальше
+        # те же middleware, что и при обычном запуске bot.py
+        app.dp.middleware.setup(self.recorder)
+        app.setup_middlewares()
+        self.app = app
+
+    async def seed(self, users=(), subscriptions=()):
+        """Заполняет базу до запуска бота (планировщик и кэши читают её в on_startup)"""
+        import db
+        pool = await db.create_pool()
+        await db.init_db(pool)
+        async with pool.write() as conn:
+            await conn.executemany(
+                'INSERT INTO users (user_id, first_name) VALUES (?, ?)',
+                ((user_id, f'User{user_id}') for user_id in users)
+            )
+            await conn.executemany('''
+                INSERT INTO subscriptions (user_id, start_date, end_date, subscription_type, payment_method, amount)
+                VALUES (?, ?, ?, 'month', 'tg_stars', 1000)
+            ''', subscriptions)
+        await pool.close()
+
+    async def start_bot(self):
+        await self.app.on_startup(self.app.dp)
+        self._polling = asyncio.create_task(
+            self.app.dp.start_polling(timeout=1, relax=0, reset_webhook=False)
+        )
+
+    async def stop_bot(self):
+        dp = self.app.dp
+        dp.stop_polling()
+        await dp.wait_closed()
+        await asyncio.gather(self._polling, return_exceptions=True)
+        await self.app.on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await self.app.bot.get_session()
+        await session.close()
+        await self.api.stop()
+        await self.crypto.stop()
+
+    async def query(self, sql: str, *params):
+        async with self.app.dp["db_pool"].read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def wait_until(self, predicate, what: str):
+        deadline = time.monotonic() + self.args.deadline
+        while not await predicate():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for {what}")
+            await asyncio.sleep(0.05)
+
+    async def wait_processed(self, count: int):
+        async def done():
+            return self.recorder.processed >= count
+        await self.wait_until(done, f"{count} updates")
+
+    def report(self, name: str, operations: int, elapsed: float, **extra) -> dict:
+        handler = self.recorder.handler
+        end_to_end = self.recorder.end_to_end
+        return dict({
+            'scenario': name,
+            'operations': operations,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(operations / elapsed, 1) if elapsed else 0.0,
+            'handler_p50_ms': round(percentile(handler, 0.5) * 1000, 2),
+            'handler_p99_ms': round(percentile(handler, 0.99) * 1000, 2),
+            'update_p50_ms': round(percentile(end_to_end, 0.5) * 1000, 2),
+            'update_p99_ms': round(percentile(end_to_end, 0.99) * 1000, 2),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'api_calls': sum(self.api.calls.values()) - self.api.calls['getUpdates'],
+            'api_throttled': self.api.throttled,
+        }, **extra)
+
+
+@scenario
+async def start_flood(h: Harness) -> dict:
+    users = h.args.users
+    await h.start_bot()
+    started = time.perf_counter()
+    for i in range(users):
+        h.api.push_update('message', _message(FIRST_USER_ID + i, '/start'))
+    await h.wait_processed(users)
+    elapsed = time.perf_counter() - started
+    await h.stop_bot()
+    return h.report('start_flood', users, elapsed)
+
+
+@scenario
+async def payment_burst(h: Harness) -> dict:
+    payments = h.args.payments
+    await h.start_bot()
+    started = time.perf_counter()
+    for i in range(payments):
+        user_id = FIRST_USER_ID + i
+        if i % 2:
+            h.api.push_update('callback_query', _callback(user_id, 'crypto_pay:TON:month'))
+        else:
+            h.api.push_update('message', _message(user_id, successful_payment={
+                'currency': 'RUB',
+                'total_amount': 100000,
+                'invoice_payload': 'channel_subscription_month',
+                'telegram_payment_charge_id': f'charge-{user_id}',
+                'provider_payment_charge_id': f'provider-{user_id}',
+            }))
+    await h.wait_processed(payments)
+    handled = time.perf_counter() - started
+
+    # Крипто-оплаты выдаются фоновой сверкой инвойсов
+    async def granted():
+        return await h.query('SELECT COUNT(*) FROM subscriptions') >= payments
+    await h.wait_until(granted, f"{payments} subscriptions")
+    elapsed = time.perf_counter() - started
+    await h.stop_bot()
+    return h.report('payment_burst', payments, elapsed, updates_handled_s=round(handled, 3),
+                    invoices_created=h.crypto.calls['createInvoice'])
+
+
+@scenario
+async def broadcast(h: Harness) -> dict:
+    users = h.args.broadcast_users
+    await h.seed(users=range(FIRST_USER_ID, FIRST_USER_ID + users))
+    await h.start_bot()
+    h.api.push_update('callback_query', _callback(ADMIN_ID, 'create_broadcast'))
+    await h.wait_processed(1)
+    started = time.perf_counter()
+    h.api.push_update('message', _message(ADMIN_ID, 'Benchmark broadcast'))
+    await h.wait_processed(2)
+
+    # Пока идёт рассылка, пользователи продолжают писать боту
+    background = 0
+
+    async def finished():
+        nonlocal background
+        if h.args.background_rate:
+            due = int((time.perf_counter() - started) * h.args.background_rate)
+            while background < due:
+                h.api.push_update('message', _message(FIRST_USER_ID + users + background, '/start'))
+                background += 1
+        return await h.query("SELECT COUNT(*) FROM broadcasts WHERE status = 'done'") > 0
+    await h.wait_until(finished, "broadcast to finish")
+    elapsed = time.perf_counter() - started
+    await h.wait_processed(2 + background)
+    await h.stop_bot()
+    return h.report('broadcast', h.api.calls['copyMessage'], elapsed, background_updates=background)
+
+
+@scenario
+async def expiry_run(h: Harness) -> dict:
+    count = h.args.expiring
+    now = int(time.time())
+    # Поровну подписок на этапах 'expired', 'day' и 'week'
+    offsets = (-60, DAY // 2, 3 * DAY)
+    await h.seed(subscriptions=[
+        (FIRST_USER_ID + i, now - 30 * DAY, now + offsets[i % 3]) for i in range(count)
+    ])
+
+    samples = h.recorder.handler
+    process_expiry = h.app.process_expiry
+
+    async def timed_expiry(*args):
+        started = time.perf_counter()
+        try:
+            return await process_expiry(*args)
+        finally:
+            samples.append(time.perf_counter() - started)
+    # on_startup передаёт планировщику process_expiry из модуля bot
+    h.app.process_expiry = timed_expiry
+
+    started = time.perf_counter()
+    await h.start_bot()
+
+    async def done():
+        return await h.query('SELECT COUNT(*) FROM expiry_notifications') >= count
+    await h.wait_until(done, f"{count} expiry notifications")
+    elapsed = time.perf_counter() - started
+    await h.stop_bot()
+    return h.report('expiry_run', count, elapsed, bans=h.api.calls['banChatMember'])
+
+
+async def run_scenario(args) -> dict:
+    harness = Harness(args)
+    await harness.prepare()
+    return await SCENARIOS[args.scenarios[0]](harness)
+
+
+def run_isolated(args, argv: list) -> list:
+    """Запускает каждый сценарий в отдельном процессе"""
+    results = []
+    for name in args.scenarios:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), name, '--json'] + argv,
+            check=True, stdout=subprocess.PIPE, text=True
+        ).stdout
+        results.extend(json.loads(output))
+    return results
+
+
+def print_table(results: list):
+    columns = ('scenario', 'operations', 'elapsed_s', 'throughput_per_s', 'handler_p50_ms',
+               'handler_p99_ms', 'update_p50_ms', 'update_p99_ms', 'peak_rss_mb', 'api_throttled')
+    widths = [max(len(column), *(len(str(row.get(column, ''))) for row in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in results:
+        print('  '.join(str(row.get(column, '')).ljust(width) for column, width in zip(columns, widths)))
+
+
+def parse_args(argv: list):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушках Bot API и Crypto Pay")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"сценарии: {', '.join(SCENARIOS)} (по умолчанию все)")
+    parser.add_argument('--users', type=int, default=5000, help="сколько /start в start_flood")
+    parser.add_argument('--payments', type=int, default=1000, help="сколько оплат в payment_burst")
+    parser.add_argument('--broadcast-users', type=int, default=100000, help="получателей рассылки")
+    parser.add_argument('--background-rate', type=float, default=20,
+                        help="/start в секунду во время рассылки")
+    parser.add_argument('--expiring', type=int, default=10000, help="подписок в expiry_run")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа заглушек, секунды")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="доля запросов, получающих 429")
+    parser.add_argument('--pay-after', type=float, default=0.0,
+                        help="через сколько секунд крипто-инвойс становится оплаченным")
+    parser.add_argument('--global-rate', type=float, default=100000,
+                        help="TELEGRAM_GLOBAL_RATE для теста (в проде около 25)")
+    parser.add_argument('--deadline', type=float, default=600, help="максимум секунд на сценарий")
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    args = parser.parse_args(argv)
+    # choices для nargs='*' не подходит: argparse сверяет с ними и пустой список по умолчанию
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+def main():
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(args.scenarios) == 1:
+        with tempfile.TemporaryDirectory() as workdir:
+            # bot_database.db создаётся в текущем каталоге
+            os.chdir(workdir)
+            # Хендлеры печатают ошибки в stdout - он нужен для результатов
+            with contextlib.redirect_stdout(sys.stderr):
+                results = [asyncio.run(run_scenario(args))]
+    else:
+        options = [arg for arg in argv if arg not in SCENARIOS and arg != '--json']
+        results = run_isolated(args, options)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,38 +3,58 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from config import (
-    BOT_TOKEN, CHANNEL_ID, ADMIN_ID, DB_URL,
-    SUBSCRIPTION_SETTINGS, PAYMENT_METHODS
+    BOT_TOKEN, CHANNEL_ID, ADMIN_ID,
+    SUBSCRIPTION_SETTINGS, PAYMENT_METHODS,
+    USE_WEBHOOK, WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_SECRET,
+    CRYPTO_PAY_WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, STORAGE_BACKEND, METRICS_ENABLED, METRICS_PORT,
+    TELEGRAM_GLOBAL_RATE, SHARD_WORKERS
 )
-from keyboards import get_payment_keyboard, get_admin_keyboard, get_admin_main_keyboard, get_crypto_payment_keyboard, get_crypto_currency_keyboard, get_payment_method_keyboard
+from keyboards import get_payment_keyboard, get_admin_keyboard, get_admin_main_keyboard, get_crypto_payment_keyboard, get_crypto_currency_keyboard, get_payment_method_keyboard, get_subscriptions_keyboard, iter_callback_data
 from db import (
-    create_pool, init_db, add_subscription, check_expired_subscriptions,
-    add_user, get_all_users, get_expiring_subscriptions, get_user_subscriptions
+    create_pool, init_db, add_subscription,
+    add_user, TRANSFER_COLUMNS
 )
 from crypto_pay import CryptoPayAPI
-from aiogram.types import LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton
-import asyncio
-import aioschedule
-from aiogram.dispatcher.handler import CancelHandler
-from aiogram.dispatcher.middlewares import BaseMiddleware
-from collections import defaultdict
-import time
+from expiry import ExpiryScheduler
+from invoices import InvoiceReconciler
+from rates import ExchangeRates, RatesUnavailable
+from webhooks import SecretWebhookRequestHandler, crypto_pay_webhook
+from antiflood import AntiFloodMiddleware
+from storage import create_store, KVStorage
+from callbacks import CallbackRouter
+from subscriptions import SubscriptionCache
+from access import JoinRequestProcessor
+from aiogram.utils.executor import Executor
+from aiohttp import web
+from broadcast import Broadcaster, UNREACHABLE_ERRORS
+from transfer import DataTransfer, FORMATS
+from ratelimit import TelegramRateLimiter
+from outbound import OutboundQueue
+from metrics import MetricsMiddleware, start_metrics_server, watch_outbound, watch_subscription_cache, watch_logging
+from logs import LoggingMiddleware, setup_logging, stop_logging, get_queue_handler
+from sharding import Supervisor, ShardLink, run_worker
+from aiogram.types import LabeledPrice
 import re
+from functools import partial
+from datetime import datetime
 from typing import Optional
 import logging
 import sys
-from logging.handlers import RotatingFileHandler
 
-# ID бота @CryptoBot для проверки вебхуков
-CRYPTO_BOT_ID = 1559501630
+logger = logging.getLogger('bot_logger')
 
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Общее хранилище для FSM и антифлуда; при STORAGE_BACKEND = 'memory' всё живёт в процессе
+kv_store = create_store(STORAGE_BACKEND)
+storage = KVStorage(kv_store) if kv_store else MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
-# Создаем пул соединений с базой данных
-pool = None
+# Все нажатия кнопок проходят через один обработчик и разбираются по действию
+callback_router = CallbackRouter()
+dp.register_callback_query_handler(callback_router.dispatch)
+
 crypto_pay = CryptoPayAPI()
+rates = ExchangeRates(crypto_pay)
 
 class PaymentStates(StatesGroup):
     waiting_for_payment = State()
@@ -45,6 +65,9 @@ class PaymentStates(StatesGroup):
 class BroadcastStates(StatesGroup):
     waiting_for_message = State()
 
+class TransferStates(StatesGroup):
+    waiting_for_file = State()
+
 def get_price(duration: str) -> float:
     return SUBSCRIPTION_SETTINGS[duration]['price']
 
@@ -55,52 +78,6 @@ def get_price_label(duration: str) -> LabeledPrice:
         amount=settings['price']
     )
 
-# Добавляем класс антиспам middleware
-class AntiFloodMiddleware(BaseMiddleware):
-    def __init__(self, limit=3, interval=1):
-        self.limit = limit  # Максимальное количество сообщений
-        self.interval = interval  # Интервал в секундах
-        self.user_timeouts = defaultdict(list)  # Хранение времени сообщений пользователей
-        self.banned_users = set()  # Множество забаненных пользователей
-        super(AntiFloodMiddleware, self).__init__()
-
-    async def on_pre_process_message(self, message: types.Message, data: dict):
-        # Пропускаем сообщения от админа
-        if str(message.from_user.id) == ADMIN_ID:
-            return
-        
-        # Проверяем, не забанен ли пользователь
-        if message.from_user.id in self.banned_users:
-            await message.answer("Вы временно заблокированы за спам.")
-            raise CancelHandler()
-        
-        # Получаем текущее время
-        curr_time = time.time()
-        user_id = message.from_user.id
-        
-        # Очищаем старые записи
-        self.user_timeouts[user_id] = [t for t in self.user_timeouts[user_id] 
-                                     if curr_time - t < self.interval]
-        
-        # Добавляем новое время
-        self.user_timeouts[user_id].append(curr_time)
-        
-        # Проверяем количество сообщений
-        if len(self.user_timeouts[user_id]) > self.limit:
-            self.banned_users.add(user_id)
-            await message.answer(
-                "Вы отправляете сообщения слишком часто. "
-                "Вы заблокированы на 5 минут."
-            )
-            # Планируем разбан через 5 минут
-            asyncio.create_task(self.unban_user(user_id))
-            raise CancelHandler()
-
-    async def unban_user(self, user_id: int):
-        await asyncio.sleep(300)  # 5 минут
-        self.banned_users.discard(user_id)
-        self.user_timeouts[user_id].clear()
-
 # Добавляем функции валидации
 def sanitize_input(text: str) -> Optional[str]:
     """Очищает входной текст от потенциально опасных символов"""
@@ -124,7 +101,7 @@ async def start_handler(message: types.Message):
         await message.answer("Ошибка валидации.")
         return
     
-    global pool
+    pool = dp["db_pool"]
     try:
         await add_user(pool, message.from_user)
         await message.answer(
@@ -132,12 +109,11 @@ async def start_handler(message: types.Message):
             reply_markup=get_payment_keyboard()
         )
     except Exception as e:
-        print(f"Error in start_handler: {e}")
+        logger.error(f"Error in start_handler: {e}", exc_info=True)
         await message.answer("Произошла ошибка. Попробуйте позже.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith('duration_'))
-async def process_duration_selection(callback_query: types.CallbackQuery, state: FSMContext):
-    duration = callback_query.data.split('_')[1]
+@callback_router.handler('duration')
+async def process_duration_selection(callback_query: types.CallbackQuery, state: FSMContext, duration: str):
     await state.update_data(duration=duration)
     price = get_price(duration)
     
@@ -148,10 +124,9 @@ async def process_duration_selection(callback_query: types.CallbackQuery, state:
         reply_markup=get_payment_method_keyboard(duration)
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('tg_stars_'))
-async def process_tg_stars(callback_query: types.CallbackQuery):
+@callback_router.handler('tg_stars')
+async def process_tg_stars(callback_query: types.CallbackQuery, state: FSMContext, duration: str):
     await bot.answer_callback_query(callback_query.id)
-    duration = callback_query.data.split('_')[2]  # tg_stars_month/year/forever
     
     price = get_price_label(duration)
     
@@ -167,23 +142,35 @@ async def process_tg_stars(callback_query: types.CallbackQuery):
         protect_content=True
     )
 
+@dp.chat_join_request_handler()
+async def process_join_request(join_request: types.ChatJoinRequest):
+    if str(join_request.chat.id) != str(CHANNEL_ID):
+        return
+    # Решение и ответ Telegram - в фоне, пачками
+    dp["join_requests"].submit(join_request.from_user.id)
+
 @dp.pre_checkout_query_handler()
 async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery):
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 @dp.message_handler(content_types=types.ContentType.SUCCESSFUL_PAYMENT)
 async def process_successful_payment(message: types.Message):
-    global pool
+    pool = dp["db_pool"]
     duration = message.successful_payment.invoice_payload.split('_')[2]
-    await add_subscription(
+    granted = await add_subscription(
         pool,
         message.from_user.id,
         duration,
         'tg_stars',
-        float(message.successful_payment.total_amount) / 100
+        float(message.successful_payment.total_amount) / 100,
+        external_id=message.successful_payment.telegram_payment_charge_id
     )
+    if not granted:
+        # Telegram повторно доставил уже проведённый платёж
+        return
     
-    await bot.approve_chat_join_request(CHANNEL_ID, message.from_user.id)
+    # Одобряем заявку на вступление, если пользователь уже её подал
+    dp["join_requests"].submit(message.from_user.id)
     
     duration_text = {
         'month': 'месяц',
@@ -191,14 +178,14 @@ async def process_successful_payment(message: types.Message):
         'forever': 'неограниченный срок'
     }
     
-    await bot.send_message(
+    await dp["outbound"].send_message(
+        'payment',
         message.from_user.id,
         f"Спасибо за оплату! Доступ к каналу открыт на {duration_text[duration]}."
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('p2p_'))
-async def process_p2p(callback_query: types.CallbackQuery, state: FSMContext):
-    duration = callback_query.data.split('_')[1]
+@callback_router.handler('p2p')
+async def process_p2p(callback_query: types.CallbackQuery, state: FSMContext, duration: str):
     price = get_price(duration)
     await state.update_data(duration=duration, amount=price)
     await bot.answer_callback_query(callback_query.id)
@@ -216,10 +203,10 @@ async def process_p2p(callback_query: types.CallbackQuery, state: FSMContext):
         reply_markup=get_admin_keyboard(callback_query.from_user.id)
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('confirm_'))
-async def confirm_payment(callback_query: types.CallbackQuery, state: FSMContext):
+@callback_router.handler('confirm')
+async def confirm_payment(callback_query: types.CallbackQuery, state: FSMContext, user_id: str):
     try:
-        user_id = int(callback_query.data.split('_')[1])
+        user_id = int(user_id)
         if not validate_user_id(user_id):
             await bot.answer_callback_query(
                 callback_query.id,
@@ -227,7 +214,8 @@ async def confirm_payment(callback_query: types.CallbackQuery, state: FSMContext
             )
             return
         
-        # Получаем данные из состояния
+        # Сумму сохранял пользователь в своём состоянии, а кнопку нажимает админ
+        state = dp.current_state(chat=user_id, user=user_id)
         data = await state.get_data()
         amount = data.get('amount', 0)
         
@@ -246,16 +234,21 @@ async def confirm_payment(callback_query: types.CallbackQuery, state: FSMContext
         else:
             duration = 'month'
         
-        await add_subscription(
-            pool,
+        # Ключ платежа - сообщение админа с кнопкой: повторное нажатие ничего не продлит
+        granted = await add_subscription(
+            dp["db_pool"],
             user_id,
             duration,
             'p2p',
-            amount
+            amount,
+            external_id=f"{callback_query.message.chat.id}:{callback_query.message.message_id}"
         )
+        if not granted:
+            await bot.answer_callback_query(callback_query.id, "Эта оплата уже подтверждена.")
+            return
         
         # Добавляем пользователя в канал
-        await bot.approve_chat_join_request(CHANNEL_ID, user_id)
+        dp["join_requests"].submit(user_id)
         
         duration_text = {
             'month': 'месяц',
@@ -263,7 +256,8 @@ async def confirm_payment(callback_query: types.CallbackQuery, state: FSMContext
             'forever': 'неограниченный срок'
         }
         
-        await bot.send_message(
+        await dp["outbound"].send_message(
+            'payment',
             user_id,
             f"Ваша оплата подтверждена! Доступ к каналу открыт на {duration_text[duration]}."
         )
@@ -272,7 +266,7 @@ async def confirm_payment(callback_query: types.CallbackQuery, state: FSMContext
         # Очищаем состояние
         await state.finish()
     except Exception as e:
-        print(f"Error in confirm_payment: {e}")
+        logger.error(f"Error in confirm_payment: {e}", exc_info=True)
         await bot.answer_callback_query(
             callback_query.id,
             "Произошла ошибка. Попробуйте позже."
@@ -286,8 +280,8 @@ async def admin_panel(message: types.Message):
             reply_markup=get_admin_main_keyboard()
         )
 
-@dp.callback_query_handler(lambda c: c.data == 'create_broadcast')
-async def create_broadcast(callback_query: types.CallbackQuery):
+@callback_router.handler('create_broadcast')
+async def create_broadcast(callback_query: types.CallbackQuery, state: FSMContext):
     if str(callback_query.from_user.id) == ADMIN_ID:
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(
@@ -301,163 +295,238 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
     if str(message.from_user.id) != ADMIN_ID:
         return
     
-    global pool
-    users = await get_all_users(pool)
-    
-    sent = 0
-    failed = 0
-    
-    await message.answer("Начинаю рассылку...")
-    
-    for user_id in users:
-        try:
-            if message.content_type == 'text':
-                await bot.send_message(user_id, message.text)
-            elif message.content_type == 'photo':
-                await bot.send_photo(
-                    user_id,
-                    message.photo[-1].file_id,
-                    caption=message.caption
-                )
-            elif message.content_type == 'video':
-                await bot.send_video(
-                    user_id,
-                    message.video.file_id,
-                    caption=message.caption
-                )
-            sent += 1
-            await asyncio.sleep(0.05)  # Небольшая задержка между отправками
-        except Exception as e:
-            failed += 1
-            print(f"Failed to send message to {user_id}: {e}")
-    
-    await message.answer(
-        f"Рассылка завершена!\n"
-        f"Успешно отправлено: {sent}\n"
-        f"Ошибок: {failed}"
-    )
+    # Рассылка идёт в фоне, прогресс приходит одним обновляемым сообщением
+    await dp["broadcaster"].start(message)
     await state.finish()
 
-async def check_subscriptions():
-    global pool
-    # Проверяем подписки, истекающие через неделю
-    week_expiring = await get_expiring_subscriptions(pool, 7)
-    for user_id, end_date in week_expiring:
-        try:
-            await bot.send_message(
-                user_id,
-                f"⚠️ Ваша подписка истекает через неделю - {end_date.strftime('%d.%m.%Y')}.\n"
-                "Не забудьте продлить подписку, чтобы сохранить доступ к каналу!"
-            )
-        except Exception as e:
-            print(f"Error sending week notification to user {user_id}: {e}")
-    
-    # Проверяем подписки, истекающие через сутки
-    day_expiring = await get_expiring_subscriptions(pool, 1)
-    for user_id, end_date in day_expiring:
-        try:
-            await bot.send_message(
-                user_id,
-                f"⚠️ Ваша подписка истекает через 24 часа - {end_date.strftime('%d.%m.%Y')}.\n"
-                "Продлите подписку сейчас, чтобы не потерять доступ к каналу!",
-                reply_markup=get_payment_keyboard()
-            )
-        except Exception as e:
-            print(f"Error sending day notification to user {user_id}: {e}")
-    
-    # Проверяем истекшие подписки
-    expired_users = await check_expired_subscriptions(pool)
-    for user_id in expired_users:
-        try:
-            await bot.ban_chat_member(
-                chat_id=CHANNEL_ID,
-                user_id=user_id,
-                until_date=0
-            )
-            await bot.send_message(
-                user_id,
-                "❌ Ваша подписка истекла. Для восстановления доступа оформите новую подписку.",
-                reply_markup=get_payment_keyboard()
-            )
-        except Exception as e:
-            print(f"Error removing user {user_id}: {e}")
-
-async def scheduler():
-    # Проверяем подписки каждый час
-    aioschedule.every().hour.at(":00").do(check_subscriptions)
-    while True:
-        await aioschedule.run_pending()
-        await asyncio.sleep(3600)  # проверка каждый час
-
-# Настройка логирования
-def setup_logging():
-    # Создаем логгер
-    logger = logging.getLogger('bot_logger')
-    logger.setLevel(logging.DEBUG)
-    
-    # Создаем обработчик для записи в файл
-    file_handler = RotatingFileHandler(
-        'bot.log',
-        maxBytes=1024*1024,  # 1MB
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setLevel(logging.DEBUG)
+@dp.message_handler(commands=['export'])
+async def export_command(message: types.Message):
+    if str(message.from_user.id) != ADMIN_ID:
+        return
     
-    # Создаем обработчик для вывода в консоль
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
+    args = message.get_args().split()
+    table = args[0] if args else None
+    fmt = args[1] if len(args) > 1 else 'csv'
+    if table not in TRANSFER_COLUMNS or fmt not in FORMATS:
+        await message.answer(
+            f"Использование: /export <таблица> [формат]\n"
+            f"Таблицы: {', '.join(TRANSFER_COLUMNS)}\n"
+            f"Форматы: {', '.join(FORMATS)} (по умолчанию csv)"
+        )
+        return
+    # Выгрузка идёт в фоне, файл придёт документом
+    await dp["transfer"].export(message, table, fmt)
+
+@dp.message_handler(commands=['import'])
+async def import_command(message: types.Message):
+    if str(message.from_user.id) != ADMIN_ID:
+        return
     
-    # Создаем форматтер
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    await message.answer(
+        "Отправьте файл выгрузки. Имя файла начинается с названия таблицы "
+        f"({', '.join(TRANSFER_COLUMNS)}), формат - {' или '.join(FORMATS)}, можно сжать в .gz.\n"
+        "Существующие пользователи и подписки будут обновлены, уже записанные платежи пропущены."
     )
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-    
-    # Добавляем обработчики к логгеру
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    await TransferStates.waiting_for_file.set()
+
+@dp.message_handler(state=TransferStates.waiting_for_file, content_types=types.ContentTypes.DOCUMENT)
+async def process_import_file(message: types.Message, state: FSMContext):
+    if str(message.from_user.id) != ADMIN_ID:
+        return
     
-    return logger
+    await dp["transfer"].import_document(message)
+    await state.finish()
+
+def expire_access(user_id: int, end_date: int):
+    """Убирает закончившуюся подписку из кэшей процесса"""
+    dp["subscriptions"].expire(user_id, end_date)
+
+async def process_expiry(user_id: int, stage: str, end_date: int) -> str:
+    outbound = dp["outbound"]
+    end_date_text = datetime.fromtimestamp(end_date).strftime('%d.%m.%Y')
+    reply_markup = get_payment_keyboard()
+    if stage == 'week':
+        text = (
+            f"⚠️ Ваша подписка истекает через неделю - {end_date_text}.\n"
+            "Не забудьте продлить подписку, чтобы сохранить доступ к каналу!"
+        )
+        reply_markup = None
+    elif stage == 'day':
+        text = (
+            f"⚠️ Ваша подписка истекает через 24 часа - {end_date_text}.\n"
+            "Продлите подписку сейчас, чтобы не потерять доступ к каналу!"
+        )
+    else:
+        expire_access(user_id, end_date)
+        shard = dp.get("shard")
+        if shard:
+            shard.publish('expired', user_id, end_date)
+        # Исключаем из канала: бан и сразу разбан, чтобы после оплаты можно было вернуться.
+        # При повторе этапа это безопасно - исключение из канала идемпотентно.
+        await outbound.call('expiry', None, bot.ban_chat_member, chat_id=CHANNEL_ID, user_id=user_id, until_date=0)
+        await outbound.call('expiry', None, bot.unban_chat_member,
+                            chat_id=CHANNEL_ID, user_id=user_id, only_if_banned=True)
+        text = "❌ Ваша подписка истекла. Для восстановления доступа оформите новую подписку."
+
+    try:
+        await outbound.send_message('expiry', user_id, text, reply_markup=reply_markup)
+    except UNREACHABLE_ERRORS:
+        return 'banned' if stage == 'expired' else 'unreachable'
+    return 'banned' if stage == 'expired' else 'notified'
 
 # Модифицируем функцию on_startup
 async def on_startup(dispatcher: Dispatcher):
-    global pool
     logger = logging.getLogger('bot_logger')
+    # При запуске в несколько процессов - номер этого процесса-обработчика
+    shard = dispatcher.get("shard")
+    primary = shard is None or shard.primary
     try:
         logger.info("Starting bot...")
         
-        # Получаем путь к базе данных
+        # Каждая кнопка из keyboards.py должна вести ровно в один обработчик
+        callback_router.validate(iter_callback_data())
+        
+        # Открываем постоянные соединения с базой данных
         pool = await create_pool()
-        logger.info("Database path initialized")
+        logger.info("Database connections opened")
         
-        # Инициализируем базу данных
-        await init_db()
+        # Применяем миграции базы данных
+        await init_db(pool)
         logger.info("Database initialized successfully")
         
+        if kv_store:
+            await kv_store.open(pool)
+            logger.info(f"Shared storage opened: {STORAGE_BACKEND}")
+        
         # Устанавливаем команды бота
-        await bot.set_my_commands([
-            types.BotCommand("start", "Начать работу с ботом"),
-            types.BotCommand("subscriptions", "Мои подписки"),
-            types.BotCommand("admin", "Панель администратора")
-        ])
-        logger.info("Bot commands set successfully")
+        if primary:
+            await bot.set_my_commands([
+                types.BotCommand("start", "Начать работу с ботом"),
+                types.BotCommand("subscriptions", "Мои подписки"),
+                types.BotCommand("admin", "Панель администратора")
+            ])
+            logger.info("Bot commands set successfully")
+        
+        if USE_WEBHOOK and shard is None:
+            # Вместо skip_updates просим Telegram сбросить накопившиеся обновления
+            await bot.set_webhook(
+                WEBHOOK_HOST + WEBHOOK_PATH,
+                drop_pending_updates=True,
+                secret_token=WEBHOOK_SECRET or None
+            )
+            logger.info("Webhook set successfully")
         
         # Сохраняем пул в диспетчере бота для доступа из хендлеров
         dispatcher["db_pool"] = pool
         
-        # Запускаем планировщик
-        asyncio.create_task(scheduler())
-        logger.info("Scheduler started successfully")
+        # Кэш подписок обновляется при каждой записи подписки; действующие
+        # подписчики из него - для мгновенного ответа на заявки в канал
+        subscriptions = SubscriptionCache(pool)
+        await subscriptions.load()
+        pool.add_subscription_listener(subscriptions.update)
+        dispatcher["subscriptions"] = subscriptions
+        logger.info(f"Loaded {len(subscriptions.active)} active subscribers")
+        
+        if shard:
+            # Подписки, выданные и закончившиеся в других процессах, приходят через супервизор
+            pool.add_subscription_listener(partial(shard.publish, 'subscription'))
+            shard.on('subscription', pool.notify_subscription)
+            shard.on('expired', expire_access)
+        
+        # Общая очередь исходящих запросов к Bot API с приоритетами и лимитами;
+        # общий лимит Telegram делится между процессами поровну
+        limiter = TelegramRateLimiter(global_rate=TELEGRAM_GLOBAL_RATE / (shard.count if shard else 1))
+        dispatcher["limiter"] = limiter
+        outbound = OutboundQueue(bot, limiter)
+        outbound.start()
+        dispatcher["outbound"] = outbound
+        
+        # Запускаем планировщик окончания подписок (фоновые задачи - только в одном процессе)
+        if primary:
+            expiry = ExpiryScheduler(pool, process_expiry)
+            await expiry.load()
+            pool.add_subscription_listener(expiry.schedule)
+            expiry.start()
+            dispatcher["expiry"] = expiry
+            logger.info("Scheduler started successfully")
+        
+        # Открываем общую HTTP-сессию Crypto Pay и запускаем сверку инвойсов;
+        # инвойсы ставят на учёт все процессы, а опрашивает их один
+        await crypto_pay.open()
+        rates.start()
+        invoices = InvoiceReconciler(pool, crypto_pay, process_crypto_invoice_paid)
+        if primary:
+            invoices.start()
+        dispatcher["invoices"] = invoices
+        
+        # Рассылка и заявки на вступление
+        join_requests = JoinRequestProcessor(bot, CHANNEL_ID, subscriptions, outbound)
+        join_requests.start()
+        dispatcher["join_requests"] = join_requests
+        # Каждый процесс продолжает только свои рассылки: перезапущенный обработчик
+        # не должен подхватить рассылку, которую ещё шлёт другой
+        broadcaster = Broadcaster(
+            bot, pool, outbound, shard=shard.index if shard else 0, shards=shard.count if shard else 1
+        )
+        await broadcaster.resume_unfinished()
+        dispatcher["broadcaster"] = broadcaster
+        dispatcher["transfer"] = DataTransfer(bot, pool, outbound)
+        
+        # Метрики отдаются на отдельном локальном порту в обоих режимах запуска
+        if METRICS_ENABLED:
+            watch_outbound(outbound)
+            watch_subscription_cache(subscriptions)
+            if get_queue_handler() is not None:
+                watch_logging(get_queue_handler())
+            dispatcher["metrics_server"] = await start_metrics_server(port=METRICS_PORT + (shard.index if shard else 0))
+            logger.info("Metrics server started")
         
     except Exception as e:
         logger.error(f"Error in on_startup: {e}", exc_info=True)
         raise
 
-@dp.callback_query_handler(lambda c: c.data.startswith('crypto_'))
-async def process_crypto_payment(callback_query: types.CallbackQuery, state: FSMContext):
-    duration = callback_query.data.split('_')[1]
+async def on_shutdown(dispatcher: Dispatcher):
+    logger = logging.getLogger('bot_logger')
+    metrics_server = dispatcher.get("metrics_server")
+    if metrics_server:
+        await metrics_server.cleanup()
+    expiry = dispatcher.get("expiry")
+    if expiry:
+        await expiry.stop()
+    broadcaster = dispatcher.get("broadcaster")
+    if broadcaster:
+        await broadcaster.stop()
+    transfer = dispatcher.get("transfer")
+    if transfer:
+        await transfer.stop()
+    invoices = dispatcher.get("invoices")
+    if invoices:
+        await invoices.stop()
+    join_requests = dispatcher.get("join_requests")
+    if join_requests:
+        await join_requests.stop()
+    outbound = dispatcher.get("outbound")
+    if outbound:
+        # Останавливаем последней из тех, кто через неё отправляет
+        logger.info(f"Outbound queue stats: {outbound.stats()}")
+        await outbound.stop()
+    await rates.stop()
+    await crypto_pay.close()
+    # Executor закрывает storage уже после on_shutdown, а SQLiteStore нужен пул,
+    # поэтому сбрасываем хранилище сами до закрытия базы
+    if kv_store:
+        await kv_store.close()
+    subscriptions = dispatcher.get("subscriptions")
+    if subscriptions:
+        logger.info(f"Subscription cache stats: {subscriptions.stats()}")
+    # Закрываем соединения с базой данных
+    pool = dispatcher.get("db_pool")
+    if pool:
+        await pool.close()
+        logger.info("Database connections closed")
+
+@callback_router.handler('crypto')
+async def process_crypto_payment(callback_query: types.CallbackQuery, state: FSMContext, duration: str):
     await state.update_data(duration=duration)
     await bot.answer_callback_query(callback_query.id)
     
@@ -468,84 +537,75 @@ async def process_crypto_payment(callback_query: types.CallbackQuery, state: FSM
         reply_markup=get_crypto_currency_keyboard(duration)
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('crypto_pay_'))
-async def process_crypto_currency_selected(callback_query: types.CallbackQuery, state: FSMContext):
-    _, _, asset, duration = callback_query.data.split('_')
+@callback_router.handler('crypto_pay')
+async def process_crypto_currency_selected(callback_query: types.CallbackQuery, state: FSMContext,
+                                           asset: str, duration: str):
     price = get_price(duration)
     
     await state.update_data(crypto_asset=asset, amount=price)
     await bot.answer_callback_query(callback_query.id)
 
+    # Пересчитываем цену в рублях по кэшированному курсу
+    try:
+        crypto_amount = await rates.convert(price, asset)
+    except RatesUnavailable as e:
+        logger.warning(f"Error converting price to {asset}: {e}")
+        await callback_query.message.answer(
+            f"Не удалось получить курс {asset}. Попробуйте позже или выберите другую валюту."
+        )
+        return
+
     # Создаем инвойс
     invoice = await crypto_pay.create_invoice(
-        amount=price,
+        amount=crypto_amount,
         asset=asset,
         description=f"Подписка на канал на {duration} ({asset})"
     )
 
     if invoice.get('ok'):
         invoice_data = invoice['result']
+        # Ставим инвойс на отслеживание: доступ выдаст фоновая сверка
+        await dp["invoices"].track(invoice_data, callback_query.from_user.id, duration, price)
         await callback_query.message.answer(
-            f"Оплатите {price} {asset} по ссылке:\n"
+            f"Оплатите {crypto_amount} {asset} ({price}₽) по ссылке:\n"
             f"{invoice_data['bot_invoice_url']}\n\n"
             "После оплаты вы автоматически получите доступ к каналу."
         )
         
-        # Сохраняем invoice_id для проверки статуса
-        await state.update_data(invoice_id=invoice_data['invoice_id'])
-        
     else:
         await callback_query.message.answer("Произошла ошибка при создании платежа. Попробуйте позже.")
 
-@dp.message_handler(content_types=types.ContentTypes.ANY, state='*')
-async def process_crypto_webhook(message: types.Message):
-    try:
-        if message.from_user.id == CRYPTO_BOT_ID:  # ID @CryptoBot
-            data = message.get_json()
-            if data.get('status') == 'paid':
-                invoice_id = data.get('invoice_id')
-                
-                # Получаем информацию об инвойсе
-                invoice = await crypto_pay.get_invoice(invoice_id)
-                if invoice:
-                    user_id = invoice['user_id']
-                    amount = float(invoice['amount'])
-                    
-                    # Определяем длительность подписки по сумме
-                    duration = None
-                    for dur, price in SUBSCRIPTION_SETTINGS.items():
-                        if abs(price['price'] - amount) < 0.01:  # Учитываем возможную погрешность
-                            duration = dur
-                            break
-                    
-                    if duration:
-                        await add_subscription(
-                            pool,
-                            user_id,
-                            duration,
-                            'crypto',
-                            amount
-                        )
-                        
-                        await bot.approve_chat_join_request(CHANNEL_ID, user_id)
-                        
-                        duration_text = {
-                            'month': 'месяц',
-                            'year': 'год',
-                            'forever': 'неограниченный срок'
-                        }
-                        
-                        await bot.send_message(
-                            user_id,
-                            f"Оплата получена! Доступ к каналу открыт на {duration_text[duration]}."
-                        )
-    except Exception as e:
-        print(f"Error processing crypto webhook: {e}")
+async def process_crypto_invoice_paid(pending: dict, invoice: dict):
+    user_id = pending['user_id']
+    duration = pending['duration']
+    granted = await add_subscription(
+        dp["db_pool"],
+        user_id,
+        duration,
+        'crypto',
+        pending['price'],
+        external_id=pending['invoice_id']
+    )
+    if not granted:
+        return
+    
+    dp["join_requests"].submit(user_id)
+    
+    duration_text = {
+        'month': 'месяц',
+        'year': 'год',
+        'forever': 'неограниченный срок'
+    }
+    
+    await dp["outbound"].send_message(
+        'payment',
+        user_id,
+        f"Оплата получена! Доступ к каналу открыт на {duration_text[duration]}."
+    )
 
-@dp.callback_query_handler(lambda c: c.data == 'my_subscriptions')
-async def show_subscriptions(callback_query: types.CallbackQuery):
-    global pool
-    subscriptions = await get_user_subscriptions(pool, callback_query.from_user.id)
+@callback_router.handler('my_subscriptions')
+async def show_subscriptions(callback_query: types.CallbackQuery, state: FSMContext = None):
+    subscriptions = await dp["subscriptions"].get(callback_query.from_user.id)
     
     if not subscriptions:
         await callback_query.message.answer(
@@ -586,13 +646,7 @@ async def show_subscriptions(callback_query: types.CallbackQuery):
     
     # Добавляем кнопку продления, если есть активная подписка
     has_active = any(sub['status'] == 'active' for sub in subscriptions)
-    keyboard = InlineKeyboardMarkup()
-    if has_active:
-        keyboard.add(InlineKeyboardButton("🔄 Продлить подписку", callback_data="duration_month"))
-    else:
-        keyboard.add(InlineKeyboardButton("📝 Оформить подписку", callback_data="duration_month"))
-    
-    await callback_query.message.answer(message_text, reply_markup=keyboard)
+    await callback_query.message.answer(message_text, reply_markup=get_subscriptions_keyboard(has_active))
     await bot.answer_callback_query(callback_query.id)
 
 @dp.message_handler(commands=['subscriptions'])
@@ -607,6 +661,24 @@ async def subscriptions_command(message: types.Message):
     )
     await show_subscriptions(callback_query)
 
+def setup_middlewares():
+    # Первым - чтобы update_id и user_id были в записях лога остальных middleware
+    dp.middleware.setup(LoggingMiddleware())
+    # Метрики - сразу после логов, чтобы время апдейта включало антифлуд
+    if METRICS_ENABLED:
+        dp.middleware.setup(MetricsMiddleware())
+    # Регистрируем middleware для защиты от флуда
+    dp.middleware.setup(AntiFloodMiddleware(limit=3, interval=1, store=kv_store))
+
+def run_shard(index: int, count: int, port: int):
+    """Точка входа процесса-обработчика, который запускает супервизор"""
+    setup_logging(f'bot.shard{index}.log')
+    setup_middlewares()
+    try:
+        run_worker(dp, ShardLink(index, count, port), on_startup, on_shutdown)
+    finally:
+        stop_logging()
+
 # Модифицируем основной блок запуска
 if __name__ == '__main__':
     # Инициализируем логгер
@@ -614,22 +686,34 @@ if __name__ == '__main__':
     logger.info("Bot starting...")
     
     try:
-        # Регистрируем middleware для защиты от флуда
-        dp.middleware.setup(AntiFloodMiddleware(limit=3, interval=1))
-        logger.info("Middleware setup completed")
-        
-        # Запускаем бота
-        executor.start_polling(
-            dp,
-            skip_updates=True,
-            on_startup=on_startup,
-            timeout=60
-        )
+        if SHARD_WORKERS > 1:
+            # Этот процесс только принимает обновления, обрабатывают их SHARD_WORKERS процессов
+            Supervisor(run_shard).run()
+        else:
+            setup_middlewares()
+            logger.info("Middleware setup completed")
+            
+            # Запускаем бота
+            if USE_WEBHOOK:
+                # Обновления Telegram и вебхуки Crypto Pay принимает один aiohttp-сервер
+                app = web.Application()
+                app.router.add_post(CRYPTO_PAY_WEBHOOK_PATH, crypto_pay_webhook)
+                runner = Executor(dp)
+                runner.on_startup(on_startup)
+                runner.on_shutdown(on_shutdown)
+                runner.set_webhook(WEBHOOK_PATH, request_handler=SecretWebhookRequestHandler, web_app=app)
+                runner.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+            else:
+                executor.start_polling(
+                    dp,
+                    skip_updates=True,
+                    on_startup=on_startup,
+                    on_shutdown=on_shutdown,
+                    timeout=60
+                )
     except Exception as e:
         logger.critical(f"Critical error: {e}", exc_info=True)
         sys.exit(1)
     finally:
-        # Закрываем соединение с базой данных при выходе
-        if pool:
-            asyncio.get_event_loop().run_until_complete(pool.close())
-            logger.info("Database connection closed") 
\ No newline at end of file
+        # Дописываем очередь лога перед выходом
+        stop_logging()
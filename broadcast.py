@@ -0,0 +1,182 @@
+import asyncio
+import logging
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import (
+    BotBlocked, CantInitiateConversation, ChatNotFound, MessageNotModified,
+    TelegramAPIError, UserDeactivated
+)
+
+from config import BROADCAST_WORKERS, BROADCAST_BATCH_SIZE, BROADCAST_PROGRESS_INTERVAL
+from db import (
+    ConnectionPool, create_broadcast, get_unfinished_broadcasts,
+    iter_user_ids, save_broadcast_progress
+)
+from logs import start_background
+from outbound import OutboundQueue
+
+# Ошибки, после которых писать пользователю бессмысленно
+UNREACHABLE_ERRORS = (BotBlocked, UserDeactivated, ChatNotFound, CantInitiateConversation)
+
+logger = logging.getLogger('bot_logger')
+
+
+class BroadcastRun:
+    """Состояние одной рассылки; прогресс периодически сохраняется в базу"""
+
+    def __init__(self, broadcast_id: int, from_chat_id: int, message_id: int,
+                 progress_message_id: int, last_user_id: int = 0,
+                 sent: int = 0, failed: int = 0, blocked: int = 0):
+        self.broadcast_id = broadcast_id
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.progress_message_id = progress_message_id
+        # Все пользователи с user_id <= last_user_id уже обработаны
+        self.last_user_id = last_user_id
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+
+    def progress_text(self, finished: bool = False) -> str:
+        header = "Рассылка завершена!" if finished else "Идёт рассылка..."
+        return (
+            f"{header}\n"
+            f"Успешно отправлено: {self.sent}\n"
+            f"Ошибок: {self.failed}\n"
+            f"Заблокировали бота: {self.blocked}"
+        )
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения админа всем пользователям.
+
+    Пользователи читаются из базы страницами по user_id, отправка идёт
+    пулом воркеров через полосу 'broadcast' общей очереди исходящих
+    запросов, поэтому рассылка не задерживает сообщения об оплате. Прогресс сохраняется
+    в таблицу broadcasts, поэтому после перезапуска рассылка продолжается
+    с места остановки, а админ видит одно обновляемое сообщение с отчётом.
+    При запуске в несколько процессов рассылку продолжает только процесс
+    shard, который её начал: пока он жив, её никто другой не трогает.
+    """
+
+    def __init__(self, bot: Bot, pool: ConnectionPool, outbound: OutboundQueue,
+                 workers: int = BROADCAST_WORKERS, batch_size: int = BROADCAST_BATCH_SIZE,
+                 progress_interval: float = BROADCAST_PROGRESS_INTERVAL,
+                 shard: int = 0, shards: int = 1):
+        self.bot = bot
+        self.pool = pool
+        self.outbound = outbound
+        self.shard = shard
+        self.shards = shards
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks = set()
+
+    async def start(self, message: types.Message):
+        """Запускает рассылку копий сообщения в фоне"""
+        progress = await message.answer("Начинаю рассылку...")
+        broadcast_id = await create_broadcast(
+            self.pool, message.chat.id, message.message_id, progress.message_id, self.shard
+        )
+        self._spawn(BroadcastRun(broadcast_id, message.chat.id, message.message_id, progress.message_id))
+
+    async def resume_unfinished(self):
+        for row in await get_unfinished_broadcasts(self.pool, self.shard, self.shards):
+            logger.info(f"Resuming broadcast {row['broadcast_id']} after user {row['last_user_id']}")
+            self._spawn(BroadcastRun(
+                row['broadcast_id'], row['from_chat_id'], row['message_id'],
+                row['progress_message_id'], row['last_user_id'],
+                row['sent'], row['failed'], row['blocked']
+            ))
+
+    async def stop(self):
+        # Незавершённые рассылки остаются в статусе running и продолжатся при запуске
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, run: BroadcastRun):
+        task = start_background(self._run(run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, run: BroadcastRun):
+        reporter = asyncio.create_task(self._report(run))
+        try:
+            async for user_ids in iter_user_ids(self.pool, run.last_user_id, self.batch_size):
+                await self._send_batch(run, user_ids)
+            await save_broadcast_progress(
+                self.pool, run.broadcast_id, run.last_user_id,
+                run.sent, run.failed, run.blocked, finished=True
+            )
+        except asyncio.CancelledError:
+            # Остановка бота: запоминаем, докуда дошли
+            await save_broadcast_progress(
+                self.pool, run.broadcast_id, run.last_user_id, run.sent, run.failed, run.blocked
+            )
+            raise
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+        await self._edit_progress(run, finished=True)
+        logger.info(f"Broadcast {run.broadcast_id} finished: {run.sent} sent, {run.failed} failed")
+
+    async def _send_batch(self, run: BroadcastRun, user_ids: list):
+        queue = asyncio.Queue()
+        for index, user_id in enumerate(user_ids):
+            queue.put_nowait((index, user_id))
+        done = [False] * len(user_ids)
+        position = 0
+
+        async def worker():
+            nonlocal position
+            while not queue.empty():
+                index, user_id = queue.get_nowait()
+                await self._send(run, user_id)
+                done[index] = True
+                # Двигаем контрольную точку, пока впереди нет необработанных
+                while position < len(done) and done[position]:
+                    run.last_user_id = user_ids[position]
+                    position += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(user_ids)))))
+
+    async def _send(self, run: BroadcastRun, user_id: int):
+        try:
+            await self.outbound.call(
+                'broadcast', user_id, self.bot.copy_message, user_id, run.from_chat_id, run.message_id
+            )
+            run.sent += 1
+        except UNREACHABLE_ERRORS:
+            run.blocked += 1
+        except Exception as e:
+            logger.warning(f"Failed to send broadcast to {user_id}: {e}")
+            run.failed += 1
+
+    async def _report(self, run: BroadcastRun):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await save_broadcast_progress(
+                    self.pool, run.broadcast_id, run.last_user_id, run.sent, run.failed, run.blocked
+                )
+                await self._edit_progress(run)
+            except Exception as e:
+                logger.error(f"Error saving broadcast {run.broadcast_id} progress: {e}")
+
+    async def _edit_progress(self, run: BroadcastRun, finished: bool = False):
+        try:
+            # Отчёт, не успевший уйти, заменяется более свежим
+            await self.outbound.call(
+                'broadcast', None, self.bot.edit_message_text,
+                run.progress_text(finished),
+                chat_id=run.from_chat_id,
+                message_id=run.progress_message_id,
+                coalesce_key=('broadcast_progress', run.broadcast_id)
+            )
+        except MessageNotModified:
+            pass
+        except TelegramAPIError as e:
+            logger.warning(f"Failed to update broadcast {run.broadcast_id} progress: {e}")
@@ -0,0 +1,90 @@
+import inspect
+import logging
+from typing import Awaitable, Callable, Iterable, Tuple
+
+from aiogram import types
+from aiogram.dispatcher import FSMContext
+
+# Формат callback_data: "action:arg1:arg2"
+SEPARATOR = ':'
+
+# Префиксы старого формата "action_arg1_arg2" - кнопки в уже отправленных
+# сообщениях продолжают работать. Длинные префиксы проверяются первыми,
+# чтобы crypto_pay_ не принимался за crypto_.
+LEGACY_PREFIXES = sorted(
+    ('duration', 'tg_stars', 'p2p', 'confirm', 'crypto', 'crypto_pay'),
+    key=len, reverse=True
+)
+
+logger = logging.getLogger('bot_logger')
+
+CallbackHandler = Callable[..., Awaitable[None]]
+
+
+def pack(action: str, *args) -> str:
+    """Собирает callback_data из действия и аргументов"""
+    data = SEPARATOR.join((action, *map(str, args)))
+    if len(data.encode()) > 64:
+        raise ValueError(f"callback_data is longer than 64 bytes: {data}")
+    return data
+
+
+def unpack(data: str) -> Tuple[str, Tuple[str, ...]]:
+    """Разбирает callback_data в (действие, аргументы)"""
+    if SEPARATOR in data:
+        action, *args = data.split(SEPARATOR)
+        return action, tuple(args)
+    for prefix in LEGACY_PREFIXES:
+        if data.startswith(prefix + '_'):
+            return prefix, tuple(data[len(prefix) + 1:].split('_'))
+    return data, ()
+
+
+class CallbackRouter:
+    """
+    Маршрутизация нажатий кнопок по словарю действий.
+
+    Вместо цепочки фильтров, которые aiogram проверяет по очереди, в
+    диспетчере регистрируется один обработчик: он разбирает callback_data
+    один раз и находит нужную функцию по действию. Функция получает
+    callback_query, state и аргументы из callback_data.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+
+    def handler(self, action: str):
+        def decorator(callback: CallbackHandler) -> CallbackHandler:
+            if action in self._handlers:
+                raise ValueError(f"Callback action '{action}' is already registered")
+            self._handlers[action] = callback
+            return callback
+        return decorator
+
+    def resolve(self, data: str):
+        """Возвращает (обработчик, аргументы); обработчик None, если действие неизвестно"""
+        action, args = unpack(data)
+        return self._handlers.get(action), args
+
+    async def dispatch(self, callback_query: types.CallbackQuery, state: FSMContext):
+        callback, args = self.resolve(callback_query.data or '')
+        if callback is None:
+            logger.warning(f"Unknown callback data: {callback_query.data}")
+            # Снимаем "часики" с кнопки, даже если она уже ничего не делает
+            await callback_query.answer()
+            return
+        await callback(callback_query, state, *args)
+
+    def validate(self, callback_data: Iterable[str]):
+        """
+        Проверяет при запуске, что каждая кнопка попадает в обработчик
+        и число аргументов совпадает с его сигнатурой
+        """
+        for data in callback_data:
+            callback, args = self.resolve(data)
+            if callback is None:
+                raise ValueError(f"No callback handler for button '{data}'")
+            try:
+                inspect.signature(callback).bind(None, None, *args)
+            except TypeError as e:
+                raise ValueError(f"Button '{data}' does not match {callback.__name__}: {e}") from None
@@ -5,6 +5,76 @@ PROVIDER_TOKEN = "YOUR_PROVIDER_TOKEN"  # Токен для Telegram Payments
 CRYPTO_PAY_TOKEN = "YOUR_CRYPTO_PAY_TOKEN"  # Токен от @CryptoBot -> Crypto Pay -> Create App
 CRYPTO_PAY_API_URL = "https://pay.crypt.bot/api"  # Основная сеть
 # CRYPTO_PAY_API_URL = "https://testnet-pay.crypt.bot/api"  # Тестовая сеть 
+CRYPTO_PAY_TIMEOUT = 10  # Таймаут одного запроса к Crypto Pay в секундах
+CRYPTO_PAY_MAX_RETRIES = 3  # Повторы методов для чтения при сетевых ошибках, 429 и 5xx
+CRYPTO_PAY_CONNECTIONS = 20  # Максимум одновременных соединений с Crypto Pay
+INVOICE_POLL_TICK = 1  # Как часто (в секундах) искать инвойсы, которые пора проверить
+RATES_REFRESH_INTERVAL = 30  # Как часто (в секундах) обновлять курсы криптовалют в фоне
+RATES_TTL = 60  # Через сколько секунд курс считается устаревшим и обновляется при обращении
+RATES_MAX_AGE = 900  # Курсы старше этого (в секундах) не используются для выставления счетов
+
+# Режим получения обновлений
+USE_WEBHOOK = False  # True - вебхук на локальном aiohttp-сервере, False - long polling
+WEBHOOK_HOST = "https://your.domain"  # Публичный адрес, на который Telegram и Crypto Pay шлют запросы
+WEBHOOK_PATH = "/telegram/webhook"  # Путь для обновлений Telegram
+WEBHOOK_SECRET = ""  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (латиница, цифры, _ и -)
+CRYPTO_PAY_WEBHOOK_PATH = "/crypto-pay/webhook"  # Путь для вебхуков Crypto Pay (укажите его в настройках приложения)
+WEBAPP_HOST = "127.0.0.1"  # Адрес, на котором слушает локальный сервер (за обратным прокси)
+WEBAPP_PORT = 8080
+
+# Запуск в несколько процессов
+SHARD_WORKERS = 1  # Процессов-обработчиков; больше 1 - обновления делятся между ними по user_id
+SHARD_RESTART_DELAY = 1  # Через сколько секунд перезапускать упавший процесс-обработчик
+
+# Метрики Prometheus
+METRICS_ENABLED = True  # Отдавать метрики на локальном HTTP-сервере
+METRICS_HOST = "127.0.0.1"  # Адрес сервера метрик (не публикуйте его наружу)
+METRICS_PORT = 9100  # Порт сервера метрик (/metrics); у процесса-обработчика N - METRICS_PORT + N
+
+# Логирование
+LOG_LEVEL = 'DEBUG'  # Минимальный уровень записей в файл лога (в консоль - от INFO)
+LOG_MAX_BYTES = 1024 * 1024  # Размер файла лога, после которого он сжимается в .gz и начинается новый
+LOG_BACKUP_COUNT = 5  # Сколько сжатых старых файлов хранить
+LOG_QUEUE_SIZE = 10000  # Записей в очереди на запись; при переполнении новые записи отбрасываются
+LOG_DEBUG_SAMPLE = 10  # Когда очередь заполнена наполовину, пишется только каждая N-я DEBUG-запись
+
+# Настройки базы данных
+DB_READERS = 2  # Количество соединений для чтения (запись всегда идёт через одно соединение)
+DB_STREAM_BATCH_SIZE = 1000  # Размер порции при потоковом чтении больших выборок
+USER_WRITE_MODE = 'buffered'  # 'buffered' - пишем пользователей пачками, 'immediate' - коммит на каждый /start
+USER_FLUSH_INTERVAL = 1.0  # Максимальная задержка записи пользователей в секундах
+USER_FLUSH_SIZE = 500  # Сбрасываем буфер, как только в нём набралось столько пользователей
+SUBSCRIPTION_CACHE_SIZE = 10000  # Для скольких пользователей держать подписки в памяти
+SUBSCRIPTION_CACHE_TTL = 300  # Через сколько секунд перечитывать подписки пользователя из базы
+
+# Общее хранилище состояний (FSM и антифлуд) для запуска в несколько процессов
+STORAGE_BACKEND = 'memory'  # 'memory' - в памяти процесса, 'sqlite' - в базе бота, 'redis' - в Redis
+REDIS_URL = "redis://localhost:6379/0"  # Адрес Redis для STORAGE_BACKEND = 'redis'
+STORAGE_FLUSH_INTERVAL = 0.2  # Как часто (в секундах) отправлять накопленные записи в хранилище
+FSM_TTL = 86400  # Сколько секунд хранить незавершённые диалоги (состояние и данные FSM)
+
+# Лимиты Telegram Bot API
+TELEGRAM_GLOBAL_RATE = 25  # Сообщений в секунду на весь бот (лимит Telegram - около 30)
+TELEGRAM_CHAT_RATE = 1  # Сообщений в секунду в один чат
+OUTBOUND_WORKERS = 20  # Параллельных запросов в очереди исходящих сообщений
+OUTBOUND_MAX_RETRIES = 3  # Сколько раз повторять запрос после RetryAfter
+
+# Обработка окончания подписок
+EXPIRY_CONCURRENCY = 20  # Сколько пользователей обрабатывать одновременно
+EXPIRY_MAX_ATTEMPTS = 5  # Сколько раз повторять этап после ошибки, прежде чем сдаться
+
+# Заявки на вступление в канал
+JOIN_REQUEST_BATCH_SIZE = 50  # Сколько заявок одобрять одновременно
+JOIN_REQUEST_BATCH_WINDOW = 0.05  # Сколько секунд ждать следующие заявки, чтобы собрать пачку
+
+# Настройки рассылки
+BROADCAST_WORKERS = 20  # Количество параллельных отправщиков
+BROADCAST_BATCH_SIZE = 1000  # Сколько пользователей читать из базы за раз
+BROADCAST_PROGRESS_INTERVAL = 5  # Как часто (в секундах) сохранять прогресс и обновлять отчёт админу
+
+# Выгрузка и загрузка данных (/export и /import)
+TRANSFER_BATCH_SIZE = 5000  # Строк в одной порции чтения и в одной транзакции загрузки
+TRANSFER_PROGRESS_INTERVAL = 2  # Как часто (в секундах) обновлять сообщение с прогрессом
 
 # Настройки подписок
 SUBSCRIPTION_SETTINGS = {
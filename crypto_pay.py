@@ -1,52 +1,175 @@
+import asyncio
+import hashlib
+import hmac
+import random
+
 import aiohttp
-from config import CRYPTO_PAY_TOKEN, CRYPTO_PAY_API_URL
+from config import (
+    CRYPTO_PAY_TOKEN, CRYPTO_PAY_API_URL,
+    CRYPTO_PAY_TIMEOUT, CRYPTO_PAY_MAX_RETRIES, CRYPTO_PAY_CONNECTIONS
+)
+from metrics import CRYPTO_PAY_SECONDS, CRYPTO_PAY_ERRORS, CRYPTO_PAY_RETRIES
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Методы только для чтения: только их можно безопасно повторять.
+# Повтор createInvoice после таймаута мог бы создать второй инвойс
+RETRY_METHODS = {'getMe', 'getInvoices', 'getExchangeRates', 'getCurrencies', 'getBalance'}
+
+# Границы паузы между повторами (секунды)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+
+# Сколько invoice_ids можно передать в один запрос getInvoices
+MAX_INVOICE_IDS = 100
+
+# Срок действия инвойса в секундах
+INVOICE_EXPIRES_IN = 3600
+
+class CryptoPayError(Exception):
+    """Ошибка, которую вернул API Crypto Pay"""
 
 class CryptoPayAPI:
-    def __init__(self):
-        self.token = CRYPTO_PAY_TOKEN
-        self.base_url = CRYPTO_PAY_API_URL
+    def __init__(self, token: str = CRYPTO_PAY_TOKEN, base_url: str = CRYPTO_PAY_API_URL,
+                 timeout: float = CRYPTO_PAY_TIMEOUT, max_retries: int = CRYPTO_PAY_MAX_RETRIES,
+                 connections: int = CRYPTO_PAY_CONNECTIONS):
+        self.token = token
+        self.base_url = base_url
         self.headers = {
             'Crypto-Pay-API-Token': self.token
         }
-    
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.connections = connections
+        self.session = None
+
+    async def open(self):
+        """
+        Открывает общую сессию с пулом keep-alive соединений
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.connections, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def check_signature(self, body: bytes, signature: str) -> bool:
+        """
+        Проверяет подпись вебхука: HMAC-SHA256 тела запроса,
+        ключ - SHA256 от токена приложения
+        """
+        secret = hashlib.sha256(self.token.encode()).digest()
+        expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: str = None) -> float:
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+        # "Full jitter": случайная пауза до экспоненциальной границы
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    async def _request(self, method: str, params: dict = None) -> dict:
+        """
+        Выполняет запрос к API; методы для чтения повторяются при сетевых ошибках, 429 и 5xx
+        """
+        with CRYPTO_PAY_SECONDS.time(method=method):
+            try:
+                data = await self._send(method, params)
+            except Exception:
+                CRYPTO_PAY_ERRORS.inc(method=method)
+                raise
+        if not isinstance(data, dict) or not data.get('ok'):
+            CRYPTO_PAY_ERRORS.inc(method=method)
+        return data
+
+    async def _send(self, method: str, params: dict = None) -> dict:
+        if self.session is None or self.session.closed:
+            await self.open()
+        url = f"{self.base_url}/{method}"
+        retries = self.max_retries if method in RETRY_METHODS else 0
+
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            try:
+                async with self.session.get(url, params=params) as response:
+                    if response.status in RETRY_STATUSES and not last_attempt:
+                        delay = self._backoff(attempt, response.headers.get('Retry-After'))
+                    else:
+                        return await self._read_json(response)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+                delay = self._backoff(attempt)
+            CRYPTO_PAY_RETRIES.inc(method=method)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _read_json(response: aiohttp.ClientResponse) -> dict:
+        try:
+            return await response.json(content_type=None)
+        except ValueError:
+            # Прокси и балансировщики отвечают на 5xx HTML-страницей, а не JSON API
+            return {
+                'ok': False,
+                'error': {'code': response.status, 'name': 'INVALID_RESPONSE'}
+            }
+
     async def create_invoice(self, amount: float, asset: str = "TON", description: str = None):
         """
         Создает инвойс для оплаты в криптовалюте
         """
-        url = f"{self.base_url}/createInvoice"
         params = {
             "asset": asset,
             "amount": str(amount),
             "description": description or "Оплата подписки на канал",
             "paid_btn_name": "callback",
             "paid_btn_url": "https://t.me/your_bot",  # Замените на ссылку вашего бота
-            "expires_in": 3600  # Срок действия инвойса - 1 час
+            "expires_in": INVOICE_EXPIRES_IN
         }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers, params=params) as response:
-                return await response.json()
+
+        return await self._request("createInvoice", params)
+
+    async def get_invoices(self, invoice_ids: list):
+        """
+        Получает информацию о нескольких инвойсах одним запросом
+        """
+        invoices = []
+        for i in range(0, len(invoice_ids), MAX_INVOICE_IDS):
+            chunk = invoice_ids[i:i + MAX_INVOICE_IDS]
+            params = {
+                "invoice_ids": ",".join(str(invoice_id) for invoice_id in chunk),
+                "count": len(chunk)
+            }
+            data = await self._request("getInvoices", params)
+            if not data.get('ok'):
+                raise CryptoPayError(data.get('error'))
+            result = data.get('result') or {}
+            invoices.extend(result.get('items', []) if isinstance(result, dict) else result)
+        return invoices
 
     async def get_invoice(self, invoice_id: int):
         """
         Получает информацию об инвойсе
         """
-        url = f"{self.base_url}/getInvoices"
-        params = {
-            "invoice_ids": str(invoice_id)
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers, params=params) as response:
-                data = await response.json()
-                return data.get('result', [None])[0]
+        invoices = await self.get_invoices([invoice_id])
+        return invoices[0] if invoices else None
 
     async def get_currencies(self):
         """
         Получает список доступных криптовалют
         """
-        url = f"{self.base_url}/getCurrencies"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                return await response.json() 
\ No newline at end of file
+        return await self._request("getCurrencies")
+
+    async def get_exchange_rates(self):
+        """
+        Получает текущие курсы обмена
+        """
+        return await self._request("getExchangeRates")
@@ -1,146 +1,899 @@
 import aiosqlite
 import asyncio
-from datetime import datetime, timedelta
+import json
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Optional, Sequence, Tuple
 from aiogram import types
+from config import (
+    DB_READERS, DB_STREAM_BATCH_SIZE,
+    USER_WRITE_MODE, USER_FLUSH_INTERVAL, USER_FLUSH_SIZE
+)
+from metrics import timed_db
+import logging
 import os
+import time
 
 DB_PATH = 'bot_database.db'
 
-async def create_pool():
-    # В SQLite не нужен пул соединений, возвращаем путь к базе
-    return DB_PATH
+# Все даты в базе хранятся как целые секунды Unix (UTC)
+DAY = 24 * 60 * 60
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Создаем таблицу подписок
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id INTEGER PRIMARY KEY,
-                start_date TIMESTAMP NOT NULL,
-                end_date TIMESTAMP,
-                subscription_type TEXT NOT NULL,
-                payment_method TEXT NOT NULL,
-                amount REAL NOT NULL
-            )
-        ''')
-        
-        # Создаем таблицу пользователей
+# Размер кэша подготовленных выражений sqlite3 на одно соединение.
+# Текст запросов ниже не меняется между вызовами, поэтому на долгоживущем
+# соединении каждый запрос компилируется один раз и дальше берётся из кэша.
+STATEMENT_CACHE_SIZE = 256
+
+# Настройки, применяемые к каждому соединению
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',       # Читатели не блокируют писателя
+    'PRAGMA synchronous = NORMAL',     # В режиме WAL безопасно и без fsync на каждый коммит
+    'PRAGMA busy_timeout = 5000',      # Ждём блокировку вместо ошибки "database is locked"
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',      # ~16 МБ страничного кэша
+    'PRAGMA mmap_size = 134217728',    # 128 МБ memory-mapped I/O
+)
+
+logger = logging.getLogger('bot_logger')
+
+
+class ConnectionPool:
+    """
+    Долгоживущие соединения с SQLite: одно соединение для записи
+    и небольшой пул соединений для чтения.
+
+    Каждое соединение aiosqlite держит свой поток, поэтому открываем их
+    один раз при старте, а не на каждый запрос.
+    """
+
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._idle = deque()
+        self._waiters = deque()
+        self._connections = []
+        self._subscription_listeners = []
+        self.users = UserWriteBuffer(self)
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        db.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        self._connections.append(db)
+        return db
+
+    async def open(self):
+        # Писатель открывается первым: он включает WAL для файла базы
+        self._writer = await self._connect()
+        for _ in range(self.readers_count):
+            self._idle.append(await self._connect())
+        self.users.start()
+        return self
+
+    @asynccontextmanager
+    async def read(self):
+        """Выдаёт свободное соединение для чтения, ожидающие получают их строго по очереди"""
+        db = await self._acquire_reader()
+        try:
+            yield db
+        finally:
+            self._release_reader(db)
+
+    async def _acquire_reader(self) -> aiosqlite.Connection:
+        if self._idle and not self._waiters:
+            return self._idle.popleft()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Соединение уже отдано этой задаче - передаём его следующей
+                self._release_reader(waiter.result())
+            raise
+
+    def _release_reader(self, db: aiosqlite.Connection):
+        # Освободившееся соединение сразу уходит самому старому ожидающему,
+        # иначе задача, которая тут же читает снова, забирает его без очереди
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(db)
+                return
+        self._idle.append(db)
+
+    @asynccontextmanager
+    async def write(self):
+        """
+        Выдаёт соединение для записи; коммит или откат по выходу из блока.
+
+        Транзакция сразу берёт блокировку записи (BEGIN IMMEDIATE): в одном
+        процессе писатели и так идут по очереди через _write_lock, а писатели
+        из других процессов ждут её через busy_timeout. Отложенная транзакция
+        могла бы получить "database is locked" без ожидания при переходе
+        от чтения к записи.
+        """
+        async with self._write_lock:
+            await self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    def add_subscription_listener(self, listener: Callable[[int, Optional[int]], None]):
+        """Регистрирует колбэк (user_id, end_date), вызываемый после записи подписки"""
+        self._subscription_listeners.append(listener)
+
+    def notify_subscription(self, user_id: int, end_date: Optional[int]):
+        for listener in self._subscription_listeners:
+            listener(user_id, end_date)
+
+    async def close(self):
+        # Сначала дописываем всё, что накопилось в буфере пользователей
+        await self.users.close()
+        connections, self._connections = self._connections, []
+        for db in connections:
+            await db.close()
+        self._writer = None
+        self._idle.clear()
+
+
+class UserWriteBuffer:
+    """
+    Отложенная запись пользователей из /start.
+
+    Строки копятся в памяти (последняя версия на каждый user_id) и пишутся
+    одной транзакцией, когда набирается USER_FLUSH_SIZE строк или проходит
+    USER_FLUSH_INTERVAL секунд. При закрытии пула буфер сбрасывается.
+    В режиме 'immediate' каждая запись коммитится до возврата из add().
+    """
+
+    def __init__(self, pool: 'ConnectionPool', mode: str = USER_WRITE_MODE,
+                 max_size: int = USER_FLUSH_SIZE, interval: float = USER_FLUSH_INTERVAL):
+        if mode not in ('buffered', 'immediate'):
+            raise ValueError(f"Unknown user write mode: {mode}")
+        self.pool = pool
+        self.mode = mode
+        self.max_size = max_size
+        self.interval = interval
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self.mode == 'buffered' and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def add(self, user: types.User):
+        self._pending[user.id] = (user.id, user.username, user.first_name, user.last_name)
+        if self.mode == 'immediate':
+            await self.flush()
+        elif len(self._pending) >= self.max_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing users buffer: {e}", exc_info=True)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = list(self._pending.values()), {}
+        try:
+            async with self.pool.write() as db:
+                await db.executemany('''
+                    INSERT INTO users (user_id, username, first_name, last_name)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name
+                ''', rows)
+        except Exception:
+            # Возвращаем строки в буфер, не затирая более свежие данные
+            for row in rows:
+                self._pending.setdefault(row[0], row)
+            raise
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+@timed_db
+async def create_pool(path: str = DB_PATH) -> ConnectionPool:
+    return await ConnectionPool(path).open()
+
+# Миграции схемы: (версия, описание, список SQL-выражений).
+# Применяются по порядку в init_db, каждая - в своей транзакции.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            start_date TIMESTAMP NOT NULL,
+            end_date TIMESTAMP,
+            subscription_type TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            amount REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            joined_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES subscriptions(user_id)
+        )
+        ''',
+    ]),
+    # Даты переводятся в целые секунды Unix. Значения, записанные из Python
+    # через datetime.now(), хранились в локальном времени (модификатор 'utc'),
+    # а DEFAULT CURRENT_TIMESTAMP - уже в UTC.
+    (2, 'epoch timestamps and expiry indexes', [
+        '''
+        CREATE TABLE subscriptions_new (
+            user_id INTEGER PRIMARY KEY,
+            start_date INTEGER NOT NULL,
+            end_date INTEGER,
+            subscription_type TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            amount REAL NOT NULL
+        )
+        ''',
+        '''
+        INSERT INTO subscriptions_new
+        SELECT user_id,
+               CAST(strftime('%s', start_date, 'utc') AS INTEGER),
+               CAST(strftime('%s', end_date, 'utc') AS INTEGER),
+               subscription_type, payment_method, amount
+        FROM subscriptions
+        ''',
+        'DROP TABLE subscriptions',
+        'ALTER TABLE subscriptions_new RENAME TO subscriptions',
+        '''
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            joined_date INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+        ''',
+        '''
+        INSERT INTO users_new
+        SELECT user_id, username, first_name, last_name,
+               CAST(strftime('%s', joined_date) AS INTEGER)
+        FROM users
+        ''',
+        'DROP TABLE users',
+        'ALTER TABLE users_new RENAME TO users',
+        '''
+        CREATE TABLE payments_new (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            completed_at INTEGER,
+            FOREIGN KEY (user_id) REFERENCES subscriptions(user_id)
+        )
+        ''',
+        '''
+        INSERT INTO payments_new
+        SELECT payment_id, user_id, amount, status, payment_method,
+               CAST(strftime('%s', created_at) AS INTEGER),
+               CAST(strftime('%s', completed_at, 'utc') AS INTEGER)
+        FROM payments
+        ''',
+        'DROP TABLE payments',
+        'ALTER TABLE payments_new RENAME TO payments',
+        'CREATE INDEX idx_subscriptions_end_date ON subscriptions(end_date)',
+        'CREATE INDEX idx_payments_user_created ON payments(user_id, created_at)',
+    ]),
+    # Отметки об отправленных уведомлениях об окончании подписки. Ключ
+    # включает end_date, поэтому после продления этапы начинаются заново.
+    # Уже истекшие подписки и открытые окна предупреждений отмечаются сразу:
+    # их обработала прежняя ежечасная проверка.
+    (3, 'expiry notification markers', [
+        '''
+        CREATE TABLE expiry_notifications (
+            user_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            end_date INTEGER NOT NULL,
+            notified_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, stage, end_date)
+        )
+        ''',
+        '''
+        INSERT INTO expiry_notifications (user_id, stage, end_date, notified_at)
+        SELECT user_id, stage.name, end_date, CAST(strftime('%s', 'now') AS INTEGER)
+        FROM subscriptions
+        JOIN (SELECT 'week' AS name, 7 * 86400 AS offset
+              UNION ALL SELECT 'day', 86400
+              UNION ALL SELECT 'expired', 0) AS stage
+        WHERE end_date - stage.offset <= CAST(strftime('%s', 'now') AS INTEGER)
+        ''',
+    ]),
+    (4, 'broadcast progress', [
+        '''
+        CREATE TABLE broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+        ''',
+    ]),
+    (5, 'pending crypto invoices', [
+        '''
+        CREATE TABLE pending_invoices (
+            invoice_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            duration TEXT NOT NULL,
+            asset TEXT NOT NULL,
+            amount TEXT NOT NULL,
+            price REAL NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            next_check_at INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX idx_pending_invoices_due ON pending_invoices(next_check_at)
+        WHERE status = 'active'
+        ''',
+    ]),
+    (6, 'shared key-value store', [
+        '''
+        CREATE TABLE kv_store (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL
+        )
+        ''',
+        'CREATE INDEX idx_kv_store_expires ON kv_store(expires_at) WHERE expires_at IS NOT NULL',
+    ]),
+    (7, 'expiry outcomes', [
+        "ALTER TABLE expiry_notifications ADD COLUMN outcome TEXT NOT NULL DEFAULT 'notified'",
+        'ALTER TABLE expiry_notifications ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1',
+    ]),
+    (8, 'payment idempotency keys', [
+        'ALTER TABLE payments ADD COLUMN provider TEXT',
+        'ALTER TABLE payments ADD COLUMN external_id TEXT',
+        "UPDATE payments SET provider = payment_method",
+        '''
+        CREATE UNIQUE INDEX idx_payments_external ON payments(provider, external_id)
+        WHERE external_id IS NOT NULL
+        ''',
+    ]),
+    # Номер процесса-обработчика, который ведёт рассылку: после перезапуска
+    # её продолжает только он, а не все процессы сразу
+    (9, 'broadcast owner', [
+        'ALTER TABLE broadcasts ADD COLUMN shard INTEGER NOT NULL DEFAULT 0',
+    ]),
+]
+
+@timed_db
+async def init_db(pool: ConnectionPool):
+    """Применяет к базе все ещё не применённые миграции"""
+    async with pool.write() as db:
         await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                joined_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at INTEGER NOT NULL
             )
         ''')
-        
-        # Создаем таблицу платежей
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                status TEXT NOT NULL,
-                payment_method TEXT NOT NULL,
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES subscriptions(user_id)
+        async with db.execute('SELECT MAX(version) FROM schema_version') as cursor:
+            row = await cursor.fetchone()
+            current = row[0] or 0
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        async with pool.write() as db:
+            # Миграцию мог применить другой процесс, пока мы ждали блокировку
+            async with db.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)) as cursor:
+                if await cursor.fetchone() is not None:
+                    continue
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute(
+                'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                (version, description, int(time.time()))
             )
-        ''')
-        await db.commit()
+        logger.info(f"Applied database migration {version}: {description}")
 
-async def add_subscription(db_path, user_id: int, duration: str, payment_method: str, amount: float):
-    now = datetime.now()
+def _to_datetime(timestamp: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+@timed_db
+async def is_payment_recorded(pool: ConnectionPool, provider: str, external_id: str) -> bool:
+    async with pool.read() as db:
+        async with db.execute(
+            'SELECT 1 FROM payments WHERE provider = ? AND external_id = ?', (provider, external_id)
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+@timed_db
+async def add_subscription(pool: ConnectionPool, user_id: int, duration: str, payment_method: str,
+                           amount: float, external_id: Optional[str] = None) -> bool:
+    """
+    Проводит платёж и продлевает подписку одной транзакцией.
+
+    external_id - идентификатор платежа у провайдера (payment_method): повторная
+    доставка того же платежа ничего не меняет и возвращает False.
+    Продление отсчитывается от текущей даты окончания, если она ещё не наступила.
+    """
+    now = int(time.time())
     
     if duration == 'month':
-        end_date = now + timedelta(days=30)
+        days = 30
     elif duration == 'year':
-        end_date = now + timedelta(days=365)
+        days = 365
     elif duration == 'forever':
-        end_date = None
+        days = None
     else:
         raise ValueError("Invalid duration")
     
-    async with aiosqlite.connect(db_path) as db:
-        # Добавляем или обновляем подписку
+    if external_id is not None:
+        external_id = str(external_id)
+        # Быстрая проверка без блокировки записи: повтор - самый частый случай дубля
+        if await is_payment_recorded(pool, payment_method, external_id):
+            return False
+    
+    # Транзакция write() сразу блокирует запись, поэтому чтение подписки и её обновление атомарны
+    async with pool.write() as db:
+        cursor = await db.execute('''
+            INSERT INTO payments (user_id, amount, status, payment_method, provider, external_id,
+                                  created_at, completed_at)
+            VALUES (?, ?, 'completed', ?, ?, ?, ?, ?)
+            ON CONFLICT(provider, external_id) WHERE external_id IS NOT NULL DO NOTHING
+        ''', (user_id, amount, payment_method, payment_method, external_id, now, now))
+        if cursor.rowcount == 0:
+            return False
+        
+        async with db.execute(
+            'SELECT start_date, end_date FROM subscriptions WHERE user_id = ?', (user_id,)
+        ) as cursor:
+            current = await cursor.fetchone()
+        
+        start_date = now
+        if current is not None and (current['end_date'] is None or current['end_date'] >= now):
+            # Подписка ещё действует: это продление, а не новая подписка
+            start_date = current['start_date']
+            if current['end_date'] is None:
+                # Бессрочную подписку продлевать некуда
+                return True
+        end_date = None if days is None else max(now, current['end_date'] if current else 0) + days * DAY
+        
         await db.execute('''
-            INSERT OR REPLACE INTO subscriptions 
+            INSERT INTO subscriptions 
             (user_id, start_date, end_date, subscription_type, payment_method, amount)
             VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, now, end_date, duration, payment_method, amount))
-        
-        # Записываем платёж
-        await db.execute('''
-            INSERT INTO payments (user_id, amount, status, payment_method, completed_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, amount, 'completed', payment_method, now))
-        
-        await db.commit()
+            ON CONFLICT(user_id) DO UPDATE SET
+                start_date = excluded.start_date,
+                end_date = excluded.end_date,
+                subscription_type = excluded.subscription_type,
+                payment_method = excluded.payment_method,
+                amount = excluded.amount
+        ''', (user_id, start_date, end_date, duration, payment_method, amount))
 
-async def get_expiring_subscriptions(db_path, days_left: int):
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
-        date_check = datetime.now() + timedelta(days=days_left)
-        
-        query = '''
-            SELECT user_id, end_date 
-            FROM subscriptions 
-            WHERE end_date IS NOT NULL 
-            AND end_date <= ?
-            AND end_date > ?
-        '''
-        
-        async with db.execute(query, (date_check, datetime.now())) as cursor:
-            rows = await cursor.fetchall()
-            return [(row['user_id'], datetime.fromisoformat(row['end_date'])) for row in rows]
+    pool.notify_subscription(user_id, end_date)
+    return True
 
-async def check_expired_subscriptions(db_path):
-    async with aiosqlite.connect(db_path) as db:
-        now = datetime.now()
-        async with db.execute('''
-            SELECT user_id FROM subscriptions 
-            WHERE end_date IS NOT NULL AND end_date < ?
-        ''', (now,)) as cursor:
-            rows = await cursor.fetchall()
-            return [row[0] for row in rows]
-
-async def add_user(db_path, user: types.User):
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-        ''', (user.id, user.username, user.first_name, user.last_name))
-        await db.commit()
-
-async def get_all_users(db_path):
-    async with aiosqlite.connect(db_path) as db:
-        async with db.execute('SELECT user_id FROM users') as cursor:
-            rows = await cursor.fetchall()
-            return [row[0] for row in rows]
-
-async def get_user_subscriptions(db_path, user_id: int):
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
+async def _iter_pages(pool: ConnectionPool, query: str, params: dict = None,
+                      after_user_id: int = 0, batch_size: int = DB_STREAM_BATCH_SIZE,
+                      key: str = 'user_id'):
+    """
+    Постранично читает результат запроса (keyset-пагинация по столбцу key).
+
+    Запрос должен отбирать строки с "key > :after", сортировать их по
+    key и заканчиваться "LIMIT :limit". Соединение для чтения занимается
+    только на время выборки одной страницы, поэтому память и пул не зависят
+    от размера таблицы и от скорости потребителя.
+    """
+    params = dict(params or {}, limit=batch_size)
+    after = after_user_id
+    while True:
+        async with pool.read() as db:
+            async with db.execute(query, dict(params, after=after)) as cursor:
+                rows = await cursor.fetchall()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][key]
+
+@timed_db
+async def iter_user_ids(pool: ConnectionPool, after_user_id: int = 0,
+                        batch_size: int = DB_STREAM_BATCH_SIZE):
+    """Отдаёт user_id всех пользователей порциями по возрастанию"""
+    async for rows in _iter_pages(pool, '''
+        SELECT user_id FROM users
+        WHERE user_id > :after
+        ORDER BY user_id LIMIT :limit
+    ''', after_user_id=after_user_id, batch_size=batch_size):
+        yield [row['user_id'] for row in rows]
+
+@timed_db
+async def iter_expiring_subscriptions(pool: ConnectionPool, days_left: int,
+                                      batch_size: int = DB_STREAM_BATCH_SIZE):
+    """Отдаёт порциями (user_id, end_date) подписок, истекающих в ближайшие days_left дней"""
+    now = int(time.time())
+    async for rows in _iter_pages(pool, '''
+        SELECT user_id, end_date
+        FROM subscriptions
+        WHERE end_date <= :until
+        AND end_date > :now
+        AND user_id > :after
+        ORDER BY user_id LIMIT :limit
+    ''', {'until': now + days_left * DAY, 'now': now}, batch_size=batch_size):
+        yield [(row['user_id'], _to_datetime(row['end_date'])) for row in rows]
+
+@timed_db
+async def iter_active_subscriptions(pool: ConnectionPool, batch_size: int = DB_STREAM_BATCH_SIZE):
+    """Отдаёт порциями (user_id, end_date) действующих подписок; end_date None - бессрочная"""
+    async for rows in _iter_pages(pool, '''
+        SELECT user_id, end_date FROM subscriptions
+        WHERE (end_date IS NULL OR end_date >= :now)
+        AND user_id > :after
+        ORDER BY user_id LIMIT :limit
+    ''', {'now': int(time.time())}, batch_size=batch_size):
+        yield [(row['user_id'], row['end_date']) for row in rows]
+
+@timed_db
+async def iter_expired_subscriptions(pool: ConnectionPool, batch_size: int = DB_STREAM_BATCH_SIZE):
+    """Отдаёт порциями user_id пользователей с истекшей подпиской"""
+    async for rows in _iter_pages(pool, '''
+        SELECT user_id FROM subscriptions
+        WHERE end_date < :now
+        AND user_id > :after
+        ORDER BY user_id LIMIT :limit
+    ''', {'now': int(time.time())}, batch_size=batch_size):
+        yield [row['user_id'] for row in rows]
+
+@timed_db
+async def get_expiring_subscriptions(pool: ConnectionPool, days_left: int):
+    return [item async for batch in iter_expiring_subscriptions(pool, days_left) for item in batch]
+
+@timed_db
+async def check_expired_subscriptions(pool: ConnectionPool):
+    return [user_id async for batch in iter_expired_subscriptions(pool) for user_id in batch]
+
+@timed_db
+async def add_user(pool: ConnectionPool, user: types.User):
+    # Запись уходит в буфер и попадёт в базу вместе с соседними /start
+    await pool.users.add(user)
+
+@timed_db
+async def get_all_users(pool: ConnectionPool):
+    return [user_id async for batch in iter_user_ids(pool) for user_id in batch]
+
+@timed_db
+async def get_subscription_rows(pool: ConnectionPool, user_id: int):
+    """Подписки пользователя как есть, без вычисления статуса (удобно кэшировать)"""
+    async with pool.read() as db:
         async with db.execute('''
             SELECT 
                 subscription_type,
                 payment_method,
                 start_date,
                 end_date,
-                amount,
-                CASE 
-                    WHEN end_date IS NULL THEN 'active'
-                    WHEN end_date < CURRENT_TIMESTAMP THEN 'expired'
-                    ELSE 'active'
-                END as status,
-                CASE 
-                    WHEN end_date IS NULL THEN NULL
-                    WHEN end_date < CURRENT_TIMESTAMP THEN NULL
-                    ELSE (julianday(end_date) - julianday(CURRENT_TIMESTAMP))
-                END as days_left
+                amount
             FROM subscriptions 
             WHERE user_id = ?
             ORDER BY start_date DESC
         ''', (user_id,)) as cursor:
-            return await cursor.fetchall() 
\ No newline at end of file
+            return [dict(row) for row in await cursor.fetchall()]
+
+def describe_subscriptions(rows: list, now: int = None):
+    """Добавляет к строкам подписок статус и число оставшихся дней на момент now"""
+    now = int(time.time()) if now is None else now
+    subscriptions = []
+    for row in rows:
+        end_date = row['end_date']
+        active = end_date is None or end_date >= now
+        subscriptions.append({
+            'subscription_type': row['subscription_type'],
+            'payment_method': row['payment_method'],
+            'start_date': _to_datetime(row['start_date']),
+            'end_date': _to_datetime(end_date),
+            'amount': row['amount'],
+            'status': 'active' if active else 'expired',
+            'days_left': (end_date - now) // DAY if end_date is not None and active else None,
+        })
+    return subscriptions
+
+@timed_db
+async def get_user_subscriptions(pool: ConnectionPool, user_id: int):
+    return describe_subscriptions(await get_subscription_rows(pool, user_id))
+
+@timed_db
+async def iter_scheduled_expiries(pool: ConnectionPool, max_attempts: int,
+                                  batch_size: int = DB_STREAM_BATCH_SIZE):
+    """
+    Подписки с датой окончания, для которых ещё не обработано само окончание.
+    Отдаёт порциями (user_id, end_date, множество завершённых этапов).
+    Этап завершён, если он удался или исчерпал max_attempts попыток.
+    """
+    async for rows in _iter_pages(pool, '''
+        SELECT s.user_id AS user_id, s.end_date AS end_date, GROUP_CONCAT(n.stage) AS notified
+        FROM subscriptions s
+        LEFT JOIN expiry_notifications n
+            ON n.user_id = s.user_id AND n.end_date = s.end_date
+            AND (n.outcome != 'failed' OR n.attempts >= :max_attempts)
+        WHERE s.end_date IS NOT NULL
+        AND s.user_id > :after
+        GROUP BY s.user_id
+        HAVING COALESCE(SUM(n.stage = 'expired'), 0) = 0
+        ORDER BY s.user_id LIMIT :limit
+    ''', {'max_attempts': max_attempts}, batch_size=batch_size):
+        yield [
+            (row['user_id'], row['end_date'], set(row['notified'].split(',')) if row['notified'] else set())
+            for row in rows
+        ]
+
+@timed_db
+async def record_expiry_outcome(pool: ConnectionPool, user_id: int, stage: str, end_date: int,
+                                outcome: str) -> int:
+    """
+    Записывает результат этапа ('notified', 'banned', 'unreachable' или 'failed').
+    Возвращает номер попытки, чтобы вызывающий мог прекратить повторы.
+    """
+    async with pool.write() as db:
+        await db.execute('''
+            INSERT INTO expiry_notifications (user_id, stage, end_date, notified_at, outcome, attempts)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT(user_id, stage, end_date) DO UPDATE SET
+                notified_at = excluded.notified_at,
+                outcome = excluded.outcome,
+                attempts = attempts + 1
+        ''', (user_id, stage, end_date, int(time.time()), outcome))
+        async with db.execute('''
+            SELECT attempts FROM expiry_notifications
+            WHERE user_id = ? AND stage = ? AND end_date = ?
+        ''', (user_id, stage, end_date)) as cursor:
+            return (await cursor.fetchone())[0]
+
+@timed_db
+async def create_broadcast(pool: ConnectionPool, from_chat_id: int, message_id: int,
+                           progress_message_id: int, shard: int = 0) -> int:
+    async with pool.write() as db:
+        cursor = await db.execute('''
+            INSERT INTO broadcasts (from_chat_id, message_id, progress_message_id, status, created_at, shard)
+            VALUES (?, ?, ?, 'running', ?, ?)
+        ''', (from_chat_id, message_id, progress_message_id, int(time.time()), shard))
+        return cursor.lastrowid
+
+@timed_db
+async def save_broadcast_progress(pool: ConnectionPool, broadcast_id: int, last_user_id: int,
+                                  sent: int, failed: int, blocked: int, finished: bool = False):
+    async with pool.write() as db:
+        await db.execute('''
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = ?, failed = ?, blocked = ?,
+                status = ?, finished_at = ?
+            WHERE broadcast_id = ?
+        ''', (
+            last_user_id, sent, failed, blocked,
+            'done' if finished else 'running',
+            int(time.time()) if finished else None,
+            broadcast_id
+        ))
+
+@timed_db
+async def get_unfinished_broadcasts(pool: ConnectionPool, shard: int = 0, shards: int = 1):
+    """Незавершённые рассылки процесса shard из shards (после смены числа процессов - по остатку)"""
+    async with pool.read() as db:
+        async with db.execute(
+            "SELECT * FROM broadcasts WHERE status = 'running' AND shard % ? = ? ORDER BY broadcast_id",
+            (shards, shard)
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+@timed_db
+async def add_pending_invoice(pool: ConnectionPool, invoice_id: int, user_id: int, duration: str,
+                              asset: str, amount: str, price: float, next_check_at: int):
+    async with pool.write() as db:
+        await db.execute('''
+            INSERT OR IGNORE INTO pending_invoices
+            (invoice_id, user_id, duration, asset, amount, price, status, created_at, next_check_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'active', ?, ?)
+        ''', (invoice_id, user_id, duration, asset, amount, price, int(time.time()), next_check_at))
+
+@timed_db
+async def get_due_invoices(pool: ConnectionPool, now: int, limit: int):
+    """Открытые инвойсы, которые пора проверить"""
+    async with pool.read() as db:
+        async with db.execute('''
+            SELECT * FROM pending_invoices
+            WHERE status = 'active' AND next_check_at <= ?
+            ORDER BY next_check_at LIMIT ?
+        ''', (now, limit)) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+@timed_db
+async def get_pending_invoices(pool: ConnectionPool, invoice_ids: list):
+    async with pool.read() as db:
+        placeholders = ','.join('?' * len(invoice_ids))
+        async with db.execute(
+            f"SELECT * FROM pending_invoices WHERE status = 'active' AND invoice_id IN ({placeholders})",
+            invoice_ids
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+@timed_db
+async def reschedule_invoices(pool: ConnectionPool, schedule: list):
+    """Принимает список (next_check_at, invoice_id)"""
+    async with pool.write() as db:
+        await db.executemany(
+            "UPDATE pending_invoices SET next_check_at = ? WHERE invoice_id = ? AND status = 'active'",
+            schedule
+        )
+
+@timed_db
+async def set_invoice_status(pool: ConnectionPool, invoice_id: int, status: str,
+                             expected: str = 'active') -> bool:
+    """Меняет статус инвойса; False, если его уже перевёл кто-то другой"""
+    async with pool.write() as db:
+        cursor = await db.execute(
+            'UPDATE pending_invoices SET status = ? WHERE invoice_id = ? AND status = ?',
+            (status, invoice_id, expected)
+        )
+        return cursor.rowcount == 1
+
+# Таблицы для /export и /import: столбцы и их типы; первый столбец - ключ таблицы
+TRANSFER_COLUMNS = {
+    'users': (
+        ('user_id', int), ('username', str), ('first_name', str), ('last_name', str), ('joined_date', int),
+    ),
+    'subscriptions': (
+        ('user_id', int), ('start_date', int), ('end_date', int), ('subscription_type', str),
+        ('payment_method', str), ('amount', float),
+    ),
+    'payments': (
+        ('payment_id', int), ('user_id', int), ('amount', float), ('status', str), ('payment_method', str),
+        ('provider', str), ('external_id', str), ('created_at', int), ('completed_at', int),
+    ),
+}
+
+# Столбцы, которые обязаны быть в загружаемом файле: ключ и NOT NULL без значения
+# по умолчанию. Подписке нужен и end_date - по нему отмечаются наступившие этапы уведомлений
+TRANSFER_REQUIRED = {
+    'users': ('user_id',),
+    'subscriptions': ('user_id', 'start_date', 'end_date', 'subscription_type', 'payment_method', 'amount'),
+    'payments': ('payment_id', 'user_id', 'amount', 'status', 'payment_method'),
+}
+# Обязательные столбцы, значение которых может быть пустым (подписка без end_date - бессрочная)
+TRANSFER_NULLABLE = {'end_date'}
+
+# Этапы уведомлений об окончании подписки (как в миграции 3): за сколько секунд до окончания
+_EXPIRY_STAGES = (('week', 7 * DAY), ('day', DAY), ('expired', 0))
+
+@lru_cache(maxsize=None)
+def _import_query(table: str, columns: Tuple[str, ...]) -> str:
+    """INSERT для столбцов, которые есть в файле: остальные столбцы существующих строк не трогаем"""
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    if table == 'payments':
+        # Платёж из внешней системы уже записан, если совпал ключ (provider, external_id)
+        return query + ' ON CONFLICT(provider, external_id) WHERE external_id IS NOT NULL DO NOTHING'
+    if len(columns) == 1:
+        return query + f' ON CONFLICT({columns[0]}) DO NOTHING'
+    updates = ', '.join(f'{name} = excluded.{name}' for name in columns[1:])
+    return query + f' ON CONFLICT({columns[0]}) DO UPDATE SET {updates}'
+
+async def _split_payment_conflicts(db: aiosqlite.Connection, columns: Sequence[str], rows: list):
+    """
+    Делит порцию платежей на новые и конфликтующие: payment_id уже занят другим платежом.
+    Платёж, который уже записан с теми же значениями, сюда не попадает ни в одну из групп:
+    он отбрасывается до INSERT и в import_rows не считается ни записанным, ни конфликтом.
+    """
+    async with db.execute(
+        f"SELECT {', '.join(columns)} FROM payments WHERE payment_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([row[0] for row in rows]),)
+    ) as cursor:
+        existing = {row[0]: tuple(row) for row in await cursor.fetchall()}
+    if not existing:
+        return rows, []
+    fresh, conflicts = [], []
+    for row in rows:
+        stored = existing.get(row[0])
+        if stored is None:
+            fresh.append(row)
+        elif stored == tuple(row):
+            continue
+        else:
+            conflicts.append(row[0])
+    return fresh, conflicts
+
+@timed_db
+async def iter_table_rows(pool: ConnectionPool, table: str, batch_size: int = DB_STREAM_BATCH_SIZE):
+    """Отдаёт порциями строки таблицы (кортежи в порядке TRANSFER_COLUMNS) по возрастанию ключа"""
+    columns = [name for name, _ in TRANSFER_COLUMNS[table]]
+    async for rows in _iter_pages(pool, f'''
+        SELECT {', '.join(columns)} FROM {table}
+        WHERE {columns[0]} > :after
+        ORDER BY {columns[0]} LIMIT :limit
+    ''', batch_size=batch_size, key=columns[0]):
+        yield [tuple(row) for row in rows]
+
+@timed_db
+async def import_rows(pool: ConnectionPool, table: str, rows: list,
+                      columns: Optional[Sequence[str]] = None) -> Tuple[int, list]:
+    """
+    Записывает порцию строк одной транзакцией. columns - столбцы строк в порядке
+    TRANSFER_COLUMNS (по умолчанию все); у подписок должны быть все столбцы.
+    Существующие пользователи и подписки обновляются только в этих столбцах,
+    уже записанные платежи пропускаются.
+    Возвращает (число записанных строк, payment_id платежей, которые не записаны,
+    потому что этот payment_id занят другим платежом).
+    """
+    columns = tuple(columns or (name for name, _ in TRANSFER_COLUMNS[table]))
+    conflicts = []
+    async with pool.write() as db:
+        if table == 'payments':
+            rows, conflicts = await _split_payment_conflicts(db, columns, rows)
+        cursor = await db.executemany(_import_query(table, columns), rows)
+        changed = cursor.rowcount
+        if table == 'subscriptions':
+            # Наступившие этапы отмечаем сразу, как миграция 3: загрузка старых
+            # подписок не должна рассылать уведомления и исключать из канала
+            now = int(time.time())
+            await db.executemany('''
+                INSERT OR IGNORE INTO expiry_notifications (user_id, stage, end_date, notified_at)
+                VALUES (?, ?, ?, ?)
+            ''', [
+                (user_id, stage, end_date, now)
+                for user_id, _, end_date, *_ in rows if end_date is not None
+                for stage, offset in _EXPIRY_STAGES if end_date - offset <= now
+            ])
+
+    if table == 'subscriptions':
+        for user_id, _, end_date, *_ in rows:
+            pool.notify_subscription(user_id, end_date)
+    return changed, conflicts
@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+from aiogram.utils.exceptions import RetryAfter
+
+from config import EXPIRY_CONCURRENCY, EXPIRY_MAX_ATTEMPTS
+from db import DAY, ConnectionPool, iter_scheduled_expiries, record_expiry_outcome
+
+# Этапы уведомлений: (название, за сколько секунд до окончания подписки)
+STAGES = (
+    ('week', 7 * DAY),
+    ('day', DAY),
+    ('expired', 0),
+)
+
+# Пауза перед повтором этапа, если обработчик упал; удваивается с каждой попыткой
+RETRY_DELAY = 60
+
+# Максимальный сон таймера: страховка от перевода системных часов
+MAX_SLEEP = 3600
+
+logger = logging.getLogger('bot_logger')
+
+# Обработчик этапа возвращает результат: 'notified', 'banned' или 'unreachable'.
+# Исключение означает 'failed' - этап будет повторён.
+ExpiryHandler = Callable[[int, str, int], Awaitable[str]]
+
+
+class ExpiryScheduler:
+    """
+    Планировщик окончания подписок на куче ближайших дедлайнов.
+
+    Для каждой подписки с датой окончания в куче лежат ещё не отправленные
+    этапы (предупреждение за неделю, за сутки и само окончание). Один таймер
+    спит до ближайшего дедлайна. Наступившие этапы обрабатываются параллельно,
+    не более concurrency одновременно. Результат каждого этапа записывается
+    в базу, поэтому после перезапуска завершённые этапы не повторяются,
+    а упавшие повторяются до max_attempts раз.
+    """
+
+    def __init__(self, pool: ConnectionPool, handler: ExpiryHandler,
+                 concurrency: int = EXPIRY_CONCURRENCY, max_attempts: int = EXPIRY_MAX_ATTEMPTS):
+        self.pool = pool
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self._heap = []  # (дедлайн, user_id, этап, end_date)
+        self._end_dates = {}  # user_id -> актуальная дата окончания
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._in_flight = set()  # (user_id, этап, end_date), которые сейчас обрабатываются
+        self._workers = set()
+        self._task = None
+
+    async def load(self):
+        """Заполняет кучу из таблицы подписок"""
+        async for batch in iter_scheduled_expiries(self.pool, self.max_attempts):
+            for user_id, end_date, notified in batch:
+                self.schedule(user_id, end_date, notified)
+        logger.info(f"Expiry scheduler loaded {len(self._end_dates)} subscriptions")
+
+    def schedule(self, user_id: int, end_date: Optional[int], notified: Optional[Iterable[str]] = None):
+        """
+        Ставит (или переставляет после продления) этапы подписки пользователя.
+
+        notified - завершённые этапы по данным базы (при загрузке). Без него
+        (слушатель записи подписки) уже наступившие этапы не ставятся: их
+        отмечает в базе тот, кто записал подписку (см. db.import_rows).
+        """
+        if end_date is None:
+            # Бессрочная подписка: старые записи в куче станут неактуальными
+            self._end_dates.pop(user_id, None)
+            return
+
+        self._end_dates[user_id] = end_date
+        now = time.time()
+        for i, (stage, offset) in enumerate(STAGES):
+            if stage in (notified or ()) or (notified is None and end_date - offset <= now):
+                continue
+            # Предупреждение не нужно, если уже наступил следующий этап
+            if i + 1 < len(STAGES) and end_date - STAGES[i + 1][1] <= now:
+                continue
+            heapq.heappush(self._heap, (end_date - offset, user_id, stage, end_date))
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._workers)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0][0] <= time.time():
+                _, user_id, stage, end_date = heapq.heappop(self._heap)
+                key = (user_id, stage, end_date)
+                # Подписку продлили или сделали бессрочной - запись устарела
+                if self._end_dates.get(user_id) != end_date or key in self._in_flight:
+                    continue
+                # Ждём свободный слот: пока все заняты, новые этапы остаются в куче
+                await self._semaphore.acquire()
+                self._in_flight.add(key)
+                worker = asyncio.create_task(self._fire(user_id, stage, end_date))
+                self._workers.add(worker)
+                worker.add_done_callback(self._workers.discard)
+
+            timeout = MAX_SLEEP
+            if self._heap:
+                timeout = min(max(self._heap[0][0] - time.time(), 0), MAX_SLEEP)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _retry(self, delay: float, user_id: int, stage: str, end_date: int):
+        heapq.heappush(self._heap, (time.time() + delay, user_id, stage, end_date))
+        self._wakeup.set()
+
+    async def _fire(self, user_id: int, stage: str, end_date: int):
+        try:
+            await self._process(user_id, stage, end_date)
+        finally:
+            self._in_flight.discard((user_id, stage, end_date))
+            self._semaphore.release()
+
+    async def _process(self, user_id: int, stage: str, end_date: int):
+        try:
+            outcome = await self.handler(user_id, stage, end_date)
+        except RetryAfter as e:
+            # Лимит Telegram - не ошибка этапа, просто повторяем позже
+            self._retry(e.timeout, user_id, stage, end_date)
+            return
+        except Exception as e:
+            logger.error(f"Error processing {stage} expiry for user {user_id}: {e}", exc_info=True)
+            outcome = 'failed'
+
+        try:
+            attempts = await record_expiry_outcome(self.pool, user_id, stage, end_date, outcome)
+        except Exception as e:
+            logger.error(f"Error recording {stage} expiry for user {user_id}: {e}", exc_info=True)
+            if outcome == 'failed':
+                self._retry(RETRY_DELAY, user_id, stage, end_date)
+            return
+
+        if outcome == 'failed':
+            if attempts < self.max_attempts:
+                self._retry(RETRY_DELAY * 2 ** (attempts - 1), user_id, stage, end_date)
+                return
+            logger.error(f"Giving up {stage} expiry for user {user_id} after {attempts} attempts")
+        if stage == 'expired' and self._end_dates.get(user_id) == end_date:
+            self._end_dates.pop(user_id, None)
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from config import INVOICE_POLL_TICK
+from crypto_pay import CryptoPayAPI, INVOICE_EXPIRES_IN, MAX_INVOICE_IDS
+from db import (
+    ConnectionPool, add_pending_invoice, get_due_invoices, get_pending_invoices,
+    reschedule_invoices, set_invoice_status
+)
+
+# Интервал опроса в зависимости от возраста инвойса:
+# (возраст до, секунд между проверками). Свежие инвойсы оплачивают чаще всего.
+POLL_SCHEDULE = (
+    (120, 3),
+    (600, 10),
+    (1800, 30),
+)
+POLL_INTERVAL_MAX = 60
+
+# Сколько ещё ждать статус paid или expired после истечения срока инвойса.
+# Потом инвойс снимается с отслеживания, даже если API его больше не возвращает
+EXPIRY_GRACE = 600
+
+# Сколько инвойсов забирать из базы за один проход
+DUE_BATCH = MAX_INVOICE_IDS * 10
+
+logger = logging.getLogger('bot_logger')
+
+PaidHandler = Callable[[dict, dict], Awaitable[None]]
+
+
+def poll_interval(age: float) -> int:
+    for max_age, interval in POLL_SCHEDULE:
+        if age < max_age:
+            return interval
+    return POLL_INTERVAL_MAX
+
+
+class InvoiceReconciler:
+    """
+    Фоновая сверка открытых крипто-инвойсов.
+
+    Инвойсы хранятся в таблице pending_invoices. Раз в INVOICE_POLL_TICK секунд
+    те из них, чья проверка подошла, запрашиваются пачками через getInvoices
+    (до MAX_INVOICE_IDS за запрос). Оплаченные передаются в on_paid,
+    просроченные закрываются, остальные переносятся на следующую проверку.
+    Инвойсы старше INVOICE_EXPIRES_IN + EXPIRY_GRACE закрываются как просроченные.
+    """
+
+    def __init__(self, pool: ConnectionPool, api: CryptoPayAPI, on_paid: PaidHandler,
+                 tick: float = INVOICE_POLL_TICK):
+        self.pool = pool
+        self.api = api
+        self.on_paid = on_paid
+        self.tick = tick
+        self._task = None
+
+    async def track(self, invoice: dict, user_id: int, duration: str, price: float):
+        """Ставит только что созданный инвойс на отслеживание"""
+        await add_pending_invoice(
+            self.pool, invoice['invoice_id'], user_id, duration,
+            invoice['asset'], str(invoice['amount']), price,
+            int(time.time()) + POLL_SCHEDULE[0][1]
+        )
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.poll_due():
+                    pass
+            except Exception as e:
+                logger.error(f"Error reconciling invoices: {e}", exc_info=True)
+            await asyncio.sleep(self.tick)
+
+    async def poll_due(self) -> bool:
+        """Проверяет одну порцию созревших инвойсов; True, если порция была полной"""
+        due = await get_due_invoices(self.pool, int(time.time()), DUE_BATCH)
+        if due:
+            await self._reconcile(due)
+        return len(due) == DUE_BATCH
+
+    async def handle_paid(self, invoice: dict):
+        """Обрабатывает оплату, пришедшую вебхуком, не дожидаясь опроса"""
+        pending = await get_pending_invoices(self.pool, [invoice['invoice_id']])
+        if pending and invoice.get('status') == 'paid':
+            await self._grant(pending[0], invoice)
+
+    async def _reconcile(self, pending: list):
+        by_id = {row['invoice_id']: row for row in pending}
+        invoices = await self.api.get_invoices(list(by_id))
+
+        now = time.time()
+        seen = set()
+        for invoice in invoices:
+            row = by_id.get(invoice['invoice_id'])
+            if row is None:
+                continue
+            status = invoice.get('status')
+            if status == 'paid':
+                seen.add(row['invoice_id'])
+                await self._grant(row, invoice)
+            elif status == 'expired':
+                seen.add(row['invoice_id'])
+                await set_invoice_status(self.pool, row['invoice_id'], 'expired')
+
+        schedule = []
+        for invoice_id, row in by_id.items():
+            if invoice_id in seen:
+                continue
+            age = now - row['created_at']
+            if age > INVOICE_EXPIRES_IN + EXPIRY_GRACE:
+                logger.warning(f"Invoice {invoice_id} outlived its expiry, closing it")
+                await set_invoice_status(self.pool, invoice_id, 'expired')
+            else:
+                schedule.append((int(now + poll_interval(age)), invoice_id))
+        if schedule:
+            await reschedule_invoices(self.pool, schedule)
+
+    async def _grant(self, row: dict, invoice: dict):
+        # Переход active -> paid делает выдачу доступа однократной
+        if not await set_invoice_status(self.pool, row['invoice_id'], 'paid'):
+            return
+        try:
+            await self.on_paid(row, invoice)
+        except Exception:
+            # Вернём инвойс в очередь, чтобы выдать доступ на следующем проходе
+            await set_invoice_status(self.pool, row['invoice_id'], 'active', expected='paid')
+            raise
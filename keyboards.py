@@ -1,47 +1,101 @@
+import json
+
+import config
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import SUBSCRIPTION_SETTINGS, PAYMENT_METHODS
+from callbacks import pack
 
-def get_payment_keyboard():
+# Готовые клавиатуры: ключ -> JSON разметки.
+# Собираются один раз из config (rebuild_keyboards) и отдаются в reply_markup
+# строкой, так что aiogram не строит и не сериализует их на каждый ответ.
+_KEYBOARDS = {}
+
+def _build(*buttons: InlineKeyboardButton) -> str:
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("📋 Мои подписки", callback_data="my_subscriptions"))
-    for duration, settings in SUBSCRIPTION_SETTINGS.items():
-        keyboard.add(InlineKeyboardButton(
-            f"{settings['emoji']} {settings['name']} - {settings['price']}₽",
-            callback_data=f"duration_{duration}"
+    for button in buttons:
+        keyboard.add(button)
+    return keyboard.as_json()
+
+def rebuild_keyboards(subscriptions: dict = None, payment_methods: dict = None):
+    """
+    Пересобирает все клавиатуры из настроек.
+    Вызывается при импорте и после перезагрузки config.
+    """
+    subscriptions = subscriptions if subscriptions is not None else config.SUBSCRIPTION_SETTINGS
+    payment_methods = payment_methods if payment_methods is not None else config.PAYMENT_METHODS
+    currencies = payment_methods['crypto']['currencies']
+
+    keyboards = {
+        'payment': _build(
+            InlineKeyboardButton("📋 Мои подписки", callback_data="my_subscriptions"),
+            *(
+                InlineKeyboardButton(
+                    f"{settings['emoji']} {settings['name']} - {settings['price']}₽",
+                    callback_data=pack("duration", duration)
+                )
+                for duration, settings in subscriptions.items()
+            )
+        ),
+        'crypto_payment': _build(*(
+            InlineKeyboardButton(
+                f"₿ {settings['name']} - {settings['price']}₽",
+                callback_data=pack("crypto", duration)
+            )
+            for duration, settings in subscriptions.items()
+        )),
+        'admin_main': _build(
+            InlineKeyboardButton("Создать рассылку", callback_data="create_broadcast")
+        ),
+        'renew': _build(
+            InlineKeyboardButton("🔄 Продлить подписку", callback_data=pack("duration", "month"))
+        ),
+        'subscribe': _build(
+            InlineKeyboardButton("📝 Оформить подписку", callback_data=pack("duration", "month"))
+        ),
+    }
+    for duration in subscriptions:
+        keyboards['payment_method', duration] = _build(*(
+            InlineKeyboardButton(f"{settings['emoji']} {settings['name']}", callback_data=pack(method, duration))
+            for method, settings in payment_methods.items()
         ))
-    return keyboard
+        keyboards['crypto_currency', duration] = _build(*(
+            InlineKeyboardButton(f"{emoji} {currency}", callback_data=pack("crypto_pay", currency, duration))
+            for currency, emoji in currencies.items()
+        ))
+
+    # Подменяем словарь целиком, чтобы читатели не увидели его наполовину собранным
+    global _KEYBOARDS
+    _KEYBOARDS = keyboards
+
+def get_payment_keyboard():
+    return _KEYBOARDS['payment']
 
 def get_payment_method_keyboard(duration: str):
-    keyboard = InlineKeyboardMarkup()
-    for method, settings in PAYMENT_METHODS.items():
-        keyboard.add(InlineKeyboardButton(
-            f"{settings['emoji']} {settings['name']}",
-            callback_data=f"{method}_{duration}"
-        ))
-    return keyboard
+    return _KEYBOARDS['payment_method', duration]
 
 def get_admin_keyboard(user_id: int):
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Подтвердить оплату", callback_data=f"confirm_{user_id}"))
+    keyboard.add(InlineKeyboardButton("Подтвердить оплату", callback_data=pack("confirm", user_id)))
     return keyboard
 
 def get_admin_main_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Создать рассылку", callback_data="create_broadcast"))
-    return keyboard 
+    return _KEYBOARDS['admin_main']
 
 def get_crypto_payment_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("₿ Месяц - 1000₽", callback_data="crypto_month"))
-    keyboard.add(InlineKeyboardButton("₿ Год - 10000₽", callback_data="crypto_year"))
-    keyboard.add(InlineKeyboardButton("₿ Навсегда - 50000₽", callback_data="crypto_forever"))
-    return keyboard
+    return _KEYBOARDS['crypto_payment']
 
 def get_crypto_currency_keyboard(duration: str):
-    keyboard = InlineKeyboardMarkup()
-    for currency, emoji in PAYMENT_METHODS['crypto']['currencies'].items():
-        keyboard.add(InlineKeyboardButton(
-            f"{emoji} {currency}",
-            callback_data=f"crypto_pay_{currency}_{duration}"
-        ))
-    return keyboard 
\ No newline at end of file
+    return _KEYBOARDS['crypto_currency', duration]
+
+def get_subscriptions_keyboard(has_active: bool):
+    return _KEYBOARDS['renew' if has_active else 'subscribe']
+
+def iter_callback_data():
+    """Все callback_data, которые бот отправляет в кнопках (для проверки маршрутов)"""
+    keyboards = list(_KEYBOARDS.values()) + [get_admin_keyboard(1).as_json()]
+    for keyboard in keyboards:
+        for row in json.loads(keyboard)['inline_keyboard']:
+            for button in row:
+                if 'callback_data' in button:
+                    yield button['callback_data']
+
+rebuild_keyboards()
@@ -0,0 +1,239 @@
+import asyncio
+import contextvars
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_QUEUE_SIZE, LOG_DEBUG_SAMPLE
+from metrics import handler_name
+
+# Поля апдейта, которые попадают в каждую запись лога, сделанную во время его обработки
+CONTEXT_FIELDS = ('update_id', 'user_id', 'handler')
+FIELDS = CONTEXT_FIELDS + ('duration_ms',)
+
+logger = logging.getLogger('bot_logger')
+
+# Свой словарь у каждой задачи: aiogram обрабатывает каждый апдейт в отдельной задаче
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar('log_context', default={})
+_listener: Optional[QueueListener] = None
+
+
+def bind(**fields):
+    """Добавляет поля ко всем следующим записям лога текущей задачи"""
+    _context.set(dict(_context.get(), **fields))
+
+
+def start_background(coro) -> asyncio.Task:
+    """
+    Запускает задачу, которая переживёт апдейт (рассылка, импорт), без его полей лога:
+    иначе все её записи получили бы update_id и handler апдейта, который её запустил
+    """
+    context = contextvars.copy_context()
+    context.run(_context.set, {})
+    return context.run(asyncio.create_task, coro)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackpressureQueueHandler(QueueHandler):
+    """
+    Кладёт записи в ограниченную очередь, которую разбирает поток QueueListener.
+
+    Когда очередь заполнена больше чем наполовину, проходит только каждая
+    debug_sample-я DEBUG-запись; в полную очередь записи не кладутся совсем.
+    Число потерянных записей попадает в лог, когда очередь снова заполнена меньше чем наполовину.
+    """
+
+    def __init__(self, records: queue.Queue, debug_sample: int = LOG_DEBUG_SAMPLE):
+        super().__init__(records)
+        self.debug_sample = debug_sample
+        self.dropped = 0
+        self._reported = 0
+        self._debug_seen = 0
+
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Текст и трейсбек собираем здесь: поток записи не видит ни аргументы, ни контекст задачи
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        for field, value in _context.get().items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        busy = self.queue.qsize() * 2 >= self.queue.maxsize
+        if busy and record.levelno <= logging.DEBUG:
+            self._debug_seen += 1
+            if self._debug_seen % self.debug_sample:
+                self.dropped += 1
+                return
+        if not busy and self.dropped > self._reported and self._put(self._dropped_record()):
+            self._reported = self.dropped
+        if not self._put(record):
+            self.dropped += 1
+
+    def _put(self, record: logging.LogRecord) -> bool:
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            return False
+
+    def _dropped_record(self) -> logging.LogRecord:
+        return logging.LogRecord(
+            logger.name, logging.WARNING, __file__, 0,
+            f"Dropped {self.dropped - self._reported} log records under backpressure", None, None
+        )
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler, который сжимает старые файлы в .gz в отдельном потоке"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._rotate
+        self._compressing: Optional[threading.Thread] = None
+
+    def doRollover(self):
+        # Пока предыдущий файл сжимается, сдвигать номера файлов нельзя
+        self._wait_compression()
+        super().doRollover()
+
+    def _rotate(self, source: str, dest: str):
+        if not os.path.exists(source):
+            return
+        plain = dest[:-len('.gz')]
+        os.replace(source, plain)
+        self._compressing = threading.Thread(
+            target=self._compress, args=(plain, dest), name='log-compress', daemon=True
+        )
+        self._compressing.start()
+
+    @staticmethod
+    def _compress(source: str, dest: str):
+        try:
+            with open(source, 'rb') as src, gzip.open(dest + '.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(dest + '.tmp', dest)
+            os.remove(source)
+        except OSError as e:
+            print(f"Error compressing log file {source}: {e}", file=sys.stderr)
+
+    def _wait_compression(self):
+        if self._compressing is not None:
+            self._compressing.join()
+            self._compressing = None
+
+    def close(self):
+        self._wait_compression()
+        super().close()
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # При остановке ждём место в очереди, а не теряем сигнал завершения
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(filename: str = 'bot.log') -> logging.Logger:
+    """
+    Лог бота: JSON-строки в filename (со сжатием старых файлов) и текст в консоль.
+    В файл и консоль пишет отдельный поток, обработчики только кладут запись в очередь.
+    """
+    global _listener
+    stop_logging()
+
+    file_handler = CompressingRotatingFileHandler(
+        filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    file_handler.setLevel(LOG_LEVEL)
+    file_handler.setFormatter(JsonFormatter())
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    queue_handler = BackpressureQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    logger.setLevel(LOG_LEVEL)
+    logger.handlers = [queue_handler]
+    _listener = _Listener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    return logger
+
+
+def stop_logging():
+    """Дописывает очередь и закрывает файлы; вызывается перед выходом из процесса"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def get_queue_handler() -> Optional[BackpressureQueueHandler]:
+    for handler in logger.handlers:
+        if isinstance(handler, BackpressureQueueHandler):
+            return handler
+    return None
+
+
+class LoggingMiddleware(BaseMiddleware):
+    """Привязывает update_id, user_id и хендлер к записям лога и пишет время обработки апдейта"""
+
+    async def trigger(self, action, args):
+        if action.endswith('_error'):
+            return
+        data = args[-1]
+        if action == 'pre_process_update':
+            _context.set({'update_id': args[0].update_id})
+            data['_log_started'] = time.perf_counter()
+        elif action == 'post_process_update':
+            started = data.get('_log_started')
+            if started is not None:
+                duration = round((time.perf_counter() - started) * 1000, 3)
+                logger.debug("Update processed", extra={'duration_ms': duration})
+        elif action.startswith('pre_process_'):
+            user = getattr(args[0], 'from_user', None)
+            if user is not None:
+                bind(user_id=user.id)
+        elif action.startswith('process_') and action != 'process_update':
+            bind(handler=handler_name(args[0]))
@@ -0,0 +1,292 @@
+import functools
+import inspect
+import logging
+import math
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, SkipHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger('bot_logger')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry:
+    """Набор метрик и функций, которые обновляют их перед каждым снятием"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], None]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self._values[self._key(labels)] += amount
+
+    def set(self, value: float, **labels):
+        """Для счётчиков, которые ведёт сам объект (снимаются коллектором)"""
+        self._values[self._key(labels)] = value
+
+    def render(self):
+        for key, value in list(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}  # метки -> [счётчики корзин, сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        names = self.labelnames + ('le',)
+        for key, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+UPDATES = Counter('bot_updates_total', 'Processed Telegram updates', ('type',))
+UPDATE_SECONDS = Histogram('bot_update_duration_seconds', 'Time to process one update', ('type',))
+HANDLER_SECONDS = Histogram('bot_handler_duration_seconds', 'Handler latency', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions raised by handlers', ('handler',))
+DB_SECONDS = Histogram('bot_db_query_duration_seconds', 'Time spent in db.py functions', ('function',))
+DB_ERRORS = Counter('bot_db_errors_total', 'Exceptions raised by db.py functions', ('function',))
+CRYPTO_PAY_SECONDS = Histogram(
+    'bot_crypto_pay_request_duration_seconds', 'Crypto Pay API call latency including retries', ('method',)
+)
+CRYPTO_PAY_ERRORS = Counter('bot_crypto_pay_errors_total', 'Failed Crypto Pay API calls', ('method',))
+CRYPTO_PAY_RETRIES = Counter('bot_crypto_pay_retries_total', 'Retried Crypto Pay API requests', ('method',))
+OUTBOUND_DEPTH = Gauge('bot_outbound_queue_depth', 'Requests waiting in the outbound queue', ('lane',))
+OUTBOUND_REQUESTS = Counter('bot_outbound_requests_total', 'Outbound Bot API requests by result', ('lane', 'result'))
+SUBSCRIPTION_CACHE = Counter('bot_subscription_cache_requests_total', 'Subscription cache lookups', ('result',))
+LOG_DROPPED = Counter('bot_log_records_dropped_total', 'Log records dropped or sampled out under backpressure')
+
+
+def watch_outbound(outbound, registry: Registry = REGISTRY):
+    """Снимает глубину и счётчики очереди исходящих запросов при каждом запросе /metrics"""
+    def collect():
+        stats = outbound.stats()
+        for lane, depth in stats['depth'].items():
+            OUTBOUND_DEPTH.set(depth, lane=lane)
+        for result in ('sent', 'failed', 'retried', 'coalesced'):
+            for lane, value in stats[result].items():
+                OUTBOUND_REQUESTS.set(value, lane=lane, result=result)
+    registry.add_collector(collect)
+
+
+def watch_subscription_cache(cache, registry: Registry = REGISTRY):
+    def collect():
+        stats = cache.stats()
+        SUBSCRIPTION_CACHE.set(stats['hits'], result='hit')
+        SUBSCRIPTION_CACHE.set(stats['misses'], result='miss')
+    registry.add_collector(collect)
+
+
+def watch_logging(handler, registry: Registry = REGISTRY):
+    def collect():
+        LOG_DROPPED.set(handler.stats()['dropped'])
+    registry.add_collector(collect)
+
+
+def timed_db(func):
+    """Декоратор функций db.py: время выполнения и ошибки по имени функции"""
+    name = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        # Для потоковых выборок считаем время внутри генератора, без времени потребителя
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            spent = 0.0
+            iterator = func(*args, **kwargs).__aiter__()
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        spent += time.perf_counter() - started
+                        break
+                    spent += time.perf_counter() - started
+                    yield item
+            except Exception:
+                DB_ERRORS.inc(function=name)
+                raise
+            finally:
+                DB_SECONDS.observe(spent, function=name)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(function=name)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, function=name)
+    return wrapper
+
+
+def _update_type(update: types.Update) -> str:
+    for name, value in update.values.items():
+        if name != 'update_id' and value is not None:
+            return name
+    return 'unknown'
+
+
+def handler_name(obj) -> str:
+    handler = current_handler.get(None)
+    if handler is None:
+        return 'unknown'
+    # Все нажатия кнопок идут через CallbackRouter.dispatch - подписываем их реальным обработчиком
+    router = getattr(handler, '__self__', None)
+    if isinstance(obj, types.CallbackQuery) and hasattr(router, 'resolve'):
+        callback, _ = router.resolve(obj.data or '')
+        if callback is not None:
+            return callback.__name__
+    return getattr(handler, '__name__', repr(handler))
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Пропускная способность, время обработки апдейтов и хендлеров, ошибки хендлеров"""
+
+    async def trigger(self, action, args):
+        if action.endswith('_error'):
+            # errors_handlers вызываются, пока исключение хендлера ещё не обработано
+            return
+        data = args[-1]
+        if action == 'pre_process_update':
+            data['_metrics_started'] = time.perf_counter()
+        elif action == 'post_process_update':
+            update_type = _update_type(args[0])
+            UPDATES.inc(type=update_type)
+            started = data.get('_metrics_started')
+            if started is not None:
+                UPDATE_SECONDS.observe(time.perf_counter() - started, type=update_type)
+        elif action.startswith('process_') and action != 'process_update':
+            # Фильтры пройдены, дальше вызывается хендлер
+            data['_metrics_handler'] = handler_name(args[0])
+            data['_metrics_started'] = time.perf_counter()
+        elif action.startswith('post_process_') and '_metrics_handler' in data:
+            handler = data['_metrics_handler']
+            HANDLER_SECONDS.observe(time.perf_counter() - data['_metrics_started'], handler=handler)
+            # post_process вызывается из finally: исключение хендлера видно через sys.exc_info()
+            error = sys.exc_info()[1]
+            if error is not None and not isinstance(error, (CancelHandler, SkipHandler)):
+                HANDLER_ERRORS.inc(handler=handler)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """Поднимает локальный HTTP-сервер с /metrics; остановка - await runner.cleanup()"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,177 @@
+import asyncio
+import heapq
+import itertools
+from typing import Any, Awaitable, Callable, Hashable, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from config import OUTBOUND_WORKERS, OUTBOUND_MAX_RETRIES
+from ratelimit import TelegramRateLimiter
+
+# Полосы по убыванию приоритета: сообщения об оплате не ждут рассылку
+LANES = ('payment', 'expiry', 'broadcast')
+
+
+class OutboundStopped(Exception):
+    """Очередь остановлена раньше, чем запрос был выполнен"""
+
+
+class _Job:
+    __slots__ = ('lane', 'chat_id', 'method', 'args', 'kwargs', 'key', 'future', 'attempts')
+
+    def __init__(self, lane: int, chat_id: Optional[int], method: Callable[..., Awaitable[Any]],
+                 args: tuple, kwargs: dict, key: Optional[Hashable]):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """
+    Единая очередь исходящих запросов к Bot API с полосами приоритета.
+
+    Воркер сначала ждёт место в общем лимите и только потом берёт из очереди
+    самую приоритетную задачу, поэтому запрос из полосы 'payment' уходит
+    следующим же запросом, сколько бы ни стояло в 'broadcast'. RetryAfter
+    ставит на паузу весь лимитер, а задача возвращается на своё место в очереди.
+
+    Задачи с одинаковым coalesce_key, ещё не взятые в работу, склеиваются:
+    выполняется последняя версия аргументов, результат получают все вызвавшие.
+    """
+
+    def __init__(self, bot: Bot, limiter: TelegramRateLimiter, workers: int = OUTBOUND_WORKERS,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.bot = bot
+        self.limiter = limiter
+        self.workers = workers
+        self.max_retries = max_retries
+        self._heap = []  # (полоса, порядковый номер, задача)
+        self._seq = itertools.count()
+        self._keyed = {}  # coalesce_key -> задача в очереди
+        self._ready = asyncio.Condition()
+        self._claimed = 0  # воркеры, которые уже ждут лимит под задачу из очереди
+        self._tasks = []
+        self.depth = dict.fromkeys(LANES, 0)
+        self.sent = dict.fromkeys(LANES, 0)
+        self.failed = dict.fromkeys(LANES, 0)
+        self.retried = dict.fromkeys(LANES, 0)
+        self.coalesced = dict.fromkeys(LANES, 0)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Ожидающие call() получают ошибку, а не висят до конца процесса
+        for _, _, job in self._heap:
+            if not job.future.done():
+                job.future.set_exception(OutboundStopped("Outbound queue stopped before the request was sent"))
+        self._heap.clear()
+        self._keyed.clear()
+        self.depth = dict.fromkeys(LANES, 0)
+
+    async def call(self, lane: str, chat_id: Optional[int], method: Callable[..., Awaitable[Any]], /,
+                   *args, coalesce_key: Hashable = None, **kwargs):
+        """
+        Выполняет method(*args, **kwargs) через очередь и возвращает результат.
+        chat_id - чат, на который действует лимит сообщений в чат (None - только общий лимит).
+        """
+        if coalesce_key is not None:
+            job = self._keyed.get(coalesce_key)
+            if job is not None:
+                job.args, job.kwargs = args, kwargs
+                self.coalesced[lane] += 1
+                return await asyncio.shield(job.future)
+
+        job = _Job(LANES.index(lane), chat_id, method, args, kwargs, coalesce_key)
+        if coalesce_key is not None:
+            self._keyed[coalesce_key] = job
+        await self._push(job, next(self._seq))
+        return await asyncio.shield(job.future)
+
+    async def send_message(self, lane: str, chat_id: int, text: str, /, **kwargs):
+        return await self.call(lane, chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    async def _push(self, job: _Job, seq: int):
+        async with self._ready:
+            heapq.heappush(self._heap, (job.lane, seq, job))
+            self.depth[LANES[job.lane]] += 1
+            self._ready.notify()
+
+    async def _next_job(self) -> Optional[Tuple[_Job, int]]:
+        async with self._ready:
+            # Ждём лимит только под реально ожидающие задачи, чтобы не тратить его впустую
+            await self._ready.wait_for(lambda: len(self._heap) > self._claimed)
+            self._claimed += 1
+        try:
+            await self.limiter.acquire_global()
+        finally:
+            self._claimed -= 1
+        if not self._heap:
+            return None
+        lane, seq, job = heapq.heappop(self._heap)
+        self.depth[LANES[lane]] -= 1
+        if job.key is not None and self._keyed.get(job.key) is job:
+            del self._keyed[job.key]
+        job.attempts += 1
+        return job, seq
+
+    async def _worker(self):
+        while True:
+            picked = await self._next_job()
+            if picked is None:
+                continue
+            job, seq = picked
+            if job.future.done():
+                continue
+            try:
+                await self._run_job(job, seq)
+            except asyncio.CancelledError:
+                # Остановка посреди запроса: задача уже не в очереди, её ответ не придёт
+                if not job.future.done():
+                    job.future.set_exception(OutboundStopped("Outbound queue stopped during the request"))
+                raise
+
+    async def _run_job(self, job: _Job, seq: int):
+        lane = LANES[job.lane]
+        try:
+            if job.chat_id is not None:
+                await self.limiter.acquire_chat(job.chat_id)
+            result = await job.method(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            self.limiter.pause(e.timeout)
+            if job.attempts <= self.max_retries:
+                self.retried[lane] += 1
+                # Возвращаем задачу на прежнее место в своей полосе
+                await self._push(job, seq)
+                return
+            self.failed[lane] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            self.failed[lane] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent[lane] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            'depth': dict(self.depth),
+            'sent': dict(self.sent),
+            'failed': dict(self.failed),
+            'retried': dict(self.retried),
+            'coalesced': dict(self.coalesced),
+        }
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE
+
+
+class TokenBucket:
+    """
+    Ведро токенов с резервированием: acquire() сразу списывает токен
+    (баланс может уйти в минус) и спит ровно столько, сколько нужно,
+    чтобы этот токен накопился. Блокировки не нужны, порядок - FIFO.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Списывает токен и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class TelegramRateLimiter:
+    """
+    Лимиты Bot API: общий поток сообщений бота и отдельный лимит на каждый чат.
+    После RetryAfter все отправки ставятся на паузу через pause().
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._paused_until = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire_chat(self, chat_id: int):
+        await self._chat_bucket(chat_id).acquire()
+
+    async def acquire_global(self):
+        """Ждёт конца паузы после RetryAfter и место в общем лимите"""
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        await self.global_bucket.acquire()
+
+    async def acquire(self, chat_id: int = None):
+        """Ждёт права на запрос; без chat_id действует только общий лимит"""
+        if chat_id is not None:
+            await self.acquire_chat(chat_id)
+        await self.acquire_global()
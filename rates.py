@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from decimal import Decimal, ROUND_UP
+
+from config import RATES_TTL, RATES_REFRESH_INTERVAL, RATES_MAX_AGE
+from crypto_pay import CryptoPayAPI, CryptoPayError
+from logs import start_background
+
+# Валюта, в которой заданы цены в SUBSCRIPTION_SETTINGS
+PRICE_CURRENCY = 'RUB'
+
+# Точность суммы, если getCurrencies не вернул decimals для актива
+DEFAULT_DECIMALS = 8
+
+logger = logging.getLogger('bot_logger')
+
+
+class RatesUnavailable(Exception):
+    """Нет достаточно свежего курса для пересчёта цены"""
+
+
+class ExchangeRates:
+    """
+    Кэш курсов Crypto Pay (getExchangeRates + getCurrencies).
+
+    Курсы обновляются в фоне каждые RATES_REFRESH_INTERVAL секунд и
+    пересчёт цены идёт по словарю в памяти. Если данные старше RATES_TTL,
+    отдаются кэшированные и запускается фоновое обновление
+    (stale-while-revalidate). Старше RATES_MAX_AGE курсами не пользуемся.
+    """
+
+    def __init__(self, api: CryptoPayAPI, ttl: float = RATES_TTL,
+                 refresh_interval: float = RATES_REFRESH_INTERVAL, max_age: float = RATES_MAX_AGE):
+        self.api = api
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self._rates = {}  # (source, target) -> Decimal
+        self._decimals = {}  # код актива -> знаков после запятой
+        self._updated = 0.0
+        self._refreshing = None
+        self._task = None
+
+    async def refresh(self):
+        rates = await self.api.get_exchange_rates()
+        if not rates.get('ok'):
+            raise CryptoPayError(rates.get('error'))
+        self._rates = {
+            (item['source'], item['target']): Decimal(item['rate'])
+            for item in rates['result']
+            if item.get('is_valid', True) and Decimal(item['rate']) > 0
+        }
+
+        currencies = await self.api.get_currencies()
+        if currencies.get('ok'):
+            self._decimals = {
+                item['code']: int(item['decimals'])
+                for item in currencies['result']
+                if item.get('decimals') is not None
+            }
+        self._updated = time.monotonic()
+
+    def _refresh_in_background(self):
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = start_background(self._safe_refresh())
+
+    async def _safe_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning(f"Failed to refresh exchange rates: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, self._refreshing):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._refreshing = None
+
+    async def _run(self):
+        while True:
+            await self._safe_refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def get_rate(self, asset: str, fiat: str = PRICE_CURRENCY) -> Decimal:
+        """Сколько единиц fiat стоит один asset"""
+        if not self._updated:
+            # Холодный старт: ждём первую загрузку один раз
+            try:
+                await self.refresh()
+            except Exception as e:
+                raise RatesUnavailable(f"Failed to load exchange rates: {e}") from e
+        age = time.monotonic() - self._updated
+        if age > self.ttl:
+            self._refresh_in_background()
+        if age > self.max_age:
+            raise RatesUnavailable(f"Exchange rates are {int(age)}s old")
+
+        rate = self._rates.get((asset, fiat))
+        if rate is None:
+            raise RatesUnavailable(f"No {asset}/{fiat} rate")
+        return rate
+
+    async def convert(self, price: float, asset: str, fiat: str = PRICE_CURRENCY) -> Decimal:
+        """Переводит цену из fiat в asset с округлением вверх до точности актива"""
+        rate = await self.get_rate(asset, fiat)
+        step = Decimal(1).scaleb(-self._decimals.get(asset, DEFAULT_DECIMALS))
+        return (Decimal(str(price)) / rate).quantize(step, rounding=ROUND_UP)
@@ -0,0 +1,382 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+from collections import OrderedDict
+from functools import partial
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from config import (
+    BOT_TOKEN, STORAGE_BACKEND, SHARD_WORKERS, SHARD_RESTART_DELAY,
+    USE_WEBHOOK, WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_SECRET,
+    CRYPTO_PAY_WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT
+)
+from crypto_pay import CryptoPayAPI
+from webhooks import check_telegram_secret, read_paid_invoice
+
+# Супервизор и обработчики общаются по локальному TCP строками JSON
+IPC_HOST = '127.0.0.1'
+FRAME_LIMIT = 4 * 1024 * 1024  # Максимальная длина одной строки
+POLL_TIMEOUT = 30  # Таймаут long polling в секундах
+STOP_TIMEOUT = 30  # Сколько секунд ждать, пока обработчики доработают при остановке
+
+logger = logging.getLogger('bot_logger')
+
+WorkerEntry = Callable[[int, int, int], None]
+Hook = Callable[[Dispatcher], Awaitable[None]]
+
+
+def shard_key(update: dict) -> int:
+    """user_id автора обновления; для обновлений без автора - id чата"""
+    for name, value in update.items():
+        if name == 'update_id' or not isinstance(value, dict):
+            continue
+        if value.get('from'):
+            return value['from']['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+def _frame(payload: dict) -> bytes:
+    return json.dumps(payload, ensure_ascii=False).encode() + b'\n'
+
+
+class Supervisor:
+    """
+    Приём обновлений для запуска бота в несколько процессов.
+
+    Supervisor получает обновления (long polling или вебхук) и передаёт их
+    workers процессам-обработчикам: обновление пользователя всегда уходит
+    в процесс user_id % workers, поэтому его FSM и порядок сообщений остаются
+    в одном процессе. Упавший обработчик перезапускается, обновления для него
+    копятся в очереди. Каждый кадр нумеруется, обработчик подтверждает его
+    сразу после чтения; кадры, которые упавший процесс не успел прочитать,
+    отправляются перезапущенному заново. Обновление, которое процесс уже
+    прочитал, но не успел обработать, теряется вместе с ним.
+    События об изменении подписок, которые присылает один обработчик,
+    пересылаются остальным.
+
+    Фоновые задачи (окончание подписок, сверка инвойсов) выполняет только
+    обработчик 0; рассылку докачивает тот обработчик, который её начал. Запись в SQLite из разных процессов
+    упорядочивает блокировка базы (BEGIN IMMEDIATE + busy_timeout).
+    """
+
+    def __init__(self, worker: WorkerEntry, workers: int = SHARD_WORKERS,
+                 restart_delay: float = SHARD_RESTART_DELAY):
+        if STORAGE_BACKEND == 'memory':
+            # Админ подтверждает оплату из своего процесса, а данные FSM лежат в процессе плательщика
+            raise ValueError("SHARD_WORKERS > 1 requires STORAGE_BACKEND 'sqlite' or 'redis'")
+        self.worker = worker
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.bot = Bot(token=BOT_TOKEN)
+        self.crypto_pay = CryptoPayAPI()
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = [None] * workers
+        self._writers = [None] * workers
+        self._queues = []
+        self._connected = []
+        self._unacked = [OrderedDict() for _ in range(workers)]  # номер кадра -> кадр
+        self._seq = 0
+        self._port = None
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            pass
+
+    async def _main(self):
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._connected = [asyncio.Event() for _ in range(self.workers)]
+        server = await asyncio.start_server(self._accept, IPC_HOST, 0, limit=FRAME_LIMIT)
+        self._port = server.sockets[0].getsockname()[1]
+        main = asyncio.current_task()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main.cancel)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows
+
+        for index in range(self.workers):
+            self._spawn(index)
+        tasks = [asyncio.create_task(self._pump(index)) for index in range(self.workers)]
+        monitor = asyncio.create_task(self._monitor())
+        logger.info(f"Supervisor started {self.workers} workers")
+        try:
+            if USE_WEBHOOK:
+                await self._serve_webhook()
+            else:
+                await self._poll()
+        finally:
+            monitor.cancel()
+            # Пустая очередь и закрытое соединение - сигнал обработчику доработать и выйти
+            for queue in self._queues:
+                queue.put_nowait(None)
+            await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(
+                loop.run_in_executor(None, process.join, STOP_TIMEOUT) for process in self._processes
+            ))
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+            server.close()
+            await (await self.bot.get_session()).close()
+            await self.crypto_pay.close()
+            logger.info("Supervisor stopped")
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=self.worker, args=(index, self.workers, self._port), name=f'bot-shard-{index}'
+        )
+        process.start()
+        self._processes[index] = process
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self._spawn(index)
+
+    def dispatch(self, update: dict):
+        self._queues[shard_key(update) % self.workers].put_nowait({'update': update})
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        index = json.loads(await reader.readline())['hello']
+        self._writers[index] = writer
+        self._connected[index].set()
+        # Будим насос: неподтверждённые кадры уйдут новому процессу, даже если очередь пуста
+        self._queues[index].put_nowait({})
+        logger.info(f"Worker {index} connected")
+        unacked = self._unacked[index]
+        try:
+            while line := await reader.readline():
+                frame = json.loads(line)
+                if 'ack' in frame:
+                    while unacked and next(iter(unacked)) <= frame['ack']:
+                        unacked.popitem(last=False)
+                    continue
+                # События обработчика (изменения подписок) нужны всем остальным
+                for other, queue in enumerate(self._queues):
+                    if other != index:
+                        queue.put_nowait(frame)
+        except ConnectionError:
+            pass
+        finally:
+            if self._writers[index] is writer:
+                self._writers[index] = None
+                self._connected[index].clear()
+            writer.close()
+
+    async def _pump(self, index: int):
+        """Передаёт очередь обработчику index, дожидаясь его (пере)подключения"""
+        queue = self._queues[index]
+        unacked = self._unacked[index]
+        writer = None
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                if self._writers[index] is not None:
+                    self._writers[index].close()
+                return
+            # Пустой кадр только будит насос после переподключения
+            if frame:
+                self._seq += 1
+                frame = dict(frame, seq=self._seq)
+                # Запись в сокет упавшего процесса не всегда даёт ошибку,
+                # поэтому кадр хранится до подтверждения
+                unacked[self._seq] = frame
+            while True:
+                await self._connected[index].wait()
+                current = self._writers[index]
+                try:
+                    if current is not writer:
+                        # Новый процесс: сначала всё, что не подтвердил прежний (вместе с этим кадром)
+                        writer = current
+                        current.write(b''.join(_frame(pending) for pending in unacked.values()))
+                    elif frame:
+                        current.write(_frame(frame))
+                    await current.drain()
+                    break
+                except ConnectionError:
+                    # Обработчик упал - ждём перезапущенный процесс
+                    if self._writers[index] is current:
+                        self._writers[index] = None
+                        self._connected[index].clear()
+
+    async def _poll(self):
+        # Как skip_updates=True у обычного запуска
+        await self.bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        while True:
+            try:
+                with self.bot.request_timeout(aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)):
+                    updates = await self.bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Error getting updates: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.dispatch(update.to_python())
+
+    async def _serve_webhook(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self._telegram_webhook)
+        app.router.add_post(CRYPTO_PAY_WEBHOOK_PATH, self._crypto_pay_webhook)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        await self.bot.set_webhook(
+            WEBHOOK_HOST + WEBHOOK_PATH,
+            drop_pending_updates=True,
+            secret_token=WEBHOOK_SECRET or None
+        )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def _telegram_webhook(self, request: web.Request) -> web.Response:
+        check_telegram_secret(request)
+        self.dispatch(await request.json())
+        return web.Response(text='ok')
+
+    async def _crypto_pay_webhook(self, request: web.Request) -> web.Response:
+        invoice = await read_paid_invoice(request, self.crypto_pay)
+        if invoice is not None:
+            # Сверку инвойсов ведёт обработчик 0; если вебхук потеряется, инвойс найдёт опрос
+            self._queues[0].put_nowait({'crypto_pay': invoice})
+        return web.Response(text='ok')
+
+
+class ShardLink:
+    """Связь процесса-обработчика с супервизором: номер процесса и обмен событиями"""
+
+    def __init__(self, index: int, count: int, port: int):
+        self.index = index
+        self.count = count
+        self.port = port
+        self.reader = None
+        self._writer = None
+        self._handlers = {}
+        self._applying = False
+
+    @property
+    def primary(self) -> bool:
+        """Процесс, который выполняет фоновые задачи"""
+        return self.index == 0
+
+    async def connect(self):
+        self.reader, self._writer = await asyncio.open_connection(IPC_HOST, self.port, limit=FRAME_LIMIT)
+        self._writer.write(_frame({'hello': self.index}))
+        await self._writer.drain()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def on(self, event: str, handler: Callable[..., None]):
+        self._handlers[event] = handler
+
+    def ack(self, seq: int):
+        """Подтверждает супервизору, что кадр seq прочитан"""
+        if self._writer is not None:
+            self._writer.write(_frame({'ack': seq}))
+
+    def publish(self, event: str, *args):
+        """Отправляет событие остальным процессам"""
+        # Событие, пришедшее от другого процесса, дальше не пересылаем
+        if self._applying or self._writer is None:
+            return
+        self._writer.write(_frame({'event': event, 'args': args}))
+
+    def apply(self, event: str, args: list):
+        handler = self._handlers.get(event)
+        if handler is None:
+            return
+        self._applying = True
+        try:
+            handler(*args)
+        finally:
+            self._applying = False
+
+
+class KeyedSerializer:
+    """Выполняет задачи с одинаковым ключом строго по очереди, с разными - параллельно"""
+
+    def __init__(self):
+        self._tails = {}
+
+    def submit(self, key, coro: Awaitable):
+        task = asyncio.create_task(self._run(self._tails.get(key), coro))
+        self._tails[key] = task
+        task.add_done_callback(partial(self._done, key))
+
+    async def _run(self, previous: Optional[asyncio.Task], coro: Awaitable):
+        if previous is not None:
+            # Ошибка предыдущей задачи не отменяет следующую
+            await asyncio.wait([previous])
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"Error processing update: {e}", exc_info=True)
+
+    def _done(self, key, task: asyncio.Task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+def run_worker(dispatcher: Dispatcher, link: ShardLink, on_startup: Hook, on_shutdown: Hook):
+    """Цикл процесса-обработчика; возвращается, когда супервизор закрывает соединение"""
+    # Ctrl+C получает вся группа процессов, а останавливать обработчики должен супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_worker(dispatcher, link, on_startup, on_shutdown))
+
+
+async def _serve_worker(dispatcher: Dispatcher, link: ShardLink, on_startup: Hook, on_shutdown: Hook):
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    dispatcher["shard"] = link
+    await link.connect()
+    await on_startup(dispatcher)
+    logger.info(f"Worker {link.index} of {link.count} started")
+
+    updates = KeyedSerializer()
+    try:
+        while line := await link.reader.readline():
+            frame = json.loads(line)
+            if 'seq' in frame:
+                link.ack(frame['seq'])
+            if 'update' in frame:
+                update = frame['update']
+                updates.submit(shard_key(update), dispatcher.process_updates([types.Update(**update)]))
+            elif 'event' in frame:
+                link.apply(frame['event'], frame['args'])
+            elif 'crypto_pay' in frame:
+                updates.submit(('crypto_pay', frame['crypto_pay']['invoice_id']),
+                               dispatcher['invoices'].handle_paid(frame['crypto_pay']))
+    except ConnectionError:
+        logger.warning(f"Worker {link.index} lost connection to supervisor")
+    finally:
+        await updates.drain()
+        link.close()
+        await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        await (await dispatcher.bot.get_session()).close()
+        logger.info(f"Worker {link.index} stopped")
@@ -0,0 +1,324 @@
+import abc
+import asyncio
+import json
+import logging
+import time
+import typing
+from urllib.parse import urlparse
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from config import STORAGE_BACKEND, REDIS_URL, STORAGE_FLUSH_INTERVAL, FSM_TTL
+
+logger = logging.getLogger('bot_logger')
+
+
+class KeyValueStore(abc.ABC):
+    """
+    Хранилище строк с TTL, общее для нескольких процессов бота.
+
+    Записи копятся в памяти и уходят в бэкенд пачкой раз в flush_interval
+    секунд (и при закрытии). Чтение сначала смотрит в этот буфер, поэтому
+    процесс всегда видит собственные записи.
+    """
+
+    def __init__(self, flush_interval: float = STORAGE_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {}  # ключ -> (значение или None для удаления, expires_at или None)
+        self._task = None
+
+    async def open(self, pool=None):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def get(self, key: str) -> typing.Optional[str]:
+        if key in self._pending:
+            value, expires_at = self._pending[key]
+            if value is None or (expires_at is not None and expires_at <= time.time()):
+                return None
+            return value
+        return await self._get(key)
+
+    async def set(self, key: str, value: str, ttl: typing.Optional[float] = None):
+        self._pending[key] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, key: str):
+        self._pending[key] = (None, None)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        items, self._pending = self._pending, {}
+        try:
+            await self._write(items)
+        except Exception:
+            # Возвращаем записи, не затирая более свежие
+            for key, item in items.items():
+                self._pending.setdefault(key, item)
+            raise
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing {type(self).__name__}: {e}", exc_info=True)
+
+    @abc.abstractmethod
+    async def _get(self, key: str) -> typing.Optional[str]:
+        """Читает значение из бэкенда; None, если ключа нет или он просрочен"""
+
+    @abc.abstractmethod
+    async def _write(self, items: dict):
+        """Записывает пачку {ключ: (значение или None, expires_at)} в бэкенд"""
+
+
+class SQLiteStore(KeyValueStore):
+    """Хранилище в таблице kv_store основной базы бота"""
+
+    # Как часто (в сбросах) удалять просроченные записи
+    PURGE_EVERY = 300
+
+    def __init__(self, flush_interval: float = STORAGE_FLUSH_INTERVAL):
+        super().__init__(flush_interval)
+        self.pool = None
+        self._flushes = 0
+
+    async def open(self, pool=None):
+        self.pool = pool
+        await super().open()
+
+    async def _get(self, key: str) -> typing.Optional[str]:
+        async with self.pool.read() as db:
+            async with db.execute(
+                'SELECT value FROM kv_store WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (key, time.time())
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    async def _write(self, items: dict):
+        upserts = [(key, value, expires_at) for key, (value, expires_at) in items.items() if value is not None]
+        deletes = [(key,) for key, (value, _) in items.items() if value is None]
+        self._flushes += 1
+        async with self.pool.write() as db:
+            if upserts:
+                await db.executemany('''
+                    INSERT INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                ''', upserts)
+            if deletes:
+                await db.executemany('DELETE FROM kv_store WHERE key = ?', deletes)
+            if self._flushes % self.PURGE_EVERY == 0:
+                await db.execute('DELETE FROM kv_store WHERE expires_at <= ?', (time.time(),))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisStore(KeyValueStore):
+    """
+    Хранилище в Redis (или любом сервере с протоколом RESP).
+    Минимальный клиент без зависимостей: GET, SET с PX, DEL; пачка записей
+    отправляется одним пайплайном.
+    """
+
+    def __init__(self, url: str = REDIS_URL, flush_interval: float = STORAGE_FLUSH_INTERVAL):
+        super().__init__(flush_interval)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def open(self, pool=None):
+        async with self._lock:
+            await self._connect()
+        await super().open()
+
+    async def close(self):
+        await super().close()
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+    @staticmethod
+    def _encode(command: tuple) -> bytes:
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            return RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _pipeline(self, commands: list) -> list:
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                await self._connect()
+            try:
+                self._writer.write(b''.join(self._encode(command) for command in commands))
+                await self._writer.drain()
+                replies = [await self._read_reply() for _ in commands]
+            except BaseException:
+                # Обрыв, отмена или любая другая ошибка посреди пайплайна: непрочитанные
+                # ответы остались бы в сокете и достались следующей команде.
+                # Закрываем соединение и переподключимся при следующем запросе
+                self._close()
+                raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def _connect(self):
+        """Открывает соединение; вызывается под self._lock"""
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        try:
+            for command in setup:
+                self._writer.write(self._encode(command))
+                await self._writer.drain()
+                reply = await self._read_reply()
+                if isinstance(reply, RedisError):
+                    raise reply
+        except BaseException:
+            # Соединение без AUTH/SELECT использовать нельзя
+            self._close()
+            raise
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _get(self, key: str) -> typing.Optional[str]:
+        return (await self._pipeline([('GET', key)]))[0]
+
+    async def _write(self, items: dict):
+        now = time.time()
+        commands = []
+        for key, (value, expires_at) in items.items():
+            if value is None or (expires_at is not None and expires_at <= now):
+                commands.append(('DEL', key))
+            elif expires_at is not None:
+                commands.append(('SET', key, value, 'PX', max(1, int((expires_at - now) * 1000))))
+            else:
+                commands.append(('SET', key, value))
+        await self._pipeline(commands)
+
+
+def create_store(backend: str = STORAGE_BACKEND) -> typing.Optional[KeyValueStore]:
+    """Создаёт общее хранилище; None для режима 'memory' (всё в памяти процесса)"""
+    if backend == 'memory':
+        return None
+    if backend == 'sqlite':
+        return SQLiteStore()
+    if backend == 'redis':
+        return RedisStore()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class KVStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх KeyValueStore; записи живут ttl секунд"""
+
+    def __init__(self, store: KeyValueStore, ttl: float = FSM_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    @classmethod
+    def _key(cls, chat, user, part: str) -> str:
+        chat, user = cls.check_address(chat=chat, user=user)
+        return f"fsm:{chat}:{user}:{part}"
+
+    async def _get_json(self, key: str) -> dict:
+        raw = await self.store.get(key)
+        return json.loads(raw) if raw else {}
+
+    async def _set_json(self, key: str, value: typing.Optional[dict]):
+        if value:
+            await self.store.set(key, json.dumps(value), self.ttl)
+        else:
+            await self.store.delete(key)
+
+    async def close(self):
+        await self.store.close()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None) -> typing.Optional[str]:
+        state = await self.store.get(self._key(chat, user, 'state'))
+        return state if state is not None else self.resolve_state(default)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user, 'state')
+        state = self.resolve_state(state)
+        if state is None:
+            await self.store.delete(key)
+        else:
+            await self.store.set(key, state, self.ttl)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> typing.Dict:
+        return await self._get_json(self._key(chat, user, 'data')) or (default or {})
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self._set_json(self._key(chat, user, 'data'), data)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key = self._key(chat, user, 'data')
+        current = await self._get_json(key)
+        current.update(data or {}, **kwargs)
+        await self._set_json(key, current)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> typing.Dict:
+        return await self._get_json(self._key(chat, user, 'bucket')) or (default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self._set_json(self._key(chat, user, 'bucket'), bucket)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key = self._key(chat, user, 'bucket')
+        current = await self._get_json(key)
+        current.update(bucket or {}, **kwargs)
+        await self._set_json(key, current)
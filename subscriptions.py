@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Optional
+
+from access import ActiveSubscribers
+from config import SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL
+from db import ConnectionPool, get_subscription_rows, describe_subscriptions
+
+
+class SubscriptionCache:
+    """
+    Кэш подписок пользователей перед get_user_subscriptions (LRU + TTL).
+
+    Хранятся строки из базы без статуса: статус и оставшиеся дни считаются
+    при каждом чтении, поэтому истёкшая подписка не покажется активной
+    даже из кэша. Одновременные промахи по одному пользователю идут в базу
+    одним запросом.
+
+    Быструю проверку is_active для заявок в канал кэш отвечает из
+    ActiveSubscribers - карты всех действующих подписчиков, загруженной
+    при запуске: заявку подают и те, кого нет в LRU. Обе части обновляются
+    вместе: update - слушатель add_subscription, expire - окончание подписки.
+    """
+
+    def __init__(self, pool: ConnectionPool, max_users: int = SUBSCRIPTION_CACHE_SIZE,
+                 ttl: float = SUBSCRIPTION_CACHE_TTL):
+        self.pool = pool
+        self.active = ActiveSubscribers(pool)
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # user_id -> (время загрузки, строки)
+        self._loading = {}  # user_id -> задача загрузки
+
+    async def _rows(self, user_id: int) -> list:
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._loading[user_id] = asyncio.ensure_future(get_subscription_rows(self.pool, user_id))
+            task.add_done_callback(partial(self._loaded, user_id))
+        return await asyncio.shield(task)
+
+    def _loaded(self, user_id: int, task: asyncio.Future):
+        if self._loading.get(user_id) is not task:
+            # Пока шёл запрос, подписку изменили - результат мог устареть
+            return
+        del self._loading[user_id]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[user_id] = (time.monotonic(), task.result())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    async def get(self, user_id: int) -> list:
+        """То же, что get_user_subscriptions, но через кэш"""
+        return describe_subscriptions(await self._rows(user_id))
+
+    async def load(self):
+        """Загружает действующих подписчиков для is_active"""
+        await self.active.load()
+
+    def is_active(self, user_id: int) -> bool:
+        """Есть ли у пользователя действующая подписка; без обращения к базе"""
+        return self.active.is_active(user_id)
+
+    def update(self, user_id: int, end_date: Optional[int]):
+        """Слушатель pool.add_subscription_listener"""
+        self.invalidate(user_id)
+        self.active.update(user_id, end_date)
+
+    def expire(self, user_id: int, end_date: int):
+        """Подписка закончилась (сообщает планировщик окончаний)"""
+        self.invalidate(user_id)
+        self.active.expire(user_id, end_date)
+
+    def invalidate(self, user_id: int, end_date: Optional[int] = None):
+        """Сбрасывает запись пользователя в LRU"""
+        self._entries.pop(user_id, None)
+        self._loading.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# bot.py создаёт Bot при импорте, а aiogram проверяет формат токена
+config.BOT_TOKEN = '123456:AAEhBP0av28ZU8ZJZ1zs7o2rNv9oLX8xyzQ'
@@ -0,0 +1,84 @@
+import inspect
+
+import pytest
+
+from bot import (
+    callback_router, confirm_payment, process_crypto_currency_selected,
+    process_crypto_payment, process_duration_selection, process_p2p, process_tg_stars
+)
+from callbacks import LEGACY_PREFIXES, SEPARATOR, pack, unpack
+from keyboards import iter_callback_data
+
+# Кнопки старого формата "action_arg1_arg2" из уже отправленных сообщений.
+# crypto_pay_ и crypto_ раньше пересекались по префиксу
+LEGACY_BUTTONS = [
+    ('crypto_pay_TON_month', process_crypto_currency_selected, ('TON', 'month')),
+    ('crypto_pay_USDT_forever', process_crypto_currency_selected, ('USDT', 'forever')),
+    ('crypto_month', process_crypto_payment, ('month',)),
+    ('tg_stars_year', process_tg_stars, ('year',)),
+    ('duration_month', process_duration_selection, ('month',)),
+    ('p2p_forever', process_p2p, ('forever',)),
+    ('confirm_123456', confirm_payment, ('123456',)),
+]
+
+
+def accepts(callback, args) -> bool:
+    try:
+        inspect.signature(callback).bind(None, None, *args)
+    except TypeError:
+        return False
+    return True
+
+
+def claimants(data: str) -> list:
+    """
+    Все разборы data, которые подходят к какому-нибудь обработчику. Каждое
+    действие и каждый старый префикс проверяются отдельно, без выбора, который делает unpack
+    """
+    found = []
+    for action, callback in callback_router._handlers.items():
+        if data == action or data.startswith(action + SEPARATOR):
+            args = tuple(data.split(SEPARATOR)[1:])
+            if accepts(callback, args):
+                found.append((action, callback, args))
+    if SEPARATOR not in data:
+        for prefix in LEGACY_PREFIXES:
+            callback = callback_router._handlers.get(prefix)
+            if callback is not None and data.startswith(prefix + '_'):
+                args = tuple(data[len(prefix) + 1:].split('_'))
+                if accepts(callback, args):
+                    found.append((prefix, callback, args))
+    return found
+
+
+@pytest.mark.parametrize('data', sorted(set(iter_callback_data())))
+def test_every_button_resolves_to_one_handler(data):
+    callback, args = callback_router.resolve(data)
+    assert callback is not None
+    assert [(found, found_args) for _, found, found_args in claimants(data)] == [(callback, args)]
+
+
+@pytest.mark.parametrize('data, expected, args', LEGACY_BUTTONS)
+def test_legacy_buttons(data, expected, args):
+    callback, parsed = callback_router.resolve(data)
+    assert callback is expected
+    assert parsed == args
+    # crypto_pay_* не должен подходить и к crypto
+    assert [(found, found_args) for _, found, found_args in claimants(data)] == [(expected, args)]
+
+
+def test_validate_accepts_all_buttons():
+    callback_router.validate(iter_callback_data())
+
+
+def test_validate_rejects_unknown_and_mismatched_buttons():
+    with pytest.raises(ValueError):
+        callback_router.validate(['unknown:1'])
+    with pytest.raises(ValueError):
+        callback_router.validate([pack('crypto_pay', 'TON')])
+
+
+def test_pack_limit():
+    assert unpack(pack('crypto_pay', 'TON', 'month')) == ('crypto_pay', ('TON', 'month'))
+    with pytest.raises(ValueError):
+        pack('confirm', 'x' * 64)
@@ -0,0 +1,365 @@
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import Iterator, Optional
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import MessageNotModified, TelegramAPIError
+
+from config import TRANSFER_BATCH_SIZE, TRANSFER_PROGRESS_INTERVAL
+from db import (
+    TRANSFER_COLUMNS, TRANSFER_NULLABLE, TRANSFER_REQUIRED, ConnectionPool, import_rows, iter_table_rows
+)
+from logs import start_background
+from outbound import OutboundQueue
+
+FORMATS = ('csv', 'jsonl')
+
+# Ограничения Bot API: бот отправляет файлы до 50 МБ, а скачивает - до 20 МБ
+UPLOAD_LIMIT = 50 * 1024 * 1024
+DOWNLOAD_LIMIT = 20 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 300
+
+# Сколько конфликтующих payment_id перечислять в отчёте
+CONFLICTS_SHOWN = 20
+
+# Имя загружаемого файла: таблица, затем что угодно (например, "users (1).csv"), формат и .gz
+FILE_NAME = re.compile(rf"^({'|'.join(TRANSFER_COLUMNS)})\b.*\.({'|'.join(FORMATS)})(\.gz)?$")
+
+logger = logging.getLogger('bot_logger')
+
+
+class TransferError(Exception):
+    """Ошибка в загружаемом файле; текст показывается админу"""
+
+
+class TransferRun:
+    """Прогресс одной выгрузки или загрузки для сообщения админу"""
+
+    def __init__(self, kind: str, table: str, chat_id: int, progress_message_id: int):
+        self.kind = kind
+        self.table = table
+        self.chat_id = chat_id
+        self.progress_message_id = progress_message_id
+        self.rows = 0
+        self.skipped = 0
+        self.conflicts = []
+        self.started = time.monotonic()
+
+    def progress_text(self, finished: bool = False, error: Optional[str] = None) -> str:
+        action = "Выгрузка" if self.kind == 'export' else "Загрузка"
+        if error is not None:
+            return f"{action} {self.table} прервана: {error}\n{self.counts_text()}"
+        if finished:
+            elapsed = time.monotonic() - self.started
+            return f"{action} {self.table} завершена за {elapsed:.1f} с\n{self.counts_text()}"
+        return f"{action} {self.table}...\n{self.counts_text()}"
+
+    def counts_text(self) -> str:
+        done = "Выгружено" if self.kind == 'export' else "Загружено"
+        text = f"{done} строк: {self.rows}"
+        if self.skipped:
+            text += f"\nПропущено (уже загружены): {self.skipped}"
+        if self.conflicts:
+            shown = ', '.join(map(str, self.conflicts[:CONFLICTS_SHOWN]))
+            if len(self.conflicts) > CONFLICTS_SHOWN:
+                shown += f" и ещё {len(self.conflicts) - CONFLICTS_SHOWN}"
+            text += f"\nНе загружены, payment_id занят другим платежом: {shown}"
+        return text
+
+
+def parse_file_name(file_name: str):
+    """(таблица, формат, сжат ли файл) по имени файла или None"""
+    match = FILE_NAME.match((file_name or '').lower())
+    if match is None:
+        return None
+    return match.group(1), match.group(2), match.group(3) is not None
+
+
+def _check_columns(names, table: str, line: int) -> list:
+    """Проверяет столбцы файла; возвращает их в порядке TRANSFER_COLUMNS"""
+    known = [name for name, _ in TRANSFER_COLUMNS[table]]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise TransferError(f"строка {line}: неизвестные столбцы {', '.join(unknown)}")
+    missing = [name for name in TRANSFER_REQUIRED[table] if name not in names]
+    if missing:
+        raise TransferError(f"строка {line}: нет обязательных столбцов {', '.join(missing)}")
+    return [name for name in known if name in names]
+
+
+def _convert_batch(table: str, columns: list, raw: list, lines: list) -> list:
+    """
+    Приводит типы порции строк (списки значений в порядке columns).
+    Преобразование идёт по столбцам - так заметно быстрее, чем по ячейкам.
+    """
+    kinds = dict(TRANSFER_COLUMNS[table])
+    required = set(TRANSFER_REQUIRED[table]) - TRANSFER_NULLABLE
+    converted = []
+    for name, values in zip(columns, zip(*raw)):
+        kind = kinds[name]
+        try:
+            converted.append([None if value is None or value == '' else kind(value) for value in values])
+        except (TypeError, ValueError):
+            for value, line in zip(values, lines):
+                try:
+                    None if value is None or value == '' else kind(value)
+                except (TypeError, ValueError):
+                    raise TransferError(f"строка {line}, столбец {name}: неверное значение {value!r}")
+        if name in required and None in converted[-1]:
+            line = lines[converted[-1].index(None)]
+            raise TransferError(f"строка {line}, столбец {name}: пустое значение")
+    return list(zip(*converted))
+
+
+def read_columns(path: str, table: str, fmt: str, compressed: bool) -> list:
+    """Столбцы файла в порядке TRANSFER_COLUMNS: заголовок CSV или ключи первого объекта JSONL"""
+    opener = gzip.open if compressed else open
+    with opener(path, 'rt', encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            header = next(csv.reader(f), None)
+            if header is None:
+                raise TransferError("файл пуст")
+            return _check_columns([name.strip() for name in header], table, 1)
+        for line, text in enumerate(f, 1):
+            if text.strip():
+                return _check_columns(_parse_object(text, line), table, line)
+    raise TransferError("файл пуст")
+
+
+def _parse_object(text: str, line: int) -> dict:
+    try:
+        item = json.loads(text)
+    except ValueError:
+        raise TransferError(f"строка {line}: неверный JSON")
+    if not isinstance(item, dict):
+        raise TransferError(f"строка {line}: ожидается объект JSON")
+    return item
+
+
+def read_batches(path: str, table: str, fmt: str, compressed: bool, columns: list,
+                 batch_size: int = TRANSFER_BATCH_SIZE) -> Iterator[list]:
+    """
+    Читает файл порциями строк в порядке columns (из read_columns) с приведением типов.
+    Пустые значения считаются NULL; в JSONL у всех объектов должны быть одни и те же столбцы.
+    Генератор блокирующий: вызывается по одной порции в пуле потоков.
+    """
+    opener = gzip.open if compressed else open
+    raw, lines = [], []
+    # utf-8-sig: CSV, сохранённый из Excel, начинается с BOM
+    with opener(path, 'rt', encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.reader(f)
+            header = [name.strip() for name in next(reader)]
+            positions = [header.index(name) for name in columns]
+            in_order = header == columns
+            for values in reader:
+                if not values:
+                    continue
+                if len(values) != len(header):
+                    raise TransferError(f"строка {reader.line_num}: {len(values)} значений вместо {len(header)}")
+                raw.append(values if in_order else [values[position] for position in positions])
+                lines.append(reader.line_num)
+                if len(raw) >= batch_size:
+                    yield _convert_batch(table, columns, raw, lines)
+                    raw, lines = [], []
+        else:
+            expected = set(columns)
+            for line, text in enumerate(f, 1):
+                if not text.strip():
+                    continue
+                item = _parse_object(text, line)
+                # Пропущенный ключ затёр бы значение в базе, поэтому набор столбцов фиксирован
+                if item.keys() != expected:
+                    raise TransferError(f"строка {line}: столбцы отличаются от первой строки")
+                raw.append([item[name] for name in columns])
+                lines.append(line)
+                if len(raw) >= batch_size:
+                    yield _convert_batch(table, columns, raw, lines)
+                    raw, lines = [], []
+    if raw:
+        yield _convert_batch(table, columns, raw, lines)
+
+
+class _FileWriter:
+    """Запись строк таблицы в CSV или JSONL; методы блокирующие, вызываются в пуле потоков"""
+
+    def __init__(self, path: str, table: str, fmt: str):
+        self.columns = [name for name, _ in TRANSFER_COLUMNS[table]]
+        self.fmt = fmt
+        self._file = open(path, 'w', encoding='utf-8', newline='')
+        if fmt == 'csv':
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(self.columns)
+
+    def write(self, rows: list):
+        if self.fmt == 'csv':
+            self._csv.writerows(rows)
+        else:
+            self._file.writelines(
+                json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + '\n' for row in rows
+            )
+
+    def close(self):
+        self._file.close()
+
+
+def _compress(path: str) -> str:
+    # Уровень 6 сжимает почти так же, как 9, но в разы быстрее
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return path + '.gz'
+
+
+class DataTransfer:
+    """
+    Выгрузка таблиц в CSV/JSONL и загрузка из них для админа.
+
+    Выгрузка читает таблицу страницами по ключу и пишет файл порциями,
+    загрузка читает файл порциями и пишет каждую одной транзакцией
+    (executemany), поэтому память не зависит от размера таблицы, а между
+    транзакциями бот продолжает обслуживать пользователей. Разбор и запись
+    файлов идут в пуле потоков. Админ видит одно обновляемое сообщение
+    с прогрессом.
+    """
+
+    def __init__(self, bot: Bot, pool: ConnectionPool, outbound: OutboundQueue,
+                 batch_size: int = TRANSFER_BATCH_SIZE, progress_interval: float = TRANSFER_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.pool = pool
+        self.outbound = outbound
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks = set()
+
+    async def export(self, message: types.Message, table: str, fmt: str):
+        """Запускает выгрузку таблицы в фоне; файл придёт документом"""
+        run = await self._start_run('export', table, message)
+        self._spawn(self._run(run, self._export(run, fmt)))
+
+    async def import_document(self, message: types.Message):
+        """Запускает загрузку присланного файла в фоне"""
+        parsed = parse_file_name(message.document.file_name)
+        if parsed is None:
+            await message.answer(
+                f"Имя файла должно начинаться с названия таблицы ({', '.join(TRANSFER_COLUMNS)}) "
+                f"и заканчиваться на .csv или .jsonl (можно сжать в .gz)"
+            )
+            return
+        if (message.document.file_size or 0) > DOWNLOAD_LIMIT:
+            await message.answer("Файл больше 20 МБ: Telegram не даст боту его скачать. Сожмите его в .gz")
+            return
+        table, fmt, compressed = parsed
+        run = await self._start_run('import', table, message)
+        self._spawn(self._run(run, self._import(run, message.document.file_id, fmt, compressed)))
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _start_run(self, kind: str, table: str, message: types.Message) -> TransferRun:
+        run = TransferRun(kind, table, message.chat.id, 0)
+        progress = await message.answer(run.progress_text())
+        run.progress_message_id = progress.message_id
+        return run
+
+    def _spawn(self, coro):
+        task = start_background(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, run: TransferRun, job):
+        reporter = asyncio.create_task(self._report(run))
+        error = None
+        try:
+            with tempfile.TemporaryDirectory(prefix='bot-transfer-') as workdir:
+                await job(workdir)
+        except TransferError as e:
+            error = str(e)
+        except sqlite3.Error as e:
+            # Порции до ошибки уже записаны; повторная загрузка исправленного файла безопасна
+            error = f"ошибка базы: {e}"
+        except Exception as e:
+            logger.error(f"Error in {run.kind} of {run.table}: {e}", exc_info=True)
+            error = "внутренняя ошибка, подробности в логе"
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+        await self._edit_progress(run, finished=True, error=error)
+        logger.info(f"{run.kind.capitalize()} of {run.table} finished: {run.rows} rows"
+                    + (f", {len(run.conflicts)} conflicts" if run.conflicts else "")
+                    + (f", error: {error}" if error else ""))
+
+    def _export(self, run: TransferRun, fmt: str):
+        async def job(workdir: str):
+            loop = asyncio.get_running_loop()
+            path = os.path.join(workdir, f'{run.table}.{fmt}')
+            writer = _FileWriter(path, run.table, fmt)
+            try:
+                async for rows in iter_table_rows(self.pool, run.table, self.batch_size):
+                    await loop.run_in_executor(None, writer.write, rows)
+                    run.rows += len(rows)
+            finally:
+                await loop.run_in_executor(None, writer.close)
+            if os.path.getsize(path) > UPLOAD_LIMIT:
+                path = await loop.run_in_executor(None, _compress, path)
+                if os.path.getsize(path) > UPLOAD_LIMIT:
+                    raise TransferError("файл больше 50 МБ даже в сжатом виде")
+            await self.outbound.call('broadcast', run.chat_id, self._send_file, run.chat_id, path)
+        return job
+
+    async def _send_file(self, chat_id: int, path: str):
+        # InputFile читает файл при отправке, поэтому при повторе после RetryAfter создаём новый
+        return await self.bot.send_document(chat_id, types.InputFile(path))
+
+    def _import(self, run: TransferRun, file_id: str, fmt: str, compressed: bool):
+        async def job(workdir: str):
+            loop = asyncio.get_running_loop()
+            path = os.path.join(workdir, 'upload')
+            with open(path, 'wb') as f:
+                await self.bot.download_file_by_id(file_id, destination=f, timeout=DOWNLOAD_TIMEOUT)
+            columns = await loop.run_in_executor(None, read_columns, path, run.table, fmt, compressed)
+            batches = read_batches(path, run.table, fmt, compressed, columns, self.batch_size)
+            # Следующая порция разбирается в потоке, пока текущая пишется в базу
+            pending = loop.run_in_executor(None, next, batches, None)
+            try:
+                while (rows := await pending) is not None:
+                    pending = loop.run_in_executor(None, next, batches, None)
+                    changed, conflicts = await import_rows(self.pool, run.table, rows, columns)
+                    run.rows += changed
+                    run.skipped += len(rows) - changed - len(conflicts)
+                    run.conflicts.extend(conflicts)
+            finally:
+                await asyncio.gather(pending, return_exceptions=True)
+                await loop.run_in_executor(None, batches.close)
+        return job
+
+    async def _report(self, run: TransferRun):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._edit_progress(run)
+
+    async def _edit_progress(self, run: TransferRun, finished: bool = False, error: Optional[str] = None):
+        try:
+            # Отчёт, не успевший уйти, заменяется более свежим
+            await self.outbound.call(
+                'broadcast', None, self.bot.edit_message_text,
+                run.progress_text(finished, error),
+                chat_id=run.chat_id,
+                message_id=run.progress_message_id,
+                coalesce_key=('transfer_progress', run.chat_id, run.progress_message_id)
+            )
+        except MessageNotModified:
+            pass
+        except TelegramAPIError as e:
+            logger.warning(f"Failed to update {run.kind} progress: {e}")
@@ -0,0 +1,58 @@
+import hmac
+import json
+import logging
+from typing import Optional
+
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY, WebhookRequestHandler
+from aiohttp import web
+
+from config import WEBHOOK_SECRET
+from crypto_pay import CryptoPayAPI
+
+# Заголовок, в котором Telegram присылает secret_token из setWebhook
+TELEGRAM_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+CRYPTO_PAY_SIGNATURE_HEADER = 'crypto-pay-api-signature'
+
+logger = logging.getLogger('bot_logger')
+
+
+def check_telegram_secret(request: web.Request):
+    """Отклоняет запрос без верного секретного токена из setWebhook"""
+    if WEBHOOK_SECRET:
+        token = request.headers.get(TELEGRAM_SECRET_HEADER, '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            raise web.HTTPUnauthorized()
+
+
+async def read_paid_invoice(request: web.Request, api: CryptoPayAPI) -> Optional[dict]:
+    """
+    Проверяет подпись вебхука Crypto Pay по сырому телу запроса
+    и возвращает оплаченный инвойс (None для остальных событий)
+    """
+    body = await request.read()
+    if not api.check_signature(body, request.headers.get(CRYPTO_PAY_SIGNATURE_HEADER)):
+        logger.warning("Rejected Crypto Pay webhook with invalid signature")
+        raise web.HTTPUnauthorized()
+
+    update = json.loads(body)
+    if update.get('update_type') == 'invoice_paid':
+        return update['payload']
+    return None
+
+
+class SecretWebhookRequestHandler(WebhookRequestHandler):
+    """Принимает обновления Telegram только с верным секретным токеном"""
+
+    async def post(self):
+        check_telegram_secret(self.request)
+        return await super().post()
+
+
+async def crypto_pay_webhook(request: web.Request) -> web.Response:
+    """Вебхук Crypto Pay: оплаченный инвойс передаётся в сверку инвойсов для выдачи доступа"""
+    invoices = request.app[BOT_DISPATCHER_KEY]['invoices']
+    invoice = await read_paid_invoice(request, invoices.api)
+    if invoice is not None:
+        # Ошибка вернёт 500, и Crypto Pay повторит доставку
+        await invoices.handle_paid(invoice)
+    return web.Response(text='ok')